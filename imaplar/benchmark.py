@@ -0,0 +1,491 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Imaplar benchmarks measure throughput and latency against an in-memory
+IMAP server. Each scenario runs in a fresh process, and its results
+are written as a line of JSON.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+from . import client
+from . import engine
+from . import pipeline
+from . import policy as _policy
+from . import server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+@dataclasses.dataclass
+class Options:
+    """Benchmark options.
+
+    :ivar messages: the number of messages to process
+    :ivar mailboxes: the number of monitored mailboxes
+    :ivar bursts: the number of bursts the messages are delivered in
+    :ivar size: the approximate size of each message in bytes
+    :ivar latency: server delay before each response in seconds
+    :ivar idle: the server supports IDLE
+    :ivar move: the server supports MOVE
+    :ivar uidplus: the server supports UIDPLUS
+    :ivar condstore: the server supports CONDSTORE and QRESYNC
+    :ivar notify: the server supports NOTIFY
+    :ivar esearch: the server supports ESEARCH, SEARCHRES, MULTISEARCH
+        and PARTIAL
+    :ivar poll: the session's polling interval in seconds
+    :ivar window: the session's search window
+    :ivar catchup: connections used to catch up on a backlog,
+        or 0 for just one
+    :ivar batch_size: the policy's batch size
+    :ivar prefetch: the policy's prefetch attributes
+    :ivar action: what the policy does with each message:
+        "none", "flag" or "move"
+    :ivar workers: pipeline workers, or 0 for no pipeline
+    :ivar engine: worker threads of an asyncio engine that runs the
+        session, as imaplar does, or 0 to run it on a thread of its own
+    :ivar timeout: give up after this many seconds
+    """
+
+    messages: int = 10000
+    mailboxes: int = 1
+    bursts: int = 10
+    size: int = 2048
+    latency: float = 0
+    idle: bool = True
+    move: bool = True
+    uidplus: bool = True
+    condstore: bool = True
+    notify: bool = False
+    esearch: bool = False
+    poll: float = 1
+    window: int = 10000
+    catchup: int = 0
+    batch_size: int = 500
+    prefetch: tuple = ("ENVELOPE", "FLAGS")
+    action: str = "none"
+    workers: int = 0
+    engine: int = 0
+    timeout: float = 600
+
+class Recorder:
+    """A policy module that notes when each message is handled.
+
+    :param action: what to do with each message: "none", "flag" or "move"
+    :type action: str
+    """
+
+    def __init__(self, action = "none"):
+        self.action = action
+        self.handled = {}
+        self._condition = threading.Condition()
+
+    def handle_batch(self, context, messages):
+        now = time.monotonic()
+        if self.action == "flag":
+            context.actions.add_flags(context.mailbox, messages,
+                ["\\Flagged"])
+        elif self.action == "move":
+            context.actions.move(context.mailbox, messages, "Archive")
+        with self._condition:
+            for message in messages:
+                self.handled.setdefault((context.mailbox, message), now)
+            self._condition.notify_all()
+
+    def wait(self, count, timeout):
+        """Wait until a number of messages have been handled.
+
+        :param count: the number of messages
+        :param timeout: maximum wait in seconds
+        :type count: int
+        :type timeout: float
+        :return: True unless the wait timed out
+        :rtype: bool
+        """
+
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: len(self.handled) >= count, timeout)
+
+class Querier(Recorder):
+    """A policy module that searches for each batch of messages,
+    and fetches their envelopes, before noting when they are handled.
+
+    :param action: what to do with each message: "none", "flag" or "move"
+    :type action: str
+    """
+
+    def handle_batch(self, context, messages):
+        client = context.pool or context.client
+        query = _policy.Query(["UID", ",".join(str(m) for m in messages),
+            "FROM", "example.com"])
+        found = query.search(client, context.mailbox)[context.mailbox]
+        envelopes = _policy.fetch_envelopes(client, context.mailbox,
+            list(found))
+        super().handle_batch(context, [m for m in messages if m in envelopes])
+
+def message(number, size = 2048):
+    """Make a synthetic message.
+
+    :param number: message number, used to vary the headers
+    :param size: approximate message size in bytes
+    :type number: int
+    :type size: int
+    :rtype: bytes
+    """
+
+    headers = ("From: Sender {0} <sender{1}@example.com>\r\n"
+        "To: recipient{2}@example.org\r\n"
+        "Subject: benchmark message {0}\r\n"
+        "Message-ID: <{0}@benchmark.example.com>\r\n"
+        "Date: Mon, 1 Jan 2024 00:00:00 +0000\r\n"
+        "\r\n").format(number, number % 97, number % 13).encode("ascii")
+    line = b"The quick brown fox jumps over the lazy dog.\r\n"
+    return headers + line * max(1, (size - len(headers)) // len(line))
+
+def backlog(options):
+    """Process a mailbox of unseen messages, delivered before startup.
+
+    :param options: benchmark options
+    :type options: Options
+    :return: the results
+    :rtype: dict
+    """
+
+    backend = server.Backend()
+    for i in range(options.messages):
+        backend.append(_mailbox(i, options), message(i, options.size),
+            notify = False)
+    return _run("backlog", options, backend)
+
+def burst(options):
+    """Process messages delivered in bursts to an idle session.
+
+    :param options: benchmark options
+    :type options: Options
+    :return: the results
+    :rtype: dict
+    """
+
+    def deliver(imap, recorder, delivered, deadline):
+        size = max(1, options.messages // options.bursts)
+        for start in range(0, options.messages, size):
+            for i in range(start, min(start + size, options.messages)):
+                name = _mailbox(i, options)
+                uid = imap.append(name, message(i, options.size))
+                delivered[(name, uid)] = time.monotonic()
+            if not recorder.wait(len(delivered),
+                    deadline - time.monotonic()):
+                break
+
+    return _run("burst", options, server.Backend(), deliver)
+
+def mailboxes(options):
+    """Process messages delivered at once to many mailboxes.
+
+    Unless the server supports NOTIFY, new mail outside the first
+    mailbox is found by STATUS checks, every polling interval.
+
+    :param options: benchmark options
+    :type options: Options
+    :return: the results
+    :rtype: dict
+    """
+
+    def deliver(imap, recorder, delivered, deadline):
+        for i in range(options.messages):
+            name = _mailbox(i, options)
+            uid = imap.append(name, message(i, options.size))
+            delivered[(name, uid)] = time.monotonic()
+
+    if options.mailboxes < 2:
+        options = dataclasses.replace(options, mailboxes = 100)
+    return _run("mailboxes", options, server.Backend(), deliver)
+
+def queries(options):
+    """Process a backlog with a policy that searches for each batch
+    of messages and fetches their envelopes.
+
+    :param options: benchmark options
+    :type options: Options
+    :return: the results
+    :rtype: dict
+    """
+
+    backend = server.Backend()
+    for i in range(options.messages):
+        backend.append(_mailbox(i, options), message(i, options.size),
+            notify = False)
+    return _run("queries", options, backend, recorder = Querier)
+
+scenarios = {
+    "backlog": backlog,
+    "burst": burst,
+    "mailboxes": mailboxes,
+    "queries": queries
+}
+
+def run(scenario, options):
+    """Run a scenario in a fresh process.
+
+    The peak RSS is that of the process, which includes the server.
+    A scenario that does not complete within the timeout is reported
+    with ``completed`` false.
+
+    :param scenario: scenario name
+    :param options: benchmark options
+    :type scenario: str
+    :type options: Options
+    :return: the results
+    :rtype: dict
+    """
+
+    with concurrent.futures.ProcessPoolExecutor(1,
+            mp_context = multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(scenarios[scenario], options).result()
+
+def _mailbox(number, options):
+    if options.mailboxes < 2:
+        return "INBOX"
+    index = number % options.mailboxes
+    return "INBOX" if index == 0 else "box{}".format(index)
+
+def _run(scenario, options, backend, deliver = None, recorder = Recorder):
+    names = [_mailbox(i, options) for i in range(options.mailboxes)]
+    for name in names + ["Archive"]:
+        backend.create(name)
+    recorder = recorder(options.action)
+    policy = client.Policy(module = recorder, batch_size = options.batch_size,
+        prefetch = tuple(options.prefetch), name = "benchmark")
+
+    imap = server.Server(backend, idle = options.idle, move = options.move,
+        uidplus = options.uidplus, condstore = options.condstore,
+        notify = options.notify, esearch = options.esearch,
+        latency = options.latency)
+    with imap:
+        session = client.Session(imap.host, imap.port,
+            client.TLSMode.DISABLED, None,
+            client.LoginAuthenticator("benchmark", "benchmark"),
+            poll = options.poll, mailboxes = {n: policy for n in names},
+            window = options.window, catchup = options.catchup)
+        if options.workers:
+            session.pipeline = pipeline.Pipeline(session, options.workers)
+
+        # messages already present count from when the session starts
+        start = time.monotonic()
+        deadline = start + options.timeout
+        delivered = dict(((n, m.uid), start)
+            for n in names for m in backend.get(n).messages)
+        if options.engine:
+            target = functools.partial(_engine, session, options.engine)
+        else:
+            target = functools.partial(_session, session)
+        threading.Thread(target = target, name = "imaplar-benchmark",
+            daemon = True).start()
+        commands = 0
+        ready = True
+        if deliver:
+            # wait for the initial scan, then deliver mail
+            ready = _ready(imap, deadline)
+            if ready:
+                start = time.monotonic()
+                commands = sum(imap.call(
+                    lambda: dict(imap.commands)).values())
+                deliver(imap, recorder, delivered, deadline)
+
+        completed = ready and recorder.wait(len(delivered),
+            deadline - time.monotonic())
+        if completed and session.pipeline:
+            # let the workers apply the policy's actions
+            session.pipeline.join()
+            session.pipeline.stop()
+        elapsed = time.monotonic() - start
+        counts = imap.call(lambda: dict(imap.commands))
+        traffic = imap.call(lambda: (imap.bytes_in, imap.bytes_out))
+
+    count = len(recorder.handled)
+    if not ready:
+        logging.error("{}: session not ready after {} seconds".format(
+            scenario, options.timeout))
+    elif not completed:
+        logging.error("{}: {} of {} messages handled in {} seconds"
+            .format(scenario, count, len(delivered), options.timeout))
+    round_trips = sum(counts.values()) - commands
+    delays = sorted(recorder.handled[k] - delivered[k]
+        for k in recorder.handled if k in delivered)
+    return {
+        "scenario": scenario,
+        "completed": completed,
+        "messages": count,
+        "seconds": elapsed,
+        "messages_per_second": count / elapsed if elapsed else None,
+        "round_trips": round_trips,
+        "round_trips_per_message": round_trips / count if count else None,
+        "latency": _summary(delays),
+        "peak_rss": _peak_rss(),
+        "bytes_in": traffic[0],
+        "bytes_out": traffic[1],
+        "commands": counts,
+        "options": dataclasses.asdict(options)
+    }
+
+def _session(session):
+    try:
+        session.run()
+    except Exception:
+        # the server stops when the benchmark is over
+        logging.debug("benchmark session ended", exc_info = True)
+
+def _engine(session, workers):
+    # one connection, like Session.run, rather than reconnecting
+    sessions = engine.Engine(workers)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers = workers, thread_name_prefix = "imaplar-worker")
+    try:
+        asyncio.run(sessions.run_session(executor, session))
+    except Exception:
+        # the server stops when the benchmark is over
+        logging.debug("benchmark session ended", exc_info = True)
+    finally:
+        executor.shutdown(wait = False)
+
+def _ready(imap, deadline):
+    # the session is ready once it starts waiting for mail
+    while time.monotonic() < deadline:
+        commands = imap.call(lambda: dict(imap.commands))
+        if commands.get("IDLE") or commands.get("NOOP"):
+            return True
+        time.sleep(0.01)
+    return False
+
+def _summary(values):
+    if not values:
+        return None
+    def percentile(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": values[-1]
+    }
+
+def _peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def main(argv = sys.argv):
+    defaults = Options()
+    parser = argparse.ArgumentParser(prog = argv[0],
+        description = __doc__)
+    parser.add_argument("scenarios", metavar = "scenario", nargs = "*",
+        help = "scenario to run: {} (default: all)".format(
+            ", ".join(sorted(scenarios))))
+    parser.add_argument("--messages", type = int,
+        default = defaults.messages,
+        help = "messages to process (default: {})".format(
+            defaults.messages))
+    parser.add_argument("--mailboxes", type = int,
+        default = defaults.mailboxes,
+        help = "monitored mailboxes (default: {}, or 100 for the "
+            "mailboxes scenario)".format(defaults.mailboxes))
+    parser.add_argument("--bursts", type = int, default = defaults.bursts,
+        help = "bursts of mail (default: {})".format(defaults.bursts))
+    parser.add_argument("--size", type = int, default = defaults.size,
+        help = "message size in bytes (default: {})".format(defaults.size))
+    parser.add_argument("--latency", type = float,
+        default = defaults.latency,
+        help = "server response delay in seconds (default: {})".format(
+            defaults.latency))
+    for name in ("idle", "move", "uidplus", "condstore", "notify",
+            "esearch"):
+        parser.add_argument("--" + name, dest = name,
+            action = "store_true", default = getattr(defaults, name),
+            help = "the server supports {}{}".format(name.upper(),
+                " (default)" if getattr(defaults, name) else ""))
+        parser.add_argument("--no-" + name, dest = name,
+            action = "store_false",
+            help = "the server does not support {}".format(name.upper()))
+    parser.add_argument("--poll", type = float, default = defaults.poll,
+        help = "polling interval in seconds (default: {})".format(
+            defaults.poll))
+    parser.add_argument("--window", type = int, default = defaults.window,
+        help = "search window in messages or UIDs (default: {})".format(
+            defaults.window))
+    parser.add_argument("--catchup", type = int,
+        default = defaults.catchup,
+        help = "connections used to catch up on a backlog, or 0 for "
+            "just one (default: {})".format(defaults.catchup))
+    parser.add_argument("--batch-size", type = int,
+        default = defaults.batch_size,
+        help = "policy batch size (default: {})".format(
+            defaults.batch_size))
+    parser.add_argument("--prefetch", nargs = "*",
+        default = list(defaults.prefetch),
+        help = "prefetched attributes (default: {})".format(
+            " ".join(defaults.prefetch)))
+    parser.add_argument("--action", choices = ["none", "flag", "move"],
+        default = defaults.action,
+        help = "what the policy does with each message (default: {})"
+            .format(defaults.action))
+    parser.add_argument("--workers", type = int, default = defaults.workers,
+        help = "pipeline workers, or 0 for none (default: {})".format(
+            defaults.workers))
+    parser.add_argument("--engine", type = int, default = defaults.engine,
+        help = "run the session on an asyncio engine with this many "
+            "worker threads, or 0 for a thread of its own (default: {})"
+            .format(defaults.engine))
+    parser.add_argument("--timeout", type = float,
+        default = defaults.timeout,
+        help = "fail after this many seconds (default: {})".format(
+            defaults.timeout))
+    args = parser.parse_args(args = argv[1:])
+    for scenario in args.scenarios:
+        if scenario not in scenarios:
+            parser.error("{}: unknown scenario".format(scenario))
+
+    options = Options(**dict((f.name, getattr(args, f.name))
+        for f in dataclasses.fields(Options)))
+    options.prefetch = tuple(options.prefetch)
+    incomplete = []
+    for scenario in args.scenarios or sorted(scenarios):
+        result = run(scenario, options)
+        print(json.dumps(result), flush = True)
+        if not result["completed"]:
+            incomplete.append(scenario)
+    if incomplete:
+        sys.exit("{}: incomplete after {} seconds: {}".format(argv[0],
+            options.timeout, ", ".join(incomplete)))
+
+if __name__ == "__main__":
+    main()
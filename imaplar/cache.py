@@ -0,0 +1,119 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+This module caches the results of searches, so that a policy that
+repeats the same query costs a STATUS rather than a SEARCH.
+"""
+
+import collections
+import threading
+import time
+
+class QueryCache:
+    """A least recently used cache of search results.
+
+    Each result is stored with the state of the mailbox it was computed
+    from, and is only reused while that state is unchanged and the
+    entry has not expired.
+
+    :param size: maximum number of entries
+    :param ttl: maximum age of an entry in seconds
+    :type size: int
+    :type ttl: float
+    """
+
+    def __init__(self, size = 1024, ttl = 300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, state):
+        """Get a cached result.
+
+        :param key: cache key
+        :param state: the current state of the searched mailbox
+        :type key: hashable
+        :type state: imaplar.policy.MailboxState
+        :return: message ids, or None if not cached
+        :rtype: list of ints
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry_state, expires, messages = entry
+                if entry_state == state and time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return list(messages)
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, state, messages):
+        """Cache a result.
+
+        :param key: cache key
+        :param state: the state of the mailbox before it was searched
+        :param messages: message ids
+        :type key: hashable
+        :type state: imaplar.policy.MailboxState
+        :type messages: iterable of ints
+        """
+
+        with self._lock:
+            self._entries[key] = (state, time.monotonic() + self.ttl,
+                tuple(messages))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        """Discard every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+def key(server, mailbox, criteria):
+    """Make a cache key.
+
+    IMAP search keys and string matches are case-insensitive,
+    so criteria that differ only in case share a key.
+
+    :param server: server name
+    :param mailbox: mailbox name
+    :param criteria: search criteria
+    :type server: str
+    :type mailbox: str
+    :type criteria: nested lists of strings
+    :return: a cache key
+    :rtype: tuple
+    """
+
+    return (server, mailbox, _normalise(criteria))
+
+def _normalise(criteria):
+    if isinstance(criteria, (list, tuple)):
+        return tuple(_normalise(c) for c in criteria)
+    if isinstance(criteria, bytes):
+        criteria = criteria.decode("utf-8", "replace")
+    return str(criteria).lower()
@@ -0,0 +1,136 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+This module records how far each mailbox has been processed,
+so that a session resumes from where it left off instead of
+rescanning the mailbox.
+"""
+
+import dataclasses
+import sqlite3
+import threading
+
+@dataclasses.dataclass(frozen = True)
+class Checkpoint:
+    """The processing state of a mailbox.
+
+    Checkpoints are only meaningful while the mailbox's UIDVALIDITY
+    is unchanged. If the server supports CONDSTORE (RFC 7162),
+    the mailbox's HIGHESTMODSEQ when it was last scanned is also
+    recorded, otherwise it is zero.
+    """
+
+    uidvalidity: int
+    uid: int
+    modseq: int = 0
+
+class MemoryStore:
+    """Checkpoints held in memory, and lost when the process exits."""
+
+    def __init__(self):
+        self._checkpoints = {}
+        self._lock = threading.Lock()
+
+    def get(self, server, mailbox):
+        """Get a mailbox's checkpoint.
+
+        :param server: server name
+        :param mailbox: mailbox name
+        :type server: str
+        :type mailbox: str
+        :return: the checkpoint, or None
+        :rtype: Checkpoint
+        """
+
+        with self._lock:
+            return self._checkpoints.get((server, mailbox))
+
+    def put(self, server, mailbox, checkpoint):
+        """Set a mailbox's checkpoint.
+
+        :param server: server name
+        :param mailbox: mailbox name
+        :param checkpoint: the checkpoint
+        :type server: str
+        :type mailbox: str
+        :type checkpoint: Checkpoint
+        """
+
+        with self._lock:
+            self._checkpoints[(server, mailbox)] = checkpoint
+
+class SQLiteStore:
+    """Checkpoints held in an SQLite database.
+
+    :param path: database path
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                "server TEXT NOT NULL, "
+                "mailbox TEXT NOT NULL, "
+                "uidvalidity INTEGER NOT NULL, "
+                "uid INTEGER NOT NULL, "
+                "modseq INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (server, mailbox))")
+
+    def get(self, server, mailbox):
+        """Get a mailbox's checkpoint.
+
+        :param server: server name
+        :param mailbox: mailbox name
+        :type server: str
+        :type mailbox: str
+        :return: the checkpoint, or None
+        :rtype: Checkpoint
+        """
+
+        with self._lock:
+            row = self._db.execute("SELECT uidvalidity, uid, modseq "
+                "FROM checkpoints WHERE server = ? AND mailbox = ?",
+                (server, mailbox)).fetchone()
+        return Checkpoint(*row) if row else None
+
+    def put(self, server, mailbox, checkpoint):
+        """Set a mailbox's checkpoint.
+
+        :param server: server name
+        :param mailbox: mailbox name
+        :param checkpoint: the checkpoint
+        :type server: str
+        :type mailbox: str
+        :type checkpoint: Checkpoint
+        """
+
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO checkpoints "
+                "(server, mailbox, uidvalidity, uid, modseq) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (server, mailbox, checkpoint.uidvalidity, checkpoint.uid,
+                    checkpoint.modseq))
+
+    def close(self):
+        """Close the database."""
+
+        with self._lock:
+            self._db.close()
@@ -16,14 +16,34 @@
 #
 
 import collections.abc
+import concurrent.futures
+import contextvars
 import dataclasses
+import email
 import enum
+import functools
 import imapclient
+import imapclient.imap_utf7
 import imaplib
 import logging
+import selectors
 import ssl
 import tenacity
+import threading
 import time
+import types
+from . import checkpoint
+from . import index
+from . import metrics
+from . import pipeline
+from . import policy as _policy
+from . import pool as _pool
+from . import profiling
+from . import trace
+
+# how often, in seconds, a connection that is waiting for others to
+# catch up on a backlog is kept alive
+_keepalive = 300
 
 class ConnectionError(Exception):
     pass
@@ -33,6 +53,190 @@ class TLSMode(enum.Enum):
     ENABLED = 1
     STARTTLS = 2
 
+class Client(imapclient.IMAPClient):
+    """An IMAP client that knows which mailbox is selected.
+
+    Selecting the mailbox that is already selected does nothing, and
+    a mailbox selected read-write satisfies a read-only selection.
+    A read-only selection is upgraded only when read-write access is
+    requested.
+
+    Once its owner sets ``unsolicited`` and ``selections`` to lists,
+    the client also notes changes that the server reports while other
+    commands are running, which imaplib would otherwise hold until
+    the next command of the same name, or discard.
+
+    :ivar selected: name of the selected mailbox, or None
+    :ivar readonly: whether the selected mailbox is read-only
+    :ivar enabled: extensions enabled with ENABLE
+    :ivar unsolicited: (mailbox, response) pairs of the unsolicited
+        EXISTS and STATUS responses received, with the mailbox then
+        selected, or None to leave them to imaplib
+    :ivar selections: (mailbox, response) pairs of the mailboxes
+        selected, or None
+    """
+
+    def __init__(self, *args, **kwargs):
+        # responses may be received while connecting
+        self.selected = None
+        self.unsolicited = None
+        self.selections = None
+        self._selecting = False
+        self._status = None
+        super().__init__(*args, **kwargs)
+        self.readonly = None
+        self.enabled = set()
+        self._selection = {}
+        self._open = True
+        metrics.connections.labels(self.host).inc()
+
+    def _create_IMAP4(self):
+        imap = super()._create_IMAP4()
+        trace.instrument(imap, self.host)
+        append_untagged = imap._append_untagged
+
+        def _append_untagged(typ, dat):
+            if not self._note(typ, dat):
+                append_untagged(typ, dat)
+
+        imap._append_untagged = _append_untagged
+        return imap
+
+    def _note(self, typ, dat):
+        # keep an unsolicited response from imaplib, if it is wanted
+        if self.unsolicited is None:
+            return False
+        if typ == "EXISTS" and not self._selecting:
+            self.unsolicited.append((self.selected,
+                (int(dat), b"EXISTS")))
+            return True
+        if typ == "STATUS":
+            # such as a NOTIFY (RFC 5465) report; the response to a
+            # STATUS command is left to the command, as is any response
+            # that names no mailbox, such as one split by a literal
+            response = (b"STATUS",)
+            if isinstance(dat, bytes):
+                try:
+                    response = imapclient.imapclient\
+                        ._parse_untagged_response(b"* STATUS " + dat)
+                except Exception:
+                    pass
+            name = response[1] if len(response) > 2 else None
+            if isinstance(name, bytes):
+                name = imapclient.imap_utf7.decode(name)
+            if self._status is not None and\
+                    (name is None or str(name) == self._status):
+                return False
+            self.unsolicited.append((self.selected, response))
+            return True
+        return False
+
+    def folder_status(self, folder, what = None):
+        self._status = folder
+        try:
+            return super().folder_status(folder, what)
+        finally:
+            self._status = None
+
+    def logout(self):
+        try:
+            return super().logout()
+        finally:
+            self._closed()
+
+    def shutdown(self):
+        try:
+            super().shutdown()
+        finally:
+            self._closed()
+
+    def _closed(self):
+        if self._open:
+            self._open = False
+            metrics.connections.labels(self.host).dec()
+
+    def pending(self):
+        """Has a response already been received, but not yet read?
+
+        A response may be buffered along with an earlier one, in which
+        case waiting for the socket to become readable would block.
+
+        :rtype: bool
+        """
+
+        sock = self.socket()
+        pending = getattr(sock, "pending", None)
+        if pending and pending():
+            return True
+
+        # peek at imaplib's buffer, without blocking if it is empty
+        peek = getattr(getattr(self._imap, "file", None), "peek", None)
+        if peek is None:
+            return False
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(peek(1))
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def idle_check(self, timeout = None):
+        # imapclient only polls the socket, missing responses that
+        # imaplib has already buffered
+        responses = []
+        while self.pending():
+            responses.append(imapclient.imapclient._parse_untagged_response(
+                self._imap._get_line()))
+        if responses:
+            timeout = 0
+        responses.extend(super().idle_check(timeout))
+        return responses
+
+    def enable(self, *capabilities):
+        enabled = super().enable(*capabilities)
+        self.enabled.update(enabled)
+        return enabled
+
+    def select_folder(self, folder, readonly = False, refresh = False):
+        """Select a mailbox, unless it is already suitably selected.
+
+        :param folder: mailbox name
+        :param readonly: select the mailbox read-only
+        :param refresh: select the mailbox even if already selected
+        :type folder: str
+        :type readonly: bool
+        :type refresh: bool
+        :return: the response to the command that selected the mailbox
+        :rtype: dict
+        """
+
+        if not refresh and folder == self.selected\
+                and (readonly or not self.readonly):
+            return self._selection
+
+        self.selected = None
+        self._selecting = True
+        try:
+            response = super().select_folder(folder, readonly = readonly)
+        finally:
+            self._selecting = False
+        self.selected = folder
+        self.readonly = readonly
+        self._selection = response
+        if self.selections is not None:
+            self.selections.append((folder, response))
+        return response
+
+    def close_folder(self):
+        self.selected = None
+        return super().close_folder()
+
+    def unselect_folder(self):
+        self.selected = None
+        return super().unselect_folder()
+
 @dataclasses.dataclass
 class LoginAuthenticator:
     username: str
@@ -62,6 +266,87 @@ class PlainAuthenticator:
         return client.plain_login(self.identity, self.password,
             self.authorization_identity)
 
+@dataclasses.dataclass
+class Policy:
+    """A compiled policy script, or a policy module.
+
+    Before the policy runs, the prefetch attributes (and the selected
+    headers) of every new message are fetched with a single FETCH.
+    In batch mode, the script is run once for a sequence of messages
+    rather than once per message.
+
+    A policy module is loaded once. It defines ``handle(context,
+    message)`` and/or ``handle_batch(context, messages)``, which is
+    preferred if present, and optionally ``setup(parameters)`` and
+    ``teardown(state)``. The value returned by setup, called once per
+    session, is available to the handlers as ``context.state``.
+
+    If process is set and the session has a process pool, the policy
+    runs in a worker process, loaded from its module or source.
+
+    The name, if any, identifies the policy in traces and logs.
+    """
+
+    code: types.CodeType = None
+    module: types.ModuleType = None
+    source: str = None
+    process: bool = False
+    batch: bool = False
+    batch_size: int = 500
+    prefetch: collections.abc.Sequence = ("ENVELOPE", "FLAGS")
+    headers: collections.abc.Sequence = ()
+    name: str = None
+
+    def fetch(self, client, messages):
+        """Prefetch message data from the selected mailbox.
+
+        Selected headers are parsed and stored under the b"HEADERS" key.
+
+        :param client: connected client
+        :param messages: message ids
+        :type client: imapclient.IMAPClient
+        :type messages: sequence of ints
+        :return: mapping of message ids to fetched data
+        :rtype: dict
+        """
+
+        attributes = list(self.prefetch)
+        if self.headers:
+            attributes.append("BODY.PEEK[HEADER.FIELDS ({})]".format(
+                " ".join(h.upper() for h in self.headers)))
+        if not attributes or not messages:
+            return {}
+
+        response = client.fetch(messages, attributes)
+        if self.headers:
+            for data in response.values():
+                for key in list(data):
+                    if key.startswith(b"BODY[HEADER.FIELDS"):
+                        data[b"HEADERS"] = email.message_from_bytes(
+                            data.pop(key))
+        return response
+
+    def setup(self, parameters):
+        """Prepare a policy module for use by a session.
+
+        :param parameters: server specific parameters
+        :type parameters: collections.abc.Mapping
+        :return: the module's state for the session
+        """
+
+        setup = getattr(self.module, "setup", None)
+        return setup(parameters) if setup else None
+
+    def teardown(self, state):
+        """Release a session's policy module state.
+
+        :param state: the module's state for the session
+        """
+
+        teardown = getattr(self.module, "teardown", None)
+        if teardown:
+            teardown(state)
+
 @dataclasses.dataclass
 class Session:
     host: str
@@ -74,6 +359,31 @@ class Session:
     mailbox: str = "inbox"
     policy: collections.abc.Callable = None
     parameters: collections.abc.Mapping = None
+    mailboxes: collections.abc.Mapping = None
+    checkpoints: object = dataclasses.field(
+        default_factory = checkpoint.MemoryStore)
+    correspondents: index.CorrespondentIndex = None
+    indexed: collections.abc.Sequence = ()
+    pipeline: object = None
+    processes: object = None
+    pool: object = None
+    window: int = 10000
+    catchup: int = 0
+    states: dict = dataclasses.field(default_factory = dict,
+        repr = False, compare = False)
+    lock: object = dataclasses.field(default_factory = threading.RLock,
+        init = False, repr = False, compare = False)
+
+    def watched(self):
+        """Return the watched mailboxes.
+
+        :return: mapping of mailbox names to policies
+        :rtype: collections.abc.Mapping
+        """
+
+        if self.mailboxes:
+            return self.mailboxes
+        return {self.mailbox: self.policy}
 
     @tenacity.retry(
         before = tenacity.before_log(logging.getLogger(), logging.DEBUG))
@@ -96,22 +406,52 @@ class Session:
                 retry = tenacity.retry_unless_exception_type(
                     imaplib.IMAP4.abort),
                 wait = tenacity.wait_exponential(min = min, max = max),
-                before = tenacity.before_log(logger, logging.DEBUG))
+                before = tenacity.before_log(logger, logging.DEBUG),
+                after = lambda state:
+                    metrics.reconnects.labels(self.host).inc())
             backoff(self.run)
         except:
             logging.exception("session aborted")
+            self.close()
             raise
 
+    def close(self):
+        """Tear down the state of any policy modules."""
+
+        with self.lock:
+            states, self.states = self.states, {}
+        for policy, state in states.values():
+            try:
+                policy.teardown(state)
+            except Exception as e:
+                logging.exception("policy teardown exception")
+
     def run(self):
         """Connect to the server and monitor for unseen mail."""
 
+        with self.connect() as client:
+            # process unseen messages, then incoming messages
+            monitor = Monitor(self, client)
+            wait = self._wait_idle if monitor.has_idle else self._wait_poll
+            while True:
+                monitor.scan()
+                if not monitor.changed:
+                    wait(monitor)
+
+    def connect(self):
+        """Connect to the server and authenticate.
+
+        :return: a connected client
+        :rtype: Client
+        """
+
         # connect to IMAP server
-        client = imapclient.IMAPClient(self.host,
+        client = Client(self.host,
             port = self.port, 
             ssl = self.tls_mode == TLSMode.ENABLED, 
             ssl_context = self.ssl_context) 
 
-        with client:
+        try:
             # start TLS?
             if self.tls_mode == TLSMode.STARTTLS:
                 client.starttls(self.ssl_context)
@@ -119,73 +459,720 @@ class Session:
             # perform authentication
             if self.authenticator:
                 self.authenticator(client)
+        except:
+            client.shutdown()
+            raise
 
-            # choose wait mechanism
-            has_idle = b"IDLE" in client.capabilities()
-            wait = self._wait_idle if has_idle else self._wait_poll
+        return client
 
-            # process unseen messages
-            client.select_folder(self.mailbox, readonly = True)
-            messages = client.search(["UNSEEN"])
-            for message in messages:
-                self._process(client, message)
+    def update_index(self, client):
+        """Add new messages in the indexed mailboxes to the
+        correspondent index.
 
-            # process incoming messages
-            next_message = max(messages) + 1 if messages else 1
-            while True:
-                client.select_folder(self.mailbox, readonly = True)
-                wait(client)
-                messages = client.search(
-                    ["{}:*".format(next_message), "UNSEEN"])
-                for message in messages:
-                    self._process(client, message)
-                if messages:
-                    next_message = max(messages) + 1
-
-    def _process(self, client, message):
-        if self.policy:
+        :param client: connected client
+        :type client: imapclient.IMAPClient
+        """
+
+        for mailbox in self.indexed:
+            try:
+                count = self.correspondents.update(client, self.host,
+                    mailbox)
+                if count:
+                    logging.info("indexed {}({})/{}/{} messages".format(
+                        self.host, self.port, mailbox, count))
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                logging.exception("indexing {}({})/{} failed".format(
+                    self.host, self.port, mailbox))
+
+    def scan(self, client, mailbox, uidvalidity, uidnext = None,
+            modseq = None, arrived = None):
+        """Process new unseen messages in the selected mailbox.
+
+        Only messages after the mailbox's checkpoint are considered,
+        unless there is no checkpoint or the mailbox's UIDVALIDITY has
+        changed. The checkpoint is advanced as messages are processed.
+
+        New messages are searched for a window at a time: the next
+        ``window`` unseen messages if the server supports PARTIAL
+        (RFC 9394), and otherwise the unseen messages among the next
+        ``window`` UIDs. A large backlog is thus processed as it is
+        found, without holding every message id, and the checkpoint
+        also advances past the seen messages of each window.
+
+        If ``catchup`` allows more than one connection, a backlog of
+        more than one window of UIDs, with nothing else in flight, is
+        instead caught up on over several connections, borrowed from
+        the session's pool if it has one, leaving one connection in the
+        pool for the policies. Each connection processes a window at a
+        time, and the checkpoint advances over the windows finished in
+        order. Monitoring resumes once every window has been processed.
+
+        If the mailbox's HIGHESTMODSEQ is given, earlier messages that
+        have been marked unseen again since the checkpoint are also
+        processed, and the mailbox is not searched at all when nothing
+        has changed.
+
+        :param client: connected client
+        :param mailbox: the selected mailbox
+        :param uidvalidity: the mailbox's UIDVALIDITY
+        :param uidnext: the mailbox's UIDNEXT, if known to be current
+        :param modseq: the mailbox's HIGHESTMODSEQ, if known to be current
+        :param arrived: when new mail was noticed, as a time.monotonic()
+            value, or None
+        :type client: imapclient.IMAPClient
+        :type mailbox: str
+        :type uidvalidity: int
+        :type uidnext: int
+        :type modseq: int
+        :type arrived: float
+        """
+
+        # messages queued for processing are treated as processed;
+        # a job commits its checkpoint before it stops being in flight,
+        # so look at the jobs before the checkpoint
+        top, pending = self.pipeline.in_flight(mailbox, uidvalidity)\
+            if self.pipeline else (0, ())
+
+        saved = self.checkpoints.get(self.host, mailbox)
+        if saved and saved.uidvalidity != uidvalidity:
+            logging.info("{}({})/{}: UIDVALIDITY changed".format(
+                self.host, self.port, mailbox))
+            saved = None
+        last = saved.uid if saved else 0
+        top = max(last, top)
+
+        saved_modseq = saved.modseq if saved else 0
+        processed = []
+
+        # earlier messages marked unseen again since the checkpoint
+        if last and modseq and saved_modseq and modseq > saved_modseq:
+            messages = sorted(set(client.search(["UID",
+                "1:{}".format(last), "UNSEEN", "MODSEQ",
+                str(saved_modseq + 1)])).difference(pending))
+            self._process(client, mailbox, uidvalidity, top, saved_modseq,
+                messages, arrived)
+            processed.extend(messages[-1:])
+
+        # a large backlog is shared between several connections
+        if self.catchup > 1 and uidnext is not None and not pending\
+                and uidnext - 1 - top > self.window:
+            if self._catch_up(client, mailbox, uidvalidity, top, uidnext,
+                    saved_modseq, arrived):
+                processed.append(uidnext - 1)
+            top = uidnext - 1
+
+            # mail may have arrived meanwhile
+            uidnext = None
+
+        # new messages, a window at a time; the backlog of a large
+        # mailbox is processed as it is found, and the checkpoint
+        # advances past each window's seen messages
+        for messages, end in self._windows(client, top, uidnext):
+            messages = sorted(set(messages).difference(pending))
+            self._process(client, mailbox, uidvalidity, top, saved_modseq,
+                messages, arrived)
+            processed.extend(messages[-1:])
+            if end is not None:
+                top = end
+                self._dispatch(client, pipeline.Job(mailbox, uidvalidity,
+                    (), top, functools.partial(self._reached,
+                        checkpoint.Checkpoint(uidvalidity, top,
+                            saved_modseq))))
+
+        # skip over seen messages next time
+        last = max([top] + processed)
+        if uidnext is not None:
+            last = max(last, uidnext - 1)
+        self._dispatch(client, pipeline.Job(mailbox, uidvalidity, (), last,
+            functools.partial(self._finish, mailbox, uidvalidity, last,
+                modseq or saved_modseq,
+                bool(processed and (modseq or saved_modseq)))))
+
+    def commit(self, mailbox, latest):
+        """Record a mailbox's checkpoint, if it has changed.
+
+        :param mailbox: mailbox name
+        :param latest: the checkpoint
+        :type mailbox: str
+        :type latest: imaplar.checkpoint.Checkpoint
+        """
+
+        if latest != self.checkpoints.get(self.host, mailbox):
+            self.checkpoints.put(self.host, mailbox, latest)
+
+    def completed(self, job, ok = True):
+        """Record the metrics of a finished job.
+
+        :param job: the job
+        :param ok: whether the job succeeded
+        :type job: imaplar.pipeline.Job
+        :type ok: bool
+        """
+
+        if not job.messages:
+            return
+        count = len(job.messages)
+        metrics.processed.labels(self.host, job.mailbox).inc(count)
+        if not ok:
+            metrics.failed.labels(self.host, job.mailbox).inc(count)
+        if job.arrived is not None:
+            metrics.delay.labels(self.host, job.mailbox).observe(
+                time.monotonic() - job.arrived, count)
+
+    def _dispatch(self, client, job):
+        if self.pipeline:
+            self.pipeline.submit(job)
+        else:
+            self._execute(client, job)
+            if job.result:
+                self.commit(job.mailbox, job.result)
+
+    def _execute(self, client, job):
+        # run a job at once, leaving its checkpoint to the caller
+        job.result = job.action(client)
+        self.completed(job)
+
+    def _finish(self, mailbox, uidvalidity, last, modseq, refresh, client):
+        if refresh:
+            # don't revisit the messages just processed, or messages
+            # changed by the policy itself; a selected mailbox is
+            # selected again rather than sent STATUS (RFC 3501 6.3.10)
+            if client.selected == mailbox:
+                response = client.select_folder(mailbox,
+                    readonly = client.readonly, refresh = True)
+            else:
+                response = client.folder_status(mailbox,
+                    [b"HIGHESTMODSEQ"])
+            modseq = response.get(b"HIGHESTMODSEQ", modseq)
+        return checkpoint.Checkpoint(uidvalidity, last, modseq)
+
+    def _windows(self, client, top, uidnext):
+        # the unseen messages after top, in windows of at most
+        # self.window messages (with PARTIAL) or UIDs, each with the
+        # highest UID it accounts for, or None for the last window
+        first = top + 1
+        if uidnext is not None and uidnext <= first:
+            return
+        partial = b"PARTIAL" in client.capabilities()
+        while True:
+            if partial:
+                page = _search_partial(client, ["UID",
+                    "{}:*".format(first), "UNSEEN"], self.window)
+                messages = [m for m in page if m >= first]
+                if len(page) < self.window or not messages:
+                    yield messages, None
+                    return
+                end = max(messages)
+            else:
+                end = first + self.window - 1
+                if uidnext is None or end >= uidnext - 1:
+                    # "*" is the highest UID, even if less than first
+                    yield [m for m in client.search(["UID",
+                        "{}:*".format(first), "UNSEEN"]) if m >= first],\
+                        None
+                    return
+                messages = client.search(["UID",
+                    "{}:{}".format(first, end), "UNSEEN"])
+            yield messages, end
+            first = end + 1
+
+    def _reached(self, latest, client):
+        return latest
+
+    def _catch_up(self, client, mailbox, uidvalidity, top, uidnext, modseq,
+            arrived):
+        # process the messages below uidnext over several connections,
+        # a window of UIDs per call, keeping the monitoring connection
+        # alive meanwhile; the checkpoint advances over the windows
+        # finished in order
+        windows = [(first, min(first + self.window, uidnext) - 1)
+            for first in range(top + 1, uidnext, self.window)]
+        connections, workers = self.pool, self.catchup
+        if connections and connections.max > 1:
+            # leave a pooled connection for the policies, which borrow
+            # from the same pool
+            workers = min(workers, connections.max - 1)
+        else:
+            connections = _pool.ConnectionPool(self.connect,
+                max = workers)
+        logging.info("{}({})/{}: catching up on UIDs {}:{} over {} "
+            "connections".format(self.host, self.port, mailbox, top + 1,
+                uidnext - 1, min(workers, len(windows))))
+        progress = _CatchUp(self, mailbox, uidvalidity, modseq, windows)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(1,
+                    thread_name_prefix = "imaplar-catchup") as executor:
+                results = executor.submit(contextvars.copy_context().run,
+                    connections.map, functools.partial(self._catch_up_window,
+                        mailbox, uidvalidity, modseq, arrived, progress),
+                    windows, workers)
+                while True:
+                    try:
+                        return any(results.result(timeout = _keepalive))
+                    except concurrent.futures.TimeoutError:
+                        client.noop()
+        finally:
+            if connections is not self.pool:
+                connections.close()
+
+    def _catch_up_window(self, mailbox, uidvalidity, modseq, arrived,
+            progress, client, window):
+        # once a window has failed, the catch-up is abandoned, and
+        # resumes from its checkpoint after reconnecting
+        if progress.failed:
+            return False
+        first, last = window
+        try:
+            response = client.select_folder(mailbox, readonly = True)
+            if response.get(b"UIDVALIDITY") != uidvalidity:
+                raise imaplib.IMAP4.abort("{}: UIDVALIDITY changed"
+                    .format(mailbox))
+            messages = client.search(["UID", "{}:{}".format(first, last),
+                "UNSEEN"])
+            self._process(client, mailbox, uidvalidity, first - 1, modseq,
+                sorted(messages), arrived, self._execute)
+        except:
+            progress.failed = True
+            raise
+        progress.finished(window)
+        return bool(messages)
+
+    def _process(self, client, mailbox, uidvalidity, last, modseq,
+            messages, arrived = None, dispatch = None):
+        policy = self.watched()[mailbox]
+        if policy and not isinstance(policy, Policy):
+            policy = Policy(policy)
+
+        size = policy.batch_size if policy else max(len(messages), 1)
+        for i in range(0, len(messages), size):
+            batch = messages[i:i + size]
+            latest = checkpoint.Checkpoint(uidvalidity,
+                max(last, batch[-1]), modseq)
+            (dispatch or self._dispatch)(client, pipeline.Job(mailbox,
+                uidvalidity, batch, latest.uid, functools.partial(
+                    self._batch, mailbox, policy, batch, latest), arrived))
+
+    def _batch(self, mailbox, policy, messages, latest, client):
+        if policy:
+            with profiling.measure(self.host, mailbox, policy.name,
+                    len(messages)):
+                # a previous batch may have selected another mailbox,
+                # or applied its actions with this one selected
+                # read-write, where fetching a message marks it seen
+                client.select_folder(mailbox, readonly = True,
+                    refresh = not client.readonly)
+                self._run(client, mailbox, policy, messages)
+        return latest
+
+    def _run(self, client, mailbox, policy, messages):
+        prefetched = policy.fetch(client, messages)
+        correspondents = index.Correspondents(self.correspondents,
+            self.host) if self.correspondents else None
+        actions = _policy.Actions()
+        if policy.process and self.processes:
+            logging.info("processing {}({})/{}/{} messages in a process"
+                .format(self.host, self.port, mailbox, len(messages)))
+            actions, failed = self.processes.run(self.host, policy,
+                mailbox, messages, prefetched, self._parameters())
+            if failed:
+                self._failed(mailbox, failed)
+        elif policy.module:
+            self._handle(client, mailbox, policy, messages,
+                _policy.Context(client, mailbox, prefetched,
+                    self._parameters(), correspondents, actions,
+                    self._state(policy), self.pool))
+        elif policy.batch:
             namespace = {
                 "client": client,
-                "mailbox": self.mailbox,
-                "message": message,
+                "mailbox": mailbox,
+                "messages": messages,
+                "prefetched": prefetched,
+                "correspondents": correspondents,
+                "actions": actions,
+                "pool": self.pool,
                 "parameters": dict(self.parameters) if self.parameters else {}
             }
 
-            logging.info("processing {}({})/{}/{}".format(
-                self.host, self.port, self.mailbox, message))
+            logging.info("processing {}({})/{}/{} messages".format(
+                self.host, self.port, mailbox, len(messages)))
+            try:
+                exec(policy.code, namespace)
+            except Exception as e:
+                logging.exception("policy exception")
+                self._failed(mailbox, len(messages))
+        else:
+            for message in messages:
+                namespace = {
+                    "client": client,
+                    "mailbox": mailbox,
+                    "message": message,
+                    "prefetched": prefetched,
+                    "correspondents": correspondents,
+                    "actions": actions,
+                    "pool": self.pool,
+                    "parameters": dict(self.parameters)
+                        if self.parameters else {}
+                }
+
+                logging.info("processing {}({})/{}/{}".format(
+                    self.host, self.port, mailbox, message))
+                try:
+                    exec(policy.code, namespace)
+                except Exception as e:
+                    logging.exception("policy exception")
+                    self._failed(mailbox)
+
+        # apply deferred actions in bulk
+        if actions:
+            try:
+                actions.flush(client)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                logging.exception("actions failed")
+
+    def _handle(self, client, mailbox, policy, messages, context):
+        handle_batch = getattr(policy.module, "handle_batch", None)
+        if handle_batch:
+            logging.info("processing {}({})/{}/{} messages".format(
+                self.host, self.port, mailbox, len(messages)))
             try:
-                exec(self.policy, namespace)
+                handle_batch(context, messages)
             except Exception as e:
                 logging.exception("policy exception")
+                self._failed(mailbox, len(messages))
+        else:
+            for message in messages:
+                logging.info("processing {}({})/{}/{}".format(
+                    self.host, self.port, mailbox, message))
+                try:
+                    policy.module.handle(context, message)
+                except Exception as e:
+                    logging.exception("policy exception")
+                    self._failed(mailbox)
+
+    def _failed(self, mailbox, count = 1):
+        metrics.failed.labels(self.host, mailbox).inc(count)
+
+    def _parameters(self):
+        return types.MappingProxyType(
+            self.parameters if self.parameters else {})
 
-    def _wait_poll(self, client):
+    def _state(self, policy):
+        # set up each policy module once per session
+        key = id(policy)
+        with self.lock:
+            if key not in self.states:
+                self.states[key] = (policy,
+                    policy.setup(self._parameters()))
+            return self.states[key][1]
+
+    def _wait_poll(self, monitor):
         while True:
-            response = client.noop()
+            if monitor.harvest():
+                return
+            response = monitor.client.noop()
             logging.debug("waiting: noop: {}".format(response))
             if response:
-                if any([x for x in response[1] if x[1] == b"EXISTS"]):
+                if monitor.harvest():
                     return
             else:
                 raise ConnectionError("connection dropped")
 
+            if monitor.check_due() and monitor.check():
+                return
             time.sleep(self.poll)
 
-    def _wait_idle(self, client):
+    def _wait_idle(self, monitor):
+        client = monitor.client
+        if monitor.harvest():
+            return
         now = time.time()
         alarm = now + self.idle
         client.idle()
         while True:
-            response = client.idle_check(alarm - now)
-            logging.debug("waiting: idle_check: {}".format(response))
-            if response:
-                if any([x for x in response if x[1] == b"EXISTS"]):
-                    client.idle_done()
-                    return
-            else:
-                raise ConnectionError("connection dropped")
+            if _readable(client, monitor.timeout(alarm) - now):
+                response = client.idle_check(0)
+                logging.debug("waiting: idle_check: {}".format(response))
+                if response:
+                    if monitor.update(response):
+                        client.idle_done()
+                        monitor.harvest()
+                        return
+                else:
+                    raise ConnectionError("connection dropped")
 
             now = time.time()
-            if now >= alarm:
-                alarm = now + self.idle
+            if now >= alarm or monitor.check_due():
                 client.idle_done()
+                monitor.harvest()
+                if monitor.check_due():
+                    monitor.check()
+                if monitor.harvest():
+                    return
+                if now >= alarm:
+                    alarm = now + self.idle
                 client.idle()
+
+class _CatchUp:
+    # the windows of a catch-up; each window's checkpoint is recorded
+    # once it and every window before it have finished
+    def __init__(self, session, mailbox, uidvalidity, modseq, windows):
+        self.session = session
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.modseq = modseq
+        self.windows = collections.deque(windows)
+        self.done = set()
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def finished(self, window):
+        with self.lock:
+            self.done.add(window)
+            last = None
+            while self.windows and self.windows[0] in self.done:
+                self.done.discard(self.windows[0])
+                last = self.windows.popleft()[1]
+            if last is not None:
+                self.session.commit(self.mailbox, checkpoint.Checkpoint(
+                    self.uidvalidity, last, self.modseq))
+
+class Monitor:
+    """Watches the mailboxes of a session over one connection.
+
+    The first mailbox is selected while waiting. New mail in the
+    other mailboxes is reported by NOTIFY (RFC 5465) if the server
+    supports it, and is otherwise found by rotating STATUS checks
+    every polling interval. Mail that arrives while commands are
+    running, including those sent by policies, is noted by the
+    client and harvested before waiting.
+
+    :param session: the session
+    :param client: connected client
+    :type session: Session
+    :type client: imapclient.IMAPClient
+    """
+
+    def __init__(self, session, client):
+        self.session = session
+        self.client = client
+        client.unsolicited = []
+        client.selections = []
+        self.mailboxes = list(session.watched())
+        self.changed = list(self.mailboxes)
+        self.uidvalidity = {}
+        self.uidnext = {}
+        self.highestmodseq = {}
+        self.status = {}
+        self.arrived = {}
+        self.checked = time.time()
+
+        capabilities = client.capabilities()
+        self.has_idle = b"IDLE" in capabilities
+        self.has_condstore = b"CONDSTORE" in capabilities\
+            or b"QRESYNC" in capabilities
+        if b"QRESYNC" in capabilities:
+            client.enable("QRESYNC")
+        elif self.has_condstore:
+            client.enable("CONDSTORE")
+        self.has_notify = b"NOTIFY" in capabilities\
+            and len(self.mailboxes) > 1
+        if self.has_notify:
+            _notify(client, self.mailboxes[1:])
+        self.select(self.mailboxes[0])
+
+    def select(self, mailbox):
+        """Select a mailbox read-only, remembering its state.
+
+        The mailbox is not selected again if it is still selected,
+        since its state is then tracked by unsolicited responses.
+        Either way, the changes noted by the client are harvested.
+
+        :param mailbox: mailbox name
+        :type mailbox: str
+        """
+
+        if getattr(self.client, "selected", None) != mailbox:
+            self.client.select_folder(mailbox, readonly = True)
+        self.harvest()
+
+    def harvest(self):
+        """Note the changes reported while other commands were running.
+
+        These are the unsolicited responses noted by the client, and
+        the state of every mailbox selected, whether by the monitor,
+        by a policy, or to apply a policy's actions.
+
+        :return: True if any mailbox has changed
+        :rtype: bool
+        """
+
+        selections, self.client.selections = self.client.selections, []
+        for mailbox, response in selections:
+            self._selected(mailbox, response)
+        responses, self.client.unsolicited = self.client.unsolicited, []
+        for mailbox, response in responses:
+            self.update([response], mailbox)
+        return bool(self.changed)
+
+    def _selected(self, mailbox, response):
+        # compare a mailbox's state with its state when last seen
+        if mailbox not in self.mailboxes:
+            return
+        self.uidvalidity[mailbox] = response.get(b"UIDVALIDITY")
+        self.uidnext[mailbox] = response.get(b"UIDNEXT")
+        self.highestmodseq[mailbox] = response.get(b"HIGHESTMODSEQ")
+        status = (response.get(b"UIDNEXT"), response.get(b"EXISTS"),
+            response.get(b"HIGHESTMODSEQ"))
+
+        # mail may have arrived while another mailbox was selected
+        previous = self.status.get(mailbox)
+        self.status[mailbox] = status
+        if previous is not None and previous != status:
+            self._changed(mailbox)
+
+    def scan(self):
+        """Process unseen messages in each changed mailbox.
+
+        On return, the first mailbox is selected. If it changed while
+        another mailbox was selected, it is left marked as changed.
+        """
+
+        if self.changed and self.session.correspondents:
+            self.session.update_index(self.client)
+
+        # the first mailbox is usually still selected, so scan it first
+        # only if nothing else has changed
+        primary = self.mailboxes[0]
+        changed = sorted(self.changed, key = lambda x: x == primary)
+        self.changed = []
+        for mailbox in changed:
+            self.select(mailbox)
+            if mailbox in self.changed:
+                self.changed.remove(mailbox)
+            with trace.span("scan", {
+                    "imaplar.session": self.session.host,
+                    "imaplar.mailbox": mailbox}):
+                self.session.scan(self.client, mailbox,
+                    self.uidvalidity[mailbox], self.uidnext.get(mailbox),
+                    self.highestmodseq.get(mailbox),
+                    self.arrived.pop(mailbox, None))
+        self.select(primary)
+
+    def update(self, responses, mailbox = None):
+        """Note mailboxes changed according to unsolicited responses.
+
+        :param responses: parsed untagged responses
+        :param mailbox: the mailbox selected when the responses were
+            received (default: the first mailbox)
+        :type responses: list of tuples
+        :type mailbox: str
+        :return: True if any mailbox has changed
+        :rtype: bool
+        """
+
+        selected = mailbox or self.mailboxes[0]
+        for response in responses:
+            if len(response) > 1 and response[1] == b"EXISTS":
+                if selected in self.mailboxes:
+                    # UIDNEXT and HIGHESTMODSEQ are no longer current
+                    self.uidnext.pop(selected, None)
+                    self.highestmodseq.pop(selected, None)
+                    self._changed(selected)
+            elif response[0] == b"STATUS" and len(response) > 2:
+                name = response[1]
+                if isinstance(name, bytes):
+                    name = imapclient.imap_utf7.decode(name)
+                for mailbox in self.mailboxes:
+                    if mailbox == str(name):
+                        self._changed(mailbox)
+            elif response[0] == b"STATUS":
+                # the mailbox is unknown, so check every other one
+                for mailbox in self.mailboxes:
+                    if mailbox != selected:
+                        self._changed(mailbox)
+        return bool(self.changed)
+
+    def check_due(self):
+        """Is a rotating STATUS check due?
+
+        :rtype: bool
+        """
+
+        return not self.has_notify and len(self.mailboxes) > 1\
+            and time.time() >= self.checked + self.session.poll
+
+    def check(self):
+        """Check the unselected mailboxes for new mail with STATUS.
+
+        :return: True if any mailbox has changed
+        :rtype: bool
+        """
+
+        items = [b"UIDNEXT", b"MESSAGES"]
+        if self.has_condstore:
+            items.append(b"HIGHESTMODSEQ")
+        for mailbox in self.mailboxes[1:]:
+            response = self.client.folder_status(mailbox, items)
+            status = (response.get(b"UIDNEXT"), response.get(b"MESSAGES"),
+                response.get(b"HIGHESTMODSEQ"))
+            if status != self.status.get(mailbox):
+                self.status[mailbox] = status
+                self._changed(mailbox)
+        self.checked = time.time()
+        return bool(self.changed)
+
+    def timeout(self, alarm):
+        """Limit a deadline to the time of the next STATUS check.
+
+        :param alarm: deadline in seconds since the epoch
+        :type alarm: float
+        :return: the earlier deadline
+        :rtype: float
+        """
+
+        if self.has_notify or len(self.mailboxes) < 2:
+            return alarm
+        return min(alarm, self.checked + self.session.poll)
+
+    def _changed(self, mailbox):
+        # remember when new mail was first noticed, for metrics
+        self.arrived.setdefault(mailbox, time.monotonic())
+        if mailbox not in self.changed:
+            self.changed.append(mailbox)
+
+def _notify(client, mailboxes):
+    names = b" ".join(
+        b"\"" + imapclient.imap_utf7.encode(m).replace(b"\\", b"\\\\")
+            .replace(b"\"", b"\\\"") + b"\"" for m in mailboxes)
+    client._raw_command_untagged(b"NOTIFY", [b"SET",
+        b"(SELECTED (MessageNew MessageExpunge))",
+        b"(MAILBOXES (" + names + b") (MessageNew MessageExpunge))"],
+        uid = False)
+
+def _search_partial(client, criteria, count):
+    # the first UIDs matching the criteria (RFC 9394)
+    args = [b"RETURN", "(PARTIAL 1:{})".format(count).encode()]
+    args.extend(imapclient.imapclient._normalise_search_criteria(criteria))
+    data = client._raw_command_untagged(b"SEARCH", args,
+        response_name = "ESEARCH")
+    messages = []
+    for line in data:
+        tokens = line.upper().replace(b"(", b" ").replace(b")", b" ")\
+            .split() if line else []
+        if b"PARTIAL" in tokens:
+            found = tokens[tokens.index(b"PARTIAL") + 2]
+            if found != b"NIL":
+                messages.extend(_policy._expand(found))
+    return messages
+
+def _readable(client, timeout):
+    if client.pending():
+        return True
+    sock = client.socket()
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        return bool(selector.select(max(timeout, 0)))
@@ -0,0 +1,257 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+This module runs many sessions from a single event loop.
+Waiting for mail is asynchronous, so an idle mailbox costs a socket
+rather than a thread. Blocking IMAP commands and policies are run by
+a fixed pool of worker threads.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import imaplib
+import logging
+import tenacity
+import time
+from . import client as _client
+from . import metrics
+
+class Transport:
+    """Asynchronous access to a connected IMAP client.
+
+    Commands are run by the executor, while waiting for unsolicited
+    server responses is driven by the event loop.
+
+    :param client: connected client
+    :param executor: runs blocking commands
+    :type client: imapclient.IMAPClient
+    :type executor: concurrent.futures.Executor
+    """
+
+    def __init__(self, client, executor):
+        self.client = client
+        self.executor = executor
+
+    async def call(self, function, *args, **kwargs):
+        """Run a blocking function in the executor.
+
+        :param function: function to run
+        :type function: callable
+        :return: the function's result
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+            functools.partial(function, *args, **kwargs))
+
+    async def readable(self, timeout = None):
+        """Wait until the server sends data.
+
+        :param timeout: maximum wait in seconds
+        :type timeout: float
+        :return: True if data is available, False on timeout
+        :rtype: bool
+        """
+
+        if self.client.pending():
+            return True
+
+        sock = self.client.socket()
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = sock.fileno()
+        loop.add_reader(fd,
+            lambda: ready.done() or ready.set_result(True))
+        try:
+            return await asyncio.wait_for(ready,
+                None if timeout is None else max(timeout, 0))
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
+    async def wait_poll(self, monitor, poll):
+        """Poll the server until new messages exist.
+
+        :param monitor: watches the session's mailboxes
+        :param poll: polling interval in seconds
+        :type monitor: imaplar.client.Monitor
+        :type poll: float
+        """
+
+        while True:
+            if monitor.harvest():
+                return
+            response = await self.call(self.client.noop)
+            logging.debug("waiting: noop: {}".format(response))
+            if response:
+                if monitor.harvest():
+                    return
+            else:
+                raise _client.ConnectionError("connection dropped")
+
+            if monitor.check_due() and await self.call(monitor.check):
+                return
+            await asyncio.sleep(poll)
+
+    async def wait_idle(self, monitor, idle):
+        """Idle until new messages exist.
+
+        :param monitor: watches the session's mailboxes
+        :param idle: interval in seconds after which IDLE is renewed
+        :type monitor: imaplar.client.Monitor
+        :type idle: float
+        """
+
+        if monitor.harvest():
+            return
+        now = time.time()
+        alarm = now + idle
+        await self.call(self.client.idle)
+        while True:
+            if await self.readable(monitor.timeout(alarm) - now):
+                # a response may arrive in pieces, and reading the rest
+                # blocks
+                response = await self.call(self.client.idle_check, 0)
+                logging.debug("waiting: idle_check: {}".format(response))
+                if response:
+                    if monitor.update(response):
+                        await self.call(self.client.idle_done)
+                        monitor.harvest()
+                        return
+                else:
+                    raise _client.ConnectionError("connection dropped")
+
+            now = time.time()
+            if now >= alarm or monitor.check_due():
+                await self.call(self.client.idle_done)
+                monitor.harvest()
+                if monitor.check_due():
+                    await self.call(monitor.check)
+                if monitor.harvest():
+                    return
+                if now >= alarm:
+                    alarm = now + idle
+                await self.call(self.client.idle)
+
+    async def close(self):
+        """Log out and close the connection."""
+
+        await self.call(self.client.__exit__, None, None, None)
+
+class Engine:
+    """Runs sessions on an asyncio event loop.
+
+    :param workers: number of worker threads
+    :type workers: int
+    """
+
+    def __init__(self, workers = 16):
+        self.workers = workers
+        self.sessions = []
+
+    def add(self, session, min = 1, max = 300):
+        """Add a session to be run.
+
+        :param session: the session
+        :param min: minimum backoff in seconds
+        :param max: maximum backoff in seconds
+        :type session: imaplar.client.Session
+        :type min: int
+        :type max: int
+        """
+
+        self.sessions.append((session, min, max))
+
+    def run(self):
+        """Run every session until they are all aborted."""
+
+        asyncio.run(self._run())
+
+    async def _run(self):
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = self.workers,
+            thread_name_prefix = "imaplar-worker")
+        try:
+            await asyncio.gather(*(
+                self.run_forever(executor, session, min, max)
+                    for session, min, max in self.sessions))
+        finally:
+            executor.shutdown(wait = False)
+
+    @tenacity.retry(
+        before = tenacity.before_log(logging.getLogger(), logging.DEBUG))
+    async def run_forever(self, executor, session, min = 1, max = 300):
+        """Repeatedly connect to the server and monitor for unseen mail.
+
+        The backoff behaviour is the same as
+        :py:meth:`imaplar.client.Session.run_forever`.
+
+        :param executor: runs blocking commands
+        :param session: the session
+        :param min: minimum backoff in seconds
+        :param max: maximum backoff in seconds
+        :type executor: concurrent.futures.Executor
+        :type session: imaplar.client.Session
+        :type min: int
+        :type max: int
+        """
+
+        try:
+            logger = logging.getLogger()
+            backoff = tenacity.AsyncRetrying(
+                retry = tenacity.retry_unless_exception_type(
+                    imaplib.IMAP4.abort),
+                wait = tenacity.wait_exponential(min = min, max = max),
+                before = tenacity.before_log(logger, logging.DEBUG),
+                after = lambda state:
+                    metrics.reconnects.labels(session.host).inc())
+            await backoff(self.run_session, executor, session)
+        except:
+            logging.exception("session aborted")
+            session.close()
+            raise
+
+    async def run_session(self, executor, session):
+        """Connect to the server and monitor for unseen mail.
+
+        :param executor: runs blocking commands
+        :param session: the session
+        :type executor: concurrent.futures.Executor
+        :type session: imaplar.client.Session
+        """
+
+        loop = asyncio.get_running_loop()
+        client = await loop.run_in_executor(executor, session.connect)
+        transport = Transport(client, executor)
+        try:
+            # process unseen messages, then incoming messages
+            monitor = await transport.call(_client.Monitor, session, client)
+            if monitor.has_idle:
+                wait = functools.partial(transport.wait_idle, monitor,
+                    session.idle)
+            else:
+                wait = functools.partial(transport.wait_poll, monitor,
+                    session.poll)
+            while True:
+                await transport.call(monitor.scan)
+                if not monitor.changed:
+                    await wait()
+        finally:
+            await transport.close()
@@ -0,0 +1,254 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+This module keeps a local index of the addresses found in message
+envelopes, so that policies can ask whether an address has ever
+been seen without searching the server.
+"""
+
+import email.utils
+import sqlite3
+import threading
+from . import checkpoint
+
+ORIGINATOR = "originator"
+RECIPIENT = "recipient"
+
+class CorrespondentIndex:
+    """An index of envelope addresses, held in an SQLite database.
+
+    Each indexed mailbox is updated incrementally from a UID checkpoint.
+    If the mailbox's UIDVALIDITY changes, its entries are discarded and
+    it is indexed again from scratch.
+
+    :param path: database path
+    :param batch_size: number of envelopes fetched at once
+    :type path: str
+    :type batch_size: int
+    """
+
+    def __init__(self, path, batch_size = 500):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS correspondents ("
+                "server TEXT NOT NULL, "
+                "role TEXT NOT NULL, "
+                "address TEXT NOT NULL, "
+                "mailbox TEXT NOT NULL, "
+                "PRIMARY KEY (server, role, address, mailbox)) "
+                "WITHOUT ROWID")
+            self._db.execute("CREATE TABLE IF NOT EXISTS indexed ("
+                "server TEXT NOT NULL, "
+                "mailbox TEXT NOT NULL, "
+                "uidvalidity INTEGER NOT NULL, "
+                "uid INTEGER NOT NULL, "
+                "PRIMARY KEY (server, mailbox))")
+
+    def checkpoint(self, server, mailbox):
+        """Get how far a mailbox has been indexed.
+
+        :param server: server name
+        :param mailbox: mailbox name
+        :type server: str
+        :type mailbox: str
+        :return: the checkpoint, or None
+        :rtype: imaplar.checkpoint.Checkpoint
+        """
+
+        with self._lock:
+            row = self._db.execute("SELECT uidvalidity, uid "
+                "FROM indexed WHERE server = ? AND mailbox = ?",
+                (server, mailbox)).fetchone()
+        return checkpoint.Checkpoint(*row) if row else None
+
+    def update(self, client, server, mailbox):
+        """Index the envelopes of new messages in a mailbox.
+
+        :param client: imap client
+        :param server: server name
+        :param mailbox: mailbox name
+        :type client: imapclient.IMAPClient
+        :type server: str
+        :type mailbox: str
+        :return: the number of messages indexed
+        :rtype: int
+        """
+
+        if getattr(client, "selected", None) == mailbox:
+            # STATUS isn't sent for the selected mailbox
+            # (RFC 3501 6.3.10), which is examined again instead
+            status = client.select_folder(mailbox, readonly = True,
+                refresh = True)
+        else:
+            status = client.folder_status(mailbox,
+                [b"UIDVALIDITY", b"UIDNEXT"])
+        uidvalidity = status[b"UIDVALIDITY"]
+        uidnext = status[b"UIDNEXT"]
+
+        saved = self.checkpoint(server, mailbox)
+        if saved and saved.uidvalidity == uidvalidity:
+            last = saved.uid
+        else:
+            # rebuild from scratch
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM correspondents "
+                    "WHERE server = ? AND mailbox = ?", (server, mailbox))
+            last = 0
+        if uidnext <= last + 1:
+            return 0
+
+        client.select_folder(mailbox, readonly = True)
+        messages = [m for m in client.search(
+            ["UID", "{}:*".format(last + 1)]) if m > last]
+        messages.sort()
+        for i in range(0, len(messages), self.batch_size):
+            batch = messages[i:i + self.batch_size]
+            response = client.fetch(batch, ["ENVELOPE"])
+            rows = set()
+            for data in response.values():
+                envelope = data.get(b"ENVELOPE")
+                if envelope:
+                    rows.update(_rows(server, mailbox, envelope))
+            self._commit(server, mailbox, rows,
+                checkpoint.Checkpoint(uidvalidity, batch[-1]))
+        self._commit(server, mailbox, (),
+            checkpoint.Checkpoint(uidvalidity,
+                max([uidnext - 1] + messages)))
+        return len(messages)
+
+    def contains(self, server, role, address, mailboxes = None):
+        """Has an address been seen?
+
+        :param server: server name
+        :param role: ORIGINATOR or RECIPIENT
+        :param address: the address
+        :param mailboxes: restrict to these mailboxes, or None for all
+        :type server: str
+        :type role: str
+        :type address: str or imapclient.response_types.Address
+        :type mailboxes: iterable of str
+        :rtype: bool
+        """
+
+        address = normalise(address)
+        if not address:
+            return False
+
+        with self._lock:
+            if mailboxes is None:
+                row = self._db.execute("SELECT 1 FROM correspondents "
+                    "WHERE server = ? AND role = ? AND address = ? LIMIT 1",
+                    (server, role, address)).fetchone()
+            else:
+                mailboxes = list(mailboxes)
+                row = self._db.execute("SELECT 1 FROM correspondents "
+                    "WHERE server = ? AND role = ? AND address = ? "
+                    "AND mailbox IN ({}) LIMIT 1".format(
+                        ", ".join("?" * len(mailboxes))),
+                    [server, role, address] + mailboxes).fetchone()
+        return row is not None
+
+    def close(self):
+        """Close the database."""
+
+        with self._lock:
+            self._db.close()
+
+    def _commit(self, server, mailbox, rows, checkpoint):
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO correspondents "
+                "(server, role, address, mailbox) VALUES (?, ?, ?, ?)",
+                rows)
+            self._db.execute("INSERT OR REPLACE INTO indexed "
+                "(server, mailbox, uidvalidity, uid) VALUES (?, ?, ?, ?)",
+                (server, mailbox, checkpoint.uidvalidity, checkpoint.uid))
+
+class Correspondents:
+    """A policy's view of a correspondent index for one server.
+
+    :param index: the index
+    :param server: server name
+    :param mailboxes: restrict lookups to these mailboxes,
+        or None for all
+    :type index: CorrespondentIndex
+    :type server: str
+    :type mailboxes: iterable of str
+    """
+
+    def __init__(self, index, server, mailboxes = None):
+        self.index = index
+        self.server = server
+        self.mailboxes = mailboxes
+
+    def originator(self, address):
+        """Has this address sent an indexed message?
+
+        :param address: the address
+        :type address: str or imapclient.response_types.Address
+        :rtype: bool
+        """
+
+        return self.index.contains(self.server, ORIGINATOR, address,
+            self.mailboxes)
+
+    def recipient(self, address):
+        """Has this address received an indexed message?
+
+        :param address: the address
+        :type address: str or imapclient.response_types.Address
+        :rtype: bool
+        """
+
+        return self.index.contains(self.server, RECIPIENT, address,
+            self.mailboxes)
+
+def normalise(address):
+    """Reduce an address to a lower case "mailbox@host" string.
+
+    :param address: the address
+    :type address: str or imapclient.response_types.Address
+    :return: the normalised address, or None for a group marker
+    :rtype: str
+    """
+
+    if hasattr(address, "mailbox") and hasattr(address, "host"):
+        if address.mailbox is None or address.host is None:
+            return None
+        return "{}@{}".format(_text(address.mailbox),
+            _text(address.host)).lower()
+    return email.utils.parseaddr(_text(address))[1].lower() or None
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+def _rows(server, mailbox, envelope):
+    for role, fields in (
+            (ORIGINATOR, (envelope.from_, envelope.sender,
+                envelope.reply_to)),
+            (RECIPIENT, (envelope.to, envelope.cc, envelope.bcc))):
+        for field in fields:
+            for address in field or ():
+                address = normalise(address)
+                if address:
+                    yield (server, role, address, mailbox)
@@ -0,0 +1,301 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+This module collects metrics, and serves them over HTTP in the
+Prometheus text format.
+"""
+
+import bisect
+import http.server
+import logging
+import math
+import threading
+
+class Registry:
+    """A collection of metrics."""
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric.
+
+        :param metric: the metric
+        :type metric: Counter, Gauge or Histogram
+        :return: the metric
+        """
+
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Format every metric in the Prometheus text format.
+
+        :rtype: str
+        """
+
+        with self._lock:
+            metrics = list(self.metrics)
+        return "".join(m.render() for m in metrics)
+
+registry = Registry()
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels = (), registry = registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Get the metric for a combination of label values.
+
+        :param values: one value for each label name
+        :return: the labelled metric
+        """
+
+        key = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._child()
+            return child
+
+    def render(self):
+        lines = ["# HELP {} {}\n".format(self.name, self.help),
+            "# TYPE {} {}\n".format(self.name, self.kind)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            labels = list(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                lines.append("{}{}{} {}\n".format(self.name, suffix,
+                    _labels(labels + extra), _number(value)))
+        return "".join(lines)
+
+class Counter(_Metric):
+    """A count that only increases.
+
+    :param name: metric name
+    :param help: description
+    :param labels: label names
+    :param registry: the registry to add the metric to, if any
+    :type name: str
+    :type help: str
+    :type labels: sequence of strings
+    :type registry: Registry
+    """
+
+    kind = "counter"
+
+    def _child(self):
+        return _Value()
+
+class Gauge(_Metric):
+    """A value that may go up and down, or be computed when read.
+
+    :param name: metric name
+    :param help: description
+    :param labels: label names
+    :param registry: the registry to add the metric to, if any
+    :type name: str
+    :type help: str
+    :type labels: sequence of strings
+    :type registry: Registry
+    """
+
+    kind = "gauge"
+
+    def _child(self):
+        return _Value()
+
+class Histogram(_Metric):
+    """A distribution of observed values.
+
+    :param name: metric name
+    :param help: description
+    :param labels: label names
+    :param buckets: upper bounds of the buckets
+    :param registry: the registry to add the metric to, if any
+    :type name: str
+    :type help: str
+    :type labels: sequence of strings
+    :type buckets: sequence of floats
+    :type registry: Registry
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (),
+            buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                5, 10), registry = registry):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _child(self):
+        return _Distribution(self.buckets)
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function):
+        # the value is computed whenever the metrics are rendered
+        self.function = function
+
+    def samples(self):
+        if self.function:
+            try:
+                return [("", [], self.function())]
+            except Exception:
+                logging.exception("metric function failed")
+                return []
+        return [("", [], self.value)]
+
+class _Distribution:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value, count = 1):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += count
+            self.sum += value * count
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(("_bucket", [("le", _number(bound))],
+                cumulative))
+        samples.append(("_sum", [], total))
+        samples.append(("_count", [], cumulative))
+        return samples
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(k, str(v)
+        .replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+            for k, v in labels) + "}"
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+# imaplar's own metrics
+delay = Histogram("imaplar_delivery_delay_seconds",
+    "Time from new mail being noticed until its policy has completed.",
+    ("server", "mailbox"),
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+commands = Histogram("imaplar_command_duration_seconds",
+    "IMAP command latency.", ("server", "command"))
+processed = Counter("imaplar_messages_processed_total",
+    "Messages processed by a policy.", ("server", "mailbox"))
+failed = Counter("imaplar_messages_failed_total",
+    "Messages whose policy raised an exception or could not be run.",
+    ("server", "mailbox"))
+reconnects = Counter("imaplar_reconnects_total",
+    "Session reconnections after a failure.", ("server",))
+queue_depth = Gauge("imaplar_queue_depth",
+    "Jobs waiting in a pipeline queue.", ("server",))
+connections = Gauge("imaplar_connections",
+    "Open IMAP connections.", ("server",))
+sent = Counter("imaplar_bytes_sent_total",
+    "Bytes sent to an IMAP server.", ("server",))
+received = Counter("imaplar_bytes_received_total",
+    "Bytes received from an IMAP server.", ("server",))
+policy_duration = Histogram("imaplar_policy_duration_seconds",
+    "Wall time of a policy run.", ("policy",),
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+policy_messages = Counter("imaplar_policy_messages_total",
+    "Messages given to a policy.", ("policy",))
+policy_cpu = Counter("imaplar_policy_cpu_seconds_total",
+    "CPU time spent running a policy.", ("policy",))
+policy_commands = Counter("imaplar_policy_commands_total",
+    "IMAP commands sent by a policy.", ("policy",))
+policy_bytes = Counter("imaplar_policy_bytes_total",
+    "Bytes transferred by a policy's IMAP commands.",
+    ("policy", "direction"))
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format, *args)
+
+def serve(host = "127.0.0.1", port = 9464, registry = registry):
+    """Serve metrics over HTTP from a background thread.
+
+    :param host: listening address
+    :param port: listening port
+    :param registry: the metrics to serve
+    :type host: str
+    :type port: int
+    :type registry: Registry
+    :return: the running server, stopped by calling its shutdown method
+    :rtype: http.server.ThreadingHTTPServer
+    """
+
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target = server.serve_forever,
+        name = "imaplar-metrics", daemon = True).start()
+    logging.info("serving metrics on {}:{}".format(*server.server_address))
+    return server
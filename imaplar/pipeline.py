@@ -0,0 +1,237 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+This module separates finding new messages from processing them.
+The connection that watches a server only searches for new messages,
+and queues them in batches for a pool of workers, each with its own
+connection, to process.
+"""
+
+import collections
+import imaplib
+import logging
+import queue
+import socket
+import threading
+from . import metrics
+
+class Job:
+    """A unit of work for a mailbox.
+
+    :param mailbox: mailbox name
+    :param uidvalidity: the mailbox's UIDVALIDITY
+    :param messages: ids of the messages processed by the job
+    :param last: the highest message id the job accounts for
+    :param action: called with a connected client to do the work,
+        returning the checkpoint to record on completion (or None)
+    :param arrived: when the messages were noticed, as a
+        time.monotonic() value, or None
+    :type mailbox: str
+    :type uidvalidity: int
+    :type messages: sequence of ints
+    :type last: int
+    :type action: callable
+    :type arrived: float
+    """
+
+    def __init__(self, mailbox, uidvalidity, messages, last, action,
+            arrived = None):
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.messages = messages
+        self.last = last
+        self.action = action
+        self.arrived = arrived
+        self.done = False
+        self.result = None
+        self.progress = None
+
+class Pipeline:
+    """A bounded queue of jobs, processed by a pool of workers.
+
+    Jobs for a mailbox may complete in any order, but their checkpoints
+    are recorded in the order in which they were submitted. If a job
+    fails, no further checkpoints are recorded for the mailbox until
+    its outstanding jobs are finished, so that the unrecorded messages
+    are found and processed again.
+
+    :param session: the session whose messages are processed
+    :param workers: number of workers, each with its own connection
+    :param queue_size: number of jobs queued before submission blocks
+    :param ordered: process each mailbox's jobs one at a time, in order
+    :param retries: number of times a job is retried on a new connection
+    :type session: imaplar.client.Session
+    :type workers: int
+    :type queue_size: int
+    :type ordered: bool
+    :type retries: int
+    """
+
+    def __init__(self, session, workers = 4, queue_size = 16,
+            ordered = False, retries = 2):
+        self.session = session
+        self.workers = workers
+        self.ordered = ordered
+        self.retries = retries
+        self._queues = [queue.Queue(queue_size)
+            for i in range(workers if ordered else 1)]
+        self._threads = []
+        self._progress = {}
+        self._lock = threading.Lock()
+        metrics.queue_depth.labels(session.host).set_function(self.depth)
+
+    def submit(self, job):
+        """Queue a job, blocking while the queue is full.
+
+        :param job: the job
+        :type job: Job
+        """
+
+        self._start()
+        with self._lock:
+            progress = self._progress.get(job.mailbox)
+            if progress is None or progress.uidvalidity != job.uidvalidity:
+                progress = self._progress[job.mailbox] =\
+                    _Progress(job.uidvalidity)
+            progress.jobs.append(job)
+            job.progress = progress
+        self._queue(job.mailbox).put(job)
+
+    def in_flight(self, mailbox, uidvalidity):
+        """Describe a mailbox's outstanding jobs.
+
+        :param mailbox: mailbox name
+        :param uidvalidity: the mailbox's UIDVALIDITY
+        :type mailbox: str
+        :type uidvalidity: int
+        :return: the highest message id accounted for, and the set of
+            message ids being processed
+        :rtype: tuple
+        """
+
+        with self._lock:
+            progress = self._progress.get(mailbox)
+            if progress is None or progress.uidvalidity != uidvalidity:
+                return 0, set()
+            return max(j.last for j in progress.jobs),\
+                set(m for j in progress.jobs for m in j.messages)
+
+    def depth(self):
+        """Count the jobs waiting to be started.
+
+        :rtype: int
+        """
+
+        return sum(q.qsize() for q in self._queues)
+
+    def join(self):
+        """Wait until every queued job is finished."""
+
+        for q in self._queues:
+            q.join()
+
+    def stop(self):
+        """Stop the workers once the queued jobs are finished."""
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for i, thread in enumerate(threads):
+            self._queues[i % len(self._queues)].put(None)
+
+    def _queue(self, mailbox):
+        if len(self._queues) == 1:
+            return self._queues[0]
+        return self._queues[hash(mailbox) % len(self._queues)]
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target = self._work,
+                    args = (self._queues[i % len(self._queues)],),
+                    name = "imaplar-pipeline-{}".format(i), daemon = True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self, jobs):
+        client = None
+        while True:
+            job = jobs.get()
+            try:
+                if job is None:
+                    break
+                client, ok = self._run(client, job)
+                self._complete(job, ok)
+            finally:
+                jobs.task_done()
+
+        if client:
+            try:
+                client.logout()
+            except Exception:
+                pass
+
+    def _run(self, client, job):
+        # workers do not borrow from the session's connection pool,
+        # which is left to the policies they run
+        for attempt in range(self.retries + 1):
+            try:
+                if client is None:
+                    client = self.session.connect()
+                job.result = job.action(client)
+                return client, True
+            except (imaplib.IMAP4.abort, socket.error) as e:
+                logging.warning("{}({})/{}: worker connection lost: {}"
+                    .format(self.session.host, self.session.port,
+                        job.mailbox, e))
+                if client:
+                    try:
+                        client.shutdown()
+                    except Exception:
+                        pass
+                client = None
+            except Exception as e:
+                logging.exception("{}({})/{}: job failed".format(
+                    self.session.host, self.session.port, job.mailbox))
+                break
+        return client, False
+
+    def _complete(self, job, ok):
+        self.session.completed(job, ok)
+        with self._lock:
+            progress = job.progress
+            job.done = True
+            if not ok:
+                progress.failed = True
+
+            # record checkpoints in submission order
+            while progress.jobs and progress.jobs[0].done:
+                finished = progress.jobs.popleft()
+                if finished.result and not progress.failed:
+                    self.session.commit(finished.mailbox, finished.result)
+            if not progress.jobs and\
+                    self._progress.get(job.mailbox) is progress:
+                del self._progress[job.mailbox]
+
+class _Progress:
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.jobs = collections.deque()
+        self.failed = False
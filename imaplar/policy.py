@@ -20,55 +20,175 @@ This module provides convenience classes and methods to help
 make writing policies easier.
 """
 
-import email.utils
+import binascii
+import collections
+import dataclasses
+import email
+import email.header
 import functools
+import imapclient
+import imapclient.imap_utf7
+import imapclient.response_parser
+import imapclient.response_types
 import itertools
 import logging
+import re
+import tempfile
+import types
+from . import cache as _cache
+from . import index as _index
+from . import pool as _pool
 
 class Originators(set):
     """Envelope originator addresses.
 
+    Group syntax markers are omitted.
+
     :param envelope: message envelope
     :type envelope: imapclient.response_types.Envelope
     """
 
     def __init__(self, envelope):
-        super().__init__(itertools.chain(
+        super().__init__(_addresses(
             envelope.from_, envelope.sender, envelope.reply_to))
 
 class Recipients(set):
     """Envelope recipient addresses.
 
+    Group syntax markers are omitted.
+
     :param envelope: message envelope
     :type envelope: imapclient.response_types.Envelope
     """
 
     def __init__(self, envelope):
-        super().__init__(itertools.chain(
+        super().__init__(_addresses(
             envelope.to, envelope.cc, envelope.bcc))
 
+@dataclasses.dataclass(unsafe_hash = True)
+class _Address(imapclient.response_types.Address):
+    """A hashable address, so that addresses can be collected in sets."""
+
+def _addresses(*fields):
+    return (_Address(a.name, a.route, a.mailbox, a.host)
+        for a in itertools.chain.from_iterable(f or () for f in fields)
+        if a.mailbox is not None and a.host is not None)
+
 class Query(list):
     """A list of IMAP search criteria.
 
+    Queries ORed together are flattened into a single balanced tree,
+    without duplicate terms. If a query is longer than ``max_length``
+    when encoded, it is split into several searches and their results
+    are merged; a negated part is never split. If the server supports
+    ESEARCH, results are returned as compact sequence sets, and with
+    SEARCHRES, the results of split searches are merged by the server.
+
+    If a cache is set (for all queries, as a class attribute),
+    results are reused while the searched mailbox is unchanged.
+
     :param criteria: search criteria
     :type criteria: iterable of strings
     """
 
+    cache = None
+    max_length = 8000
+
     def __call__(self, client, *mailboxes):
         """Generate message ids by executing query.
 
-        :param client: imap client
+        The mailboxes are searched as described for :meth:`search`.
+
+        :param client: imap client or connection pool
         :param mailboxes: mailbox names
-        :type client: imapclient.IMAPClient
+        :type client: imapclient.IMAPClient or
+            imaplar.pool.ConnectionPool
         :type mailboxes: strings
         :return: message ids
         :rtype: generator of ints
         """
 
-        for mailbox in mailboxes:
+        for messages in self.search(client, *mailboxes).values():
+            yield from messages
+
+    def search(self, client, *mailboxes):
+        """Execute query, grouping the results by mailbox.
+
+        If the server supports MULTISEARCH, several mailboxes are
+        searched with a single command, without selecting them.
+        Otherwise, given a connection pool rather than a client,
+        the mailboxes are searched in parallel, each with a pooled
+        connection.
+
+        :param client: imap client or connection pool
+        :param mailboxes: mailbox names
+        :type client: imapclient.IMAPClient or
+            imaplar.pool.ConnectionPool
+        :type mailboxes: strings
+        :return: a mapping of mailbox names to message ids,
+            in the order the mailboxes were given
+        :rtype: dict
+        """
+
+        mailboxes = list(dict.fromkeys(mailboxes))
+        if len(mailboxes) > 1:
+            results = _multisearch(client, self, mailboxes)
+            if results is not None:
+                return results
+
+        if isinstance(client, _pool.ConnectionPool):
+            return dict(zip(mailboxes, client.map(self._search, mailboxes)))
+        return dict((m, self._search(client, m)) for m in mailboxes)
+
+    def _search(self, client, mailbox):
+        if self.cache is None:
             client.select_folder(mailbox, readonly = True)
             logging.debug("query {}".format(str(self)))
-            yield from client.search(self)
+            return self._execute(client)
+
+        key = _cache.key(client.host, mailbox, self)
+        state = mailbox_state(client, mailbox)
+        messages = self.cache.get(key, state)
+        if messages is None:
+            client.select_folder(mailbox, readonly = True)
+            logging.debug("query {}".format(str(self)))
+            messages = self._execute(client)
+            self.cache.put(key, state, messages)
+        else:
+            logging.debug("query {} (cached)".format(str(self)))
+        return messages
+
+    def _chunks(self):
+        chunks = [c if isinstance(c, list) else [c]
+            for c in _split(self, self.max_length)]
+        if len(chunks) > 1:
+            logging.debug("query split into {} searches".format(len(chunks)))
+        return chunks
+
+    def _execute(self, client):
+        chunks = self._chunks()
+        capabilities = client.capabilities()
+        if b"ESEARCH" not in capabilities:
+            if len(chunks) == 1:
+                return client.search(chunks[0])
+            messages = set()
+            for chunk in chunks:
+                messages.update(client.search(chunk))
+            return sorted(messages)
+
+        if b"SEARCHRES" in capabilities and len(chunks) > 1:
+            # accumulate the union as the saved search result,
+            # so that only the final result is returned
+            _esearch(client, "SAVE", chunks[0])
+            for chunk in chunks[1:-1]:
+                _esearch(client, "SAVE", ["OR", ["UID", "$"], chunk])
+            return sorted(_esearch(client, "ALL",
+                ["OR", ["UID", "$"], chunks[-1]]))
+
+        messages = set()
+        for chunk in chunks:
+            messages.update(_esearch(client, "ALL", chunk))
+        return sorted(messages)
 
     def __and__(self, query):
         """AND queries together.
@@ -90,16 +210,16 @@ class Query(list):
         :rtype: Query
         """
 
-        return Query(["OR", self, query])
+        return _any(_disjuncts(self) + _disjuncts(query))
 
-    def __not__(self):
+    def __invert__(self):
         """NOT this query.
 
         :return: a new query
         :rtype: Query
         """
 
-        return Query(["NOT", query])
+        return Query(["NOT", self])
 
 class ToQuery(Query):
     """A query for "To" addresses.
@@ -109,9 +229,7 @@ class ToQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(functools.reduce(lambda x, y: x | y,
-            (Query(["TO", email.utils.parseaddr(str(a))[1]])
-                for a in addresses)))
+        super().__init__(_any(_address_queries(["TO"], addresses)))
 
 class CcQuery(Query):
     """A query for "Cc" addresses.
@@ -121,9 +239,7 @@ class CcQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(functools.reduce(lambda x, y: x | y,
-            (Query(["CC", email.utils.parseaddr(str(a))[1]])
-                for a in addresses)))
+        super().__init__(_any(_address_queries(["CC"], addresses)))
 
 class BccQuery(Query):
     """A query for "Bcc" addresses.
@@ -133,9 +249,7 @@ class BccQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(functools.reduce(lambda x, y: x | y,
-            (Query(["BCC", email.utils.parseaddr(str(a))[1]])
-                for a in addresses)))
+        super().__init__(_any(_address_queries(["BCC"], addresses)))
 
 class FromQuery(Query):
     """A query for "From" addresses.
@@ -145,9 +259,7 @@ class FromQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(functools.reduce(lambda x, y: x | y,
-            (Query(["FROM", email.utils.parseaddr(str(a))[1]])
-                for a in addresses)))
+        super().__init__(_any(_address_queries(["FROM"], addresses)))
 
 class SenderQuery(Query):
     """A query for "Sender" addresses.
@@ -157,9 +269,8 @@ class SenderQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(functools.reduce(lambda x, y: x | y,
-            (Query(["HEADER", "Sender", email.utils.parseaddr(str(a))[1]])
-                for a in addresses)))
+        super().__init__(_any(
+            _address_queries(["HEADER", "Sender"], addresses)))
 
 class ReplyToQuery(Query):
     """A query for "Reply-To" addresses.
@@ -169,9 +280,8 @@ class ReplyToQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(functools.reduce(lambda x, y: x | y,
-            (Query(["HEADER", "Reply-To", email.utils.parseaddr(str(a))[1]])
-                for a in addresses)))
+        super().__init__(_any(
+            _address_queries(["HEADER", "Reply-To"], addresses)))
 
 class OriginatorQuery(Query):
     """A query for "From", "Sender" and "Reply-To" addresses.
@@ -181,9 +291,10 @@ class OriginatorQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(FromQuery(addresses)
-            | SenderQuery(addresses)
-            | ReplyToQuery(addresses))
+        addresses = list(addresses)
+        super().__init__(_any(_address_queries(["FROM"], addresses)
+            + _address_queries(["HEADER", "Sender"], addresses)
+            + _address_queries(["HEADER", "Reply-To"], addresses)))
 
 class RecipientQuery(Query):
     """A query for "To", "Cc" and "Bcc" addresses.
@@ -193,17 +304,194 @@ class RecipientQuery(Query):
     """
 
     def __init__(self, addresses):
-        super().__init__(ToQuery(addresses)
-            | CcQuery(addresses)
-            | BccQuery(addresses))
+        addresses = list(addresses)
+        super().__init__(_any(_address_queries(["TO"], addresses)
+            + _address_queries(["CC"], addresses)
+            + _address_queries(["BCC"], addresses)))
+
+def _address_queries(criteria, addresses):
+    # one query per distinct canonical address, in order
+    canonical = dict.fromkeys(a for a in map(_index.normalise, addresses)
+        if a)
+    return [Query(criteria + [a]) for a in canonical]
+
+def _any(queries):
+    # OR queries together as a balanced tree, without duplicates
+    unique = {}
+    for query in queries:
+        unique.setdefault(_cache._normalise(query), query)
+    queries = list(unique.values())
+    if not queries:
+        return Query(["NOT", "ALL"])
+    return _balance(queries)
+
+def _balance(queries):
+    if len(queries) == 1:
+        return queries[0]
+    middle = len(queries) // 2
+    return Query(["OR", _balance(queries[:middle]),
+        _balance(queries[middle:])])
+
+def _is_or(criteria):
+    return isinstance(criteria, list) and len(criteria) == 3\
+        and isinstance(criteria[0], str) and criteria[0].upper() == "OR"
+
+def _disjuncts(criteria):
+    if _is_or(criteria):
+        return _disjuncts(criteria[1]) + _disjuncts(criteria[2])
+    return [criteria]
 
+def _length(criteria):
+    if not isinstance(criteria, list):
+        criteria = [criteria]
+    return len(b" ".join(
+        imapclient.imapclient._normalise_search_criteria(criteria)))
+
+def _split(criteria, limit):
+    """Split criteria into parts whose results may be merged.
+
+    Each part is no longer than limit when encoded, if that is possible.
+    Disjunctions are split into their operands, and conjunctions are
+    distributed over their longest disjunction. A disjunction that is
+    the operand of a NOT or OR key is not split, since it may be
+    negated, and the union of its parts' results would not be the
+    result of the whole.
+    """
+
+    length = _length(criteria)
+    if length <= limit:
+        yield criteria
+    elif _is_or(criteria):
+        yield from _split(criteria[1], limit)
+        yield from _split(criteria[2], limit)
+    else:
+        disjunctions = [(_length(c), i) for i, c in enumerate(criteria)
+            if _is_or(c) and not _is_operand(criteria, i)]\
+            if isinstance(criteria, list) else []
+        if not disjunctions:
+            yield criteria
+            return
+        longest, i = max(disjunctions)
+        remaining = limit - (length - longest)
+        if remaining <= 0:
+            yield criteria
+            return
+        for part in _split(criteria[i], remaining):
+            yield criteria[:i] + [part] + criteria[i + 1:]
+
+def _is_operand(criteria, i):
+    # is criteria[i] an operand of a NOT or OR key in criteria?
+    def key(j, *names):
+        return j >= 0 and isinstance(criteria[j], str)\
+            and criteria[j].upper() in names
+    return key(i - 1, "NOT", "OR") or key(i - 2, "OR")
+
+def _esearch(client, returns, criteria):
+    args = [b"RETURN", "({})".format(returns).encode()]
+    args.extend(imapclient.imapclient._normalise_search_criteria(criteria))
+    data = client._raw_command_untagged(b"SEARCH", args,
+        response_name = "ESEARCH")
+    messages = []
+    for line in data:
+        if not line:
+            continue
+        tokens = line.upper().split()
+        if b"ALL" in tokens:
+            messages.extend(_expand(tokens[tokens.index(b"ALL") + 1]))
+    return messages
+
+def pooled(function):
+    """Let a helper be given a connection pool instead of a client.
+
+    The helper then runs with a connection borrowed from the pool,
+    leaving the session's own connection undisturbed.
+
+    :param function: a helper taking a client as its first argument
+    :type function: callable
+    :return: the wrapped helper
+    :rtype: callable
+    """
+
+    @functools.wraps(function)
+    def wrapper(client, *args, **kwargs):
+        if isinstance(client, _pool.ConnectionPool):
+            with client.connection() as connection:
+                return function(connection, *args, **kwargs)
+        return function(client, *args, **kwargs)
+    return wrapper
+
+@pooled
+def _multisearch(client, query, mailboxes):
+    # search several mailboxes at once, or return None if unsupported
+    if not client.has_capability("MULTISEARCH"):
+        return None
+
+    results = {}
+    states = {}
+    if query.cache is not None:
+        for mailbox in mailboxes:
+            states[mailbox] = mailbox_state(client, mailbox)
+            results[mailbox] = query.cache.get(
+                _cache.key(client.host, mailbox, query), states[mailbox])
+    pending = [m for m in mailboxes if results.get(m) is None]
+    if pending:
+        logging.debug("query {} in {}".format(str(query),
+            ", ".join(pending)))
+        found = dict((m, set()) for m in pending)
+        for chunk in query._chunks():
+            for mailbox, messages in _esearch_in(client, pending,
+                    chunk).items():
+                found[mailbox].update(messages)
+        for mailbox in pending:
+            results[mailbox] = sorted(found[mailbox])
+            if query.cache is not None:
+                query.cache.put(_cache.key(client.host, mailbox, query),
+                    states[mailbox], results[mailbox])
+    return dict((m, results[m]) for m in mailboxes)
+
+def _esearch_in(client, mailboxes, criteria):
+    names = dict((_mailbox_key(m), m) for m in mailboxes)
+    args = [b"IN", b"(mailboxes (" + b" ".join(
+        client._normalise_folder(m) for m in mailboxes) + b"))",
+        b"RETURN", b"(ALL)"]
+    args.extend(imapclient.imapclient._normalise_search_criteria(criteria))
+    data = client._raw_command_untagged(b"ESEARCH", args, uid = False)
+
+    # responses are correlated with mailboxes, and carry UIDs
+    results = dict((m, []) for m in mailboxes)
+    for line in data:
+        if not line:
+            continue
+        response = imapclient.response_parser.parse_response([line])
+        correlators = dict(zip(response[0][::2], response[0][1::2]))
+        name = correlators.get(b"MAILBOX")
+        if name is None:
+            continue
+        name = imapclient.imap_utf7.decode(name) if client.folder_encode\
+            else name.decode("utf-8", "replace")
+        mailbox = names.get(_mailbox_key(name))
+        if mailbox is None:
+            continue
+        items = response[1:]
+        for key, value in zip(items, items[1:]):
+            if isinstance(key, bytes) and key.upper() == b"ALL":
+                results[mailbox].extend(_expand(value
+                    if isinstance(value, bytes) else str(value).encode()))
+    return results
+
+def _mailbox_key(mailbox):
+    # INBOX is case-insensitive
+    return "INBOX" if mailbox.upper() == "INBOX" else mailbox
+
+@pooled
 def fetch_envelope(client, mailbox, message):
     """Fetch the envelope of a message.
 
-    :param client: imap client
+    :param client: imap client or connection pool
     :param mailbox: mailbox name
     :param message: message id
-    :type client: imapclient.IMAPClient
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
     :type mailbox: string
     :type message: int
     :return: an envelope
@@ -214,6 +502,590 @@ def fetch_envelope(client, mailbox, message):
     response = client.fetch([message], ["ENVELOPE"])
     return response[message][b"ENVELOPE"]
 
+@pooled
+def fetch_envelopes(client, mailbox, messages):
+    """Fetch the envelopes of several messages with a single FETCH.
+
+    :param client: imap client or connection pool
+    :param mailbox: mailbox name
+    :param messages: message ids
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :type messages: sequence of ints
+    :return: a mapping of message ids to envelopes
+    :rtype: dict
+    """
+
+    if not messages:
+        return {}
+    client.select_folder(mailbox, readonly = True)
+    response = client.fetch(messages, ["ENVELOPE"])
+    return dict((m, r[b"ENVELOPE"]) for m, r in response.items())
+
+# shared by messages with nothing fetched yet
+_UNFETCHED = types.MappingProxyType({})
+
+class Message:
+    """A message whose attributes are fetched when first used.
+
+    Each attribute is fetched at most once, and is then kept.
+    The summary attributes (envelope, flags, size and internal date)
+    are fetched together whenever one of them is needed.
+    Use :meth:`fetch`, or :func:`fetch_messages` for many messages,
+    to fetch any other attributes that will be needed with a single
+    FETCH.
+
+    :param client: imap client or connection pool
+    :param mailbox: mailbox name
+    :param uid: message id
+    :param data: attributes already fetched, such as a prefetched entry
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :type uid: int
+    :type data: dict
+    """
+
+    __slots__ = ("client", "mailbox", "uid", "_data")
+
+    SUMMARY = ("ENVELOPE", "FLAGS", "RFC822.SIZE", "INTERNALDATE")
+
+    def __init__(self, client, mailbox, uid, data = None):
+        self.client = client
+        self.mailbox = mailbox
+        self.uid = uid
+        self._data = data if data is not None else _UNFETCHED
+
+    def __repr__(self):
+        return "Message({!r}, {})".format(self.mailbox, self.uid)
+
+    def fetch(self, *items):
+        """Fetch attributes that have not already been fetched.
+
+        :param items: FETCH attributes, such as "BODY.PEEK[1]"
+        :type items: strings
+        :return: this message
+        :rtype: Message
+        """
+
+        fetch_messages([self], *items)
+        return self
+
+    def get(self, item):
+        """Get an attribute, fetching it if necessary.
+
+        :param item: a FETCH attribute
+        :type item: string
+        :return: the attribute's value, or None if the message is gone
+        """
+
+        key = _response_key(item)
+        if key not in self._data:
+            self.fetch(*(self.SUMMARY if item.upper() in self.SUMMARY
+                else (item,)))
+        return self._data.get(key)
+
+    @property
+    def envelope(self):
+        """The message envelope.
+
+        :rtype: imapclient.response_types.Envelope
+        """
+
+        return self.get("ENVELOPE")
+
+    @property
+    def flags(self):
+        """The message flags, as they were when fetched.
+
+        :rtype: tuple of bytes
+        """
+
+        return self.get("FLAGS")
+
+    @property
+    def size(self):
+        """The message size in bytes.
+
+        :rtype: int
+        """
+
+        return self.get("RFC822.SIZE")
+
+    @property
+    def internaldate(self):
+        """The date the message was received by the server.
+
+        :rtype: datetime.datetime
+        """
+
+        return self.get("INTERNALDATE")
+
+    @property
+    def bodystructure(self):
+        """The MIME structure of the message.
+
+        :rtype: imapclient.response_types.BodyData
+        """
+
+        return self.get("BODYSTRUCTURE")
+
+    @property
+    def headers(self):
+        """The complete message header.
+
+        :rtype: email.message.Message
+        """
+
+        key = _response_key("BODY.PEEK[HEADER]")
+        header = self.get("BODY.PEEK[HEADER]")
+        if isinstance(header, bytes):
+            header = email.message_from_bytes(header)
+            self._update({key: header})
+        return header
+
+    def part(self, section):
+        """Get a body part, without setting the \\Seen flag.
+
+        :param section: a section specification, such as "1.2" or "TEXT"
+        :type section: string
+        :return: the part's content, still transfer encoded
+        :rtype: bytes
+        """
+
+        return self.get("BODY.PEEK[{}]".format(section))
+
+    @property
+    def parts(self):
+        """The leaf body parts of the message.
+
+        :rtype: list of Part objects
+        """
+
+        return parts(self.bodystructure)
+
+    def stream(self, part, chunk_size = 1048576, decode = True):
+        """Generate the content of a body part in chunks.
+
+        See :func:`stream_part`.
+        """
+
+        return stream_part(self.client, self.mailbox, self.uid, part,
+            chunk_size, decode)
+
+    def spool(self, part, max_memory = 1048576, chunk_size = 1048576,
+            decode = True):
+        """Copy the content of a body part to a temporary file.
+
+        See :func:`spool_part`.
+        """
+
+        return spool_part(self.client, self.mailbox, self.uid, part,
+            max_memory, chunk_size, decode)
+
+    def _update(self, response):
+        data = dict(self._data)
+        data.update(response)
+        self._data = data
+
+def fetch_messages(messages, *items):
+    """Fetch attributes of several messages that have not already been
+    fetched, with a single FETCH per mailbox.
+
+    :param messages: messages
+    :param items: FETCH attributes
+    :type messages: iterable of Message objects
+    :type items: strings
+    """
+
+    groups = collections.defaultdict(list)
+    wanted = collections.defaultdict(set)
+    for message in messages:
+        missing = [i for i in items
+            if _response_key(i) not in message._data]
+        if missing:
+            groups[(message.client, message.mailbox)].append(message)
+            wanted[(message.client, message.mailbox)].update(missing)
+
+    for (client, mailbox), group in groups.items():
+        response = _fetch(client, mailbox, [m.uid for m in group],
+            sorted(wanted[(client, mailbox)]))
+        for message in group:
+            message._update(response.get(message.uid, {}))
+
+@pooled
+def _fetch(client, mailbox, messages, items):
+    client.select_folder(mailbox, readonly = True)
+    return client.fetch(messages, items)
+
+def _response_key(item):
+    # the server names BODY.PEEK[...] data as BODY[...]
+    item = item.upper()
+    if item.startswith("BODY.PEEK["):
+        item = "BODY" + item[len("BODY.PEEK"):]
+    return item.encode()
+
+@dataclasses.dataclass(frozen = True)
+class Part:
+    """A leaf body part of a message, as described by its BODYSTRUCTURE.
+
+    :ivar section: section specification, such as "2.1"
+    :ivar content_type: lower case MIME type, such as "application/pdf"
+    :ivar parameters: content type parameters, keyed by lower case name
+    :ivar encoding: lower case content transfer encoding
+    :ivar size: encoded size in bytes
+    :ivar disposition: lower case content disposition, or None
+    :ivar filename: suggested file name, or None
+    """
+
+    section: str
+    content_type: str
+    parameters: dict
+    encoding: str
+    size: int
+    disposition: str = None
+    filename: str = None
+
+    @property
+    def is_attachment(self):
+        """Whether the part is an attachment rather than inline content.
+
+        :rtype: bool
+        """
+
+        return self.disposition == "attachment"\
+            or (self.disposition is None and self.filename is not None)
+
+def parts(bodystructure):
+    """List the leaf body parts of a message.
+
+    An encapsulated message (message/rfc822) is a single part.
+
+    :param bodystructure: the message's BODYSTRUCTURE
+    :type bodystructure: imapclient.response_types.BodyData
+    :return: the parts, in order
+    :rtype: list of Part objects
+    """
+
+    return list(_walk(bodystructure, ""))
+
+def _walk(structure, section):
+    if structure.is_multipart:
+        for i, child in enumerate(structure[0], 1):
+            yield from _walk(child,
+                "{}.{}".format(section, i) if section else str(i))
+        return
+
+    # a message that is not multipart has a single part, numbered 1
+    maintype = _decode(structure[0]).lower()
+    subtype = _decode(structure[1]).lower()
+    parameters = _pairs(structure[2])
+    disposition, disposition_parameters = None, {}
+
+    # extension data follows the type specific fields
+    extension = 8
+    if maintype == "text":
+        extension = 9
+    elif (maintype, subtype) == ("message", "rfc822"):
+        extension = 11
+    if len(structure) > extension and structure[extension]:
+        disposition = _decode(structure[extension][0]).lower()
+        disposition_parameters = _pairs(structure[extension][1])
+
+    yield Part(section or "1", "{}/{}".format(maintype, subtype),
+        parameters, _decode(structure[5] or b"7bit").lower(),
+        structure[6], disposition,
+        disposition_parameters.get("filename") or parameters.get("name"))
+
+def _pairs(values):
+    if not values:
+        return {}
+    return dict((_decode(k).lower(), _decode(v))
+        for k, v in zip(values[::2], values[1::2]))
+
+def _decode(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    value = str(value)
+    if "=?" in value:
+        # RFC 2047 encoded words, as some mailers use for file names
+        value = str(email.header.make_header(
+            email.header.decode_header(value)))
+    return value
+
+def stream_part(client, mailbox, message, part, chunk_size = 1048576,
+        decode = True):
+    """Generate the content of a body part in chunks.
+
+    The part is fetched with a partial FETCH per chunk, without setting
+    the \\Seen flag, so at most a chunk is held in memory at a time.
+    If a Part is given and decode is set, its content transfer encoding
+    (base64 or quoted-printable) is decoded as it arrives.
+
+    :param client: imap client or connection pool
+    :param mailbox: mailbox name
+    :param message: message id
+    :param part: the part, or its section specification
+    :param chunk_size: the number of bytes to fetch at a time
+    :param decode: decode the content transfer encoding
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :type message: int
+    :type part: Part or string
+    :type chunk_size: int
+    :type decode: bool
+    :return: the content
+    :rtype: generator of bytes
+    """
+
+    if isinstance(client, _pool.ConnectionPool):
+        with client.connection() as connection:
+            yield from stream_part(connection, mailbox, message, part,
+                chunk_size, decode)
+        return
+
+    section = part.section if isinstance(part, Part) else part
+    decoder = _decoder(part.encoding)\
+        if decode and isinstance(part, Part) else None
+    offset = 0
+    while True:
+        # the policy may have selected another mailbox meanwhile
+        client.select_folder(mailbox, readonly = True)
+        response = client.fetch([message], ["BODY.PEEK[{}]<{}.{}>".format(
+            section, offset, chunk_size)]).get(message, {})
+        data = next((v for k, v in response.items()
+            if k.startswith(b"BODY[")), None) or b""
+        offset += len(data)
+        chunk = decoder.decode(data) if decoder else data
+        if chunk:
+            yield chunk
+        if len(data) < chunk_size:
+            break
+    if decoder:
+        chunk = decoder.flush()
+        if chunk:
+            yield chunk
+
+def spool_part(client, mailbox, message, part, max_memory = 1048576,
+        chunk_size = 1048576, decode = True):
+    """Copy the content of a body part to a temporary file.
+
+    The content is streamed as by :func:`stream_part`. It is kept in
+    memory up to max_memory bytes, and is otherwise written to disk,
+    where (after calling fileno) it may be memory mapped.
+
+    :param client: imap client or connection pool
+    :param mailbox: mailbox name
+    :param message: message id
+    :param part: the part, or its section specification
+    :param max_memory: the largest content to keep in memory
+    :param chunk_size: the number of bytes to fetch at a time
+    :param decode: decode the content transfer encoding
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :type message: int
+    :type part: Part or string
+    :type max_memory: int
+    :type chunk_size: int
+    :type decode: bool
+    :return: a file positioned at its start, to be closed by the caller
+    :rtype: tempfile.SpooledTemporaryFile
+    """
+
+    spool = tempfile.SpooledTemporaryFile(max_size = max_memory)
+    try:
+        for chunk in stream_part(client, mailbox, message, part,
+                chunk_size, decode):
+            spool.write(chunk)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+def _decoder(encoding):
+    if encoding == "base64":
+        return _Base64Decoder()
+    if encoding == "quoted-printable":
+        return _QuotedPrintableDecoder()
+    return None
+
+class _Base64Decoder:
+    # decodes whole 4 character groups, keeping the remainder
+    def __init__(self):
+        self._pending = b""
+
+    def decode(self, data):
+        data = self._pending + re.sub(rb"[^A-Za-z0-9+/=]", b"", data)
+        end = len(data) - len(data) % 4
+        self._pending = data[end:]
+        return binascii.a2b_base64(data[:end]) if end else b""
+
+    def flush(self):
+        data, self._pending = self._pending, b""
+        if not data:
+            return b""
+        return binascii.a2b_base64(data + b"=" * (-len(data) % 4))
+
+class _QuotedPrintableDecoder:
+    # decodes whole lines, keeping the remainder
+    def __init__(self):
+        self._pending = b""
+
+    def decode(self, data):
+        data = self._pending + data
+        end = data.rfind(b"\n") + 1
+        self._pending = data[end:]
+        return binascii.a2b_qp(data[:end])
+
+    def flush(self):
+        data, self._pending = self._pending, b""
+        return binascii.a2b_qp(data)
+
+@dataclasses.dataclass
+class Context:
+    """What a policy module's handlers are given to work with.
+
+    :ivar client: connected client
+    :ivar mailbox: the monitored mailbox
+    :ivar prefetched: mapping of message ids to prefetched attributes
+    :ivar parameters: read-only server specific parameters
+    :ivar correspondents: correspondent index, or None
+    :ivar actions: deferred actions, applied after the handlers return
+    :ivar state: the value returned by the module's setup function
+    :ivar pool: connection pool for the server, or None
+    """
+
+    client: object
+    mailbox: str
+    prefetched: dict
+    parameters: object
+    correspondents: object = None
+    actions: object = None
+    state: object = None
+    pool: object = None
+
+    def message(self, message):
+        """Make a message object, seeded with any prefetched attributes.
+
+        :param message: message id
+        :type message: int
+        :return: the message
+        :rtype: Message
+        """
+
+        return Message(self.client, self.mailbox, message,
+            self.prefetched.get(message))
+
+@dataclasses.dataclass(frozen = True)
+class MailboxState:
+    """The state of a mailbox, as reported by STATUS.
+
+    Anything derived from a mailbox's contents remains valid while
+    its state is unchanged. If the server supports CONDSTORE
+    (RFC 7162), the state also changes whenever any message's flags
+    change, otherwise highestmodseq is None.
+    """
+
+    uidvalidity: int
+    uidnext: int
+    messages: int
+    highestmodseq: int = None
+
+@pooled
+def mailbox_state(client, mailbox):
+    """Get the state of a mailbox.
+
+    A mailbox that is selected is selected again, rather than sent
+    STATUS.
+
+    :param client: imap client or connection pool
+    :param mailbox: mailbox name
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :return: the mailbox's state
+    :rtype: MailboxState
+    """
+
+    if getattr(client, "selected", None) == mailbox:
+        # STATUS isn't sent for the selected mailbox (RFC 3501 6.3.10),
+        # which is selected again instead
+        response = client.select_folder(mailbox,
+            readonly = client.readonly, refresh = True)
+        return MailboxState(response.get(b"UIDVALIDITY"),
+            response.get(b"UIDNEXT"), response.get(b"EXISTS"),
+            response.get(b"HIGHESTMODSEQ"))
+
+    capabilities = client.capabilities()
+    items = [b"UIDVALIDITY", b"UIDNEXT", b"MESSAGES"]
+    if b"CONDSTORE" in capabilities or b"QRESYNC" in capabilities:
+        items.append(b"HIGHESTMODSEQ")
+    response = client.folder_status(mailbox, items)
+    return MailboxState(response.get(b"UIDVALIDITY"),
+        response.get(b"UIDNEXT"), response.get(b"MESSAGES"),
+        response.get(b"HIGHESTMODSEQ"))
+
+@pooled
+def fetch_changes(client, mailbox, modseq, messages = None):
+    """Fetch the flags of messages changed since a modification sequence.
+
+    Requires CONDSTORE. If QRESYNC has been enabled, as it is on a
+    session's own connection, messages expunged since then are
+    reported too.
+
+    :param client: imap client or connection pool
+    :param mailbox: mailbox name
+    :param modseq: a previous HIGHESTMODSEQ of the mailbox
+    :param messages: message ids to consider, or None for all
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :type modseq: int
+    :type messages: sequence of ints
+    :return: a mapping of changed message ids to their flags,
+        and a list of expunged message ids
+    :rtype: tuple
+    """
+
+    if messages is not None and not messages:
+        return {}, []
+    client.select_folder(mailbox, readonly = True)
+    modifiers = "CHANGEDSINCE {}".format(modseq)
+    qresync = b"QRESYNC" in getattr(client, "enabled", ())
+    if qresync:
+        modifiers += " VANISHED"
+
+    # the message set may be a range, which IMAPClient.fetch rejects
+    imap = client._imap
+    tag = imap._command("UID", "FETCH",
+        imapclient.imapclient.join_message_ids(messages)
+            if messages is not None else "1:*",
+        "(FLAGS)", "({})".format(modifiers))
+    typ, data = imap._command_complete("FETCH", tag)
+    client._checkok("fetch", typ, data)
+    typ, data = imap._untagged_response(typ, data, "FETCH")
+    response = imapclient.response_parser.parse_fetch_response(
+        data, client.normalise_times, True)
+    changed = dict((m, r[b"FLAGS"])
+        for m, r in response.items() if b"FLAGS" in r)
+
+    # unsolicited VANISHED responses may also have been collected
+    vanished = set()
+    for line in imap.untagged_responses.pop("VANISHED", []):
+        vanished.update(_expand(line.split()[-1]))
+    return changed, sorted(vanished)
+
+def _expand(sequence_set):
+    messages = []
+    for item in sequence_set.split(b","):
+        first, _, last = item.partition(b":")
+        messages.extend(range(int(first), int(last or first) + 1))
+    return messages
+
 def move_message(client, mailbox, message, to_mailbox):
     """Move a message to a different mailbox.
 
@@ -230,13 +1102,175 @@ def move_message(client, mailbox, message, to_mailbox):
     :type to_mailbox: string
     """
 
-    if mailbox == to_mailbox:
+    move_messages(client, mailbox, [message], to_mailbox)
+
+@pooled
+def move_messages(client, mailbox, messages, to_mailbox):
+    """Move several messages to a different mailbox at once.
+
+    Uses the IMAP MOVE capability if available, otherwise it copies the
+    messages to the destination and then deletes the originals.
+
+    :param client: imap client or connection pool
+    :param mailbox: source mailbox name
+    :param messages: message ids
+    :param to_mailbox: destination mailbox name
+    :type client: imapclient.IMAPClient or
+        imaplar.pool.ConnectionPool
+    :type mailbox: string
+    :type messages: sequence of ints
+    :type to_mailbox: string
+    """
+
+    if mailbox == to_mailbox or not messages:
         return
 
     client.select_folder(mailbox)
-    if b"MOVE" in client.capabilities():
-        client.move([message], to_mailbox)
+    capabilities = client.capabilities()
+    if b"MOVE" in capabilities:
+        client.move(messages, to_mailbox)
     else:
-        client.copy([message], to_mailbox)
-        client.delete_messages([message])
-    client.close_folder()
+        client.copy(messages, to_mailbox)
+        client.delete_messages(messages)
+        if b"UIDPLUS" in capabilities:
+            client.uid_expunge(messages)
+        else:
+            client.close_folder()
+
+class Actions:
+    """Changes to messages, deferred until they are flushed.
+
+    Queued changes are applied together by :py:meth:`flush`,
+    with one command per source mailbox and destination (or flag set)
+    and a single expunge per source mailbox. A session flushes its
+    policy's actions after each batch of messages.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def __bool__(self):
+        return bool(self._pending)
+
+    def move(self, mailbox, messages, to_mailbox):
+        """Queue moving messages to a different mailbox.
+
+        :param mailbox: source mailbox name
+        :param messages: message ids
+        :param to_mailbox: destination mailbox name
+        :type mailbox: string
+        :type messages: iterable of ints
+        :type to_mailbox: string
+        """
+
+        if mailbox != to_mailbox:
+            self._changes(mailbox).move[to_mailbox].update(messages)
+
+    def copy(self, mailbox, messages, to_mailbox):
+        """Queue copying messages to a different mailbox.
+
+        :param mailbox: source mailbox name
+        :param messages: message ids
+        :param to_mailbox: destination mailbox name
+        :type mailbox: string
+        :type messages: iterable of ints
+        :type to_mailbox: string
+        """
+
+        self._changes(mailbox).copy[to_mailbox].update(messages)
+
+    def add_flags(self, mailbox, messages, flags):
+        """Queue adding flags to messages.
+
+        :param mailbox: mailbox name
+        :param messages: message ids
+        :param flags: flags to add
+        :type mailbox: string
+        :type messages: iterable of ints
+        :type flags: iterable of strings
+        """
+
+        self._changes(mailbox).add_flags[tuple(sorted(flags))]\
+            .update(messages)
+
+    def remove_flags(self, mailbox, messages, flags):
+        """Queue removing flags from messages.
+
+        :param mailbox: mailbox name
+        :param messages: message ids
+        :param flags: flags to remove
+        :type mailbox: string
+        :type messages: iterable of ints
+        :type flags: iterable of strings
+        """
+
+        self._changes(mailbox).remove_flags[tuple(sorted(flags))]\
+            .update(messages)
+
+    def delete(self, mailbox, messages):
+        """Queue deleting messages.
+
+        :param mailbox: mailbox name
+        :param messages: message ids
+        :type mailbox: string
+        :type messages: iterable of ints
+        """
+
+        self._changes(mailbox).delete.update(messages)
+
+    def flush(self, client):
+        """Apply and forget the queued changes.
+
+        In each mailbox, flags are changed first, then messages are
+        copied, moved and finally deleted.
+        Uses the IMAP MOVE capability if available, otherwise moved
+        messages are copied and then deleted. Deleted messages are
+        expunged by UID if the server supports UIDPLUS.
+
+        :param client: imap client
+        :type client: imapclient.IMAPClient
+        """
+
+        pending, self._pending = self._pending, {}
+        capabilities = client.capabilities()
+        for mailbox, changes in pending.items():
+            client.select_folder(mailbox)
+            for flags, messages in changes.add_flags.items():
+                client.add_flags(sorted(messages), flags, silent = True)
+            for flags, messages in changes.remove_flags.items():
+                client.remove_flags(sorted(messages), flags, silent = True)
+            for to_mailbox, messages in changes.copy.items():
+                client.copy(sorted(messages), to_mailbox)
+
+            expunged = set(changes.delete)
+            for to_mailbox, messages in changes.move.items():
+                if b"MOVE" in capabilities:
+                    client.move(sorted(messages), to_mailbox)
+                else:
+                    client.copy(sorted(messages), to_mailbox)
+                    expunged.update(messages)
+            if expunged:
+                client.delete_messages(sorted(expunged), silent = True)
+                if b"UIDPLUS" in capabilities:
+                    client.uid_expunge(sorted(expunged))
+                else:
+                    client.expunge()
+            logging.debug("flushed actions for {}".format(mailbox))
+
+    def _changes(self, mailbox):
+        changes = self._pending.get(mailbox)
+        if changes is None:
+            changes = self._pending[mailbox] = _Changes()
+        return changes
+
+@dataclasses.dataclass
+class _Changes:
+    add_flags: dict = dataclasses.field(
+        default_factory = lambda: collections.defaultdict(set))
+    remove_flags: dict = dataclasses.field(
+        default_factory = lambda: collections.defaultdict(set))
+    copy: dict = dataclasses.field(
+        default_factory = lambda: collections.defaultdict(set))
+    move: dict = dataclasses.field(
+        default_factory = lambda: collections.defaultdict(set))
+    delete: set = dataclasses.field(default_factory = set)
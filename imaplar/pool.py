@@ -0,0 +1,248 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+This module keeps a pool of connections to a server, ready for use
+by policies and workers, so that they need not disturb the
+connection that monitors the server.
+"""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import imaplib
+import logging
+import threading
+import time
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """A pool of authenticated connections to a server.
+
+    Connections are checked with NOOP before reuse if they have been
+    idle for a while, and are closed if they are idle for longer,
+    down to the minimum size.
+
+    :param connect: opens and authenticates a new connection
+    :param min: number of connections kept open
+    :param max: maximum number of connections
+    :param idle: idle time in seconds after which a connection is closed
+    :param check: idle time in seconds after which a connection is
+        checked before reuse
+    :param timeout: time in seconds to wait for a free connection
+        (default: wait forever)
+    :type connect: callable
+    :type min: int
+    :type max: int
+    :type idle: float
+    :type check: float
+    :type timeout: float
+    """
+
+    def __init__(self, connect, min = 0, max = 4, idle = 300, check = 60,
+            timeout = None):
+        self.connect = connect
+        self.min = min
+        self.max = max
+        self.idle = idle
+        self.check = check
+        self.timeout = timeout
+        self._free = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def start(self):
+        """Open the minimum number of connections, and start evicting
+        idle connections, in the background."""
+
+        threading.Thread(target = self._maintain,
+            name = "imaplar-pool", daemon = True).start()
+
+    def acquire(self):
+        """Take a connection from the pool, waiting if none is free.
+
+        :return: a connected client
+        :rtype: imaplar.client.Client
+        :raises PoolTimeout: if no connection is free within the
+            pool's timeout
+        """
+
+        deadline = None if self.timeout is None\
+            else time.monotonic() + self.timeout
+        while True:
+            with self._condition:
+                while not self._free and self._size >= self.max:
+                    remaining = None if deadline is None\
+                        else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout(
+                            "no connection free after {} seconds"
+                            .format(self.timeout))
+                    self._condition.wait(remaining)
+                if self._free:
+                    client, released = self._free.pop()
+                else:
+                    client, released = None, None
+                    self._size += 1
+
+            if client is None:
+                try:
+                    return self.connect()
+                except:
+                    self._discard()
+                    raise
+            if time.monotonic() - released < self.check\
+                    or self._healthy(client):
+                return client
+            self._discard(client)
+
+    def release(self, client, broken = False):
+        """Return a connection to the pool.
+
+        :param client: the connection
+        :param broken: close the connection rather than reuse it
+        :type client: imaplar.client.Client
+        :type broken: bool
+        """
+
+        if broken or self._closed:
+            self._discard(client)
+            return
+        with self._condition:
+            self._free.append((client, time.monotonic()))
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with statement.
+
+        The connection is discarded if the statement raises an
+        exception other than an IMAP error reported by the server.
+        """
+
+        client = self.acquire()
+        broken = True
+        try:
+            yield client
+            broken = False
+        except Exception as e:
+            broken = not _is_server_error(e)
+            raise
+        finally:
+            self.release(client, broken)
+
+    def map(self, function, items, workers = None):
+        """Call a function for each item in parallel,
+        each with its own connection.
+
+        :param function: called with a connection and an item
+        :param items: the items
+        :param workers: the most calls made at once
+            (default: the pool's maximum size)
+        :type function: callable
+        :type items: iterable
+        :type workers: int
+        :return: the results, in the order of the items
+        :rtype: list
+        """
+
+        items = list(items)
+        if len(items) < 2:
+            return [self._call(function, item) for item in items]
+
+        # each call runs in a copy of the caller's context, so that its
+        # commands are traced as the caller's
+        context = contextvars.copy_context()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers = min(len(items), self.max,
+                    workers or self.max),
+                thread_name_prefix = "imaplar-pool") as executor:
+            return list(executor.map(lambda item: context.copy().run(
+                self._call, function, item), items))
+
+    def close(self):
+        """Close every free connection, and any in use when released."""
+
+        with self._condition:
+            self._closed = True
+            free, self._free = self._free, []
+        for client, released in free:
+            self._discard(client)
+
+    def _call(self, function, item):
+        with self.connection() as client:
+            return function(client, item)
+
+    def _healthy(self, client):
+        try:
+            client.noop()
+            return True
+        except Exception as e:
+            logging.debug("pooled connection failed: {}".format(e))
+            return False
+
+    def _discard(self, client = None):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+        if client:
+            try:
+                client.logout()
+            except Exception as e:
+                pass
+
+    def _maintain(self):
+        while not self._closed:
+            # open connections up to the minimum
+            while True:
+                with self._condition:
+                    if self._closed or self._size >= self.min:
+                        break
+                    self._size += 1
+                try:
+                    client = self.connect()
+                except Exception as e:
+                    logging.warning("pooled connection failed: {}".format(e))
+                    self._discard()
+                    break
+                self.release(client)
+
+            # close connections idle for too long
+            now = time.monotonic()
+            evicted = []
+            with self._condition:
+                keep = self._size - self.min
+                for entry in list(self._free):
+                    if keep > 0 and now - entry[1] >= self.idle:
+                        self._free.remove(entry)
+                        evicted.append(entry[0])
+                        keep -= 1
+            for client in evicted:
+                self._discard(client)
+
+            # check and idle may be 0, but the pool needn't be
+            # maintained more often than every second
+            time.sleep(max(min(self.check, self.idle), 1))
+
+def _is_server_error(e):
+    # a NO or BAD response leaves the connection usable
+    return isinstance(e, imaplib.IMAP4.error)\
+        and not isinstance(e, imaplib.IMAP4.abort)
@@ -0,0 +1,243 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+This module runs policies in a pool of worker processes, so that
+CPU intensive policies are not serialised by the global interpreter
+lock. A policy run in a worker process has no IMAP connection:
+it is given the prefetched message data, and queues any changes to
+messages as actions, which are applied by the owning session.
+"""
+
+import importlib
+import importlib.util
+import logging
+import multiprocessing
+import multiprocessing.util
+import signal
+import threading
+import traceback
+import types
+from . import policy as _policy
+
+# how long, in seconds, stopped worker processes are given to tear
+# down their policy module states before they are killed
+_grace = 5
+
+class ProcessPool:
+    """A pool of worker processes that run policies.
+
+    A policy module is set up once per session in each worker process,
+    and torn down when the process exits: when it is replaced after
+    ``max_tasks`` tasks, when the pool is restarted after a task times
+    out, or when the pool is closed.
+
+    :param workers: number of processes, or None for one per CPU
+    :param max_tasks: number of tasks after which a process is replaced
+    :param timeout: maximum time in seconds for a task
+    :type workers: int
+    :type max_tasks: int
+    :type timeout: float
+    """
+
+    def __init__(self, workers = None, max_tasks = 100, timeout = 60):
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def run(self, key, policy, mailbox, messages, prefetched, parameters):
+        """Run a policy for a batch of messages in a worker process.
+
+        :param key: identifies the session, whose policy module state
+            is kept separately in each process
+        :param policy: the policy
+        :param mailbox: mailbox name
+        :param messages: message ids
+        :param prefetched: prefetched message data
+        :param parameters: server specific parameters
+        :type key: str
+        :type policy: imaplar.client.Policy
+        :type mailbox: str
+        :type messages: sequence of ints
+        :type prefetched: dict
+        :type parameters: collections.abc.Mapping
+        :return: the actions queued by the policy, or None on failure,
+            and the number of messages whose handling failed
+        :rtype: tuple
+        """
+
+        pool = self._get()
+        try:
+            result = pool.apply_async(_execute, (describe(policy), key,
+                dict(parameters), mailbox, list(messages), prefetched,
+                policy.batch))
+            actions, failures, failed = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            logging.error("{}/{}: policy timed out after {} seconds".format(
+                key, mailbox, self.timeout))
+            self._restart(pool)
+            return None, len(messages)
+        except Exception as e:
+            logging.exception("{}/{}: policy process failed".format(
+                key, mailbox))
+            return None, len(messages)
+
+        for failure in failures:
+            logging.error("policy exception\n{}".format(failure))
+        return actions, failed
+
+    def close(self):
+        """Stop the worker processes."""
+
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            _stop(pool)
+
+    def _get(self):
+        with self._lock:
+            if self._pool is None:
+                # forking a threaded process is unsafe
+                context = multiprocessing.get_context("spawn")
+                self._pool = context.Pool(self.workers, _initialize,
+                    maxtasksperchild = self.max_tasks)
+            return self._pool
+
+    def _restart(self, pool):
+        # a stuck task can only be stopped with its process,
+        # and the pool can't stop a single process
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        _stop(pool)
+
+def _stop(pool):
+    # terminated workers tear down, unless stuck outside Python code,
+    # so any still running after a grace period are killed
+    stopping = threading.Thread(target = pool.terminate,
+        name = "imaplar-processes", daemon = True)
+    stopping.start()
+    stopping.join(_grace)
+    for process in list(pool._pool):
+        if process.is_alive():
+            process.kill()
+    stopping.join()
+
+def describe(policy):
+    """Describe a policy so that a worker process can load it.
+
+    :param policy: the policy
+    :type policy: imaplar.client.Policy
+    :return: a picklable description
+    :rtype: tuple
+    """
+
+    if policy.module:
+        return ("module", policy.module.__name__,
+            getattr(policy.module, "__file__", None))
+    if policy.source is None:
+        raise ValueError("policy source is unknown")
+    return ("script", policy.code.co_filename, policy.source)
+
+# the policies and policy module states of this worker process
+_loaded = {}
+_states = {}
+
+def _initialize():
+    # tear down when the process exits, including when it is terminated
+    signal.signal(signal.SIGTERM, _terminated)
+    multiprocessing.util.Finalize(None, _teardown, exitpriority = 0)
+
+def _terminated(signum, frame):
+    raise SystemExit("terminated")
+
+def _teardown():
+    states = list(_states.items())
+    _states.clear()
+    for (description, key), state in states:
+        teardown = getattr(_loaded[description], "teardown", None)
+        if teardown:
+            try:
+                teardown(state)
+            except Exception:
+                logging.exception("policy teardown exception")
+
+def _load(description):
+    loaded = _loaded.get(description)
+    if loaded is None:
+        kind, name, origin = description
+        if kind == "script":
+            loaded = compile(origin, name, "exec")
+        else:
+            try:
+                loaded = importlib.import_module(name)
+            except ImportError:
+                spec = importlib.util.spec_from_file_location(name, origin)
+                loaded = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(loaded)
+        _loaded[description] = loaded
+    return loaded
+
+def _execute(description, key, parameters, mailbox, messages, prefetched,
+        batch):
+    loaded = _load(description)
+    actions = _policy.Actions()
+    failures = []
+    failed = 0
+    parameters = types.MappingProxyType(parameters)
+
+    if isinstance(loaded, types.CodeType):
+        if batch:
+            namespaces = [{"messages": messages}]
+        else:
+            namespaces = [{"message": m} for m in messages]
+        for namespace in namespaces:
+            namespace.update({
+                "client": None,
+                "mailbox": mailbox,
+                "prefetched": prefetched,
+                "correspondents": None,
+                "actions": actions,
+                "pool": None,
+                "parameters": dict(parameters)
+            })
+            try:
+                exec(loaded, namespace)
+            except Exception as e:
+                failures.append(traceback.format_exc())
+                failed += len(messages) if batch else 1
+        return actions, failures, failed
+
+    if (description, key) not in _states:
+        setup = getattr(loaded, "setup", None)
+        _states[(description, key)] = setup(parameters) if setup else None
+    context = _policy.Context(None, mailbox, prefetched, parameters,
+        None, actions, _states[(description, key)])
+
+    handle_batch = getattr(loaded, "handle_batch", None)
+    calls = [(handle_batch, messages)] if handle_batch\
+        else [(loaded.handle, m) for m in messages]
+    for handler, argument in calls:
+        try:
+            handler(context, argument)
+        except Exception as e:
+            failures.append(traceback.format_exc())
+            failed += len(messages) if handle_batch else 1
+    return actions, failures, failed
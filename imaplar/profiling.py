@@ -0,0 +1,168 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+This module measures policy runs: the wall and CPU time each takes,
+and the IMAP commands and bytes it costs. The figures are aggregated
+per policy in the metrics, and attached to the run's trace span.
+The slowest runs of each policy may also be profiled.
+"""
+
+import contextlib
+import cProfile
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from . import metrics
+from . import trace
+
+logger = logging.getLogger(__name__)
+
+class Profiler:
+    """Profiles policy runs with cProfile, keeping the profiles of
+    the slowest runs of each policy.
+
+    Profiles are written to a directory, named after the policy, and
+    may be read with the pstats module or a viewer such as snakeviz.
+    Only one run is profiled at a time; runs that overlap it, on other
+    pipeline workers, are measured but not profiled.
+
+    :param path: directory path
+    :param slowest: the number of profiles to keep for each policy
+    :type path: str
+    :type slowest: int
+    """
+
+    def __init__(self, path, slowest = 5):
+        self.path = path
+        self.slowest = slowest
+        self._kept = {}
+        self._count = itertools.count()
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+
+    @contextlib.contextmanager
+    def run(self, name):
+        """Profile a policy run.
+
+        :param name: policy name
+        :type name: str
+        :return: a context manager
+        """
+
+        if not self._active.acquire(blocking = False):
+            yield
+            return
+        try:
+            profile = cProfile.Profile()
+            started = time.perf_counter()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self._keep(name, time.perf_counter() - started, profile)
+        finally:
+            self._active.release()
+
+    def _keep(self, name, seconds, profile):
+        # keep a heap of the slowest runs, discarding the fastest
+        with self._lock:
+            kept = self._kept.setdefault(name, [])
+            if len(kept) >= self.slowest and seconds <= kept[0][0]:
+                return
+            path = os.path.join(self.path, "{}-{}.prof".format(
+                re.sub(r"[^\w.-]", "_", name) or "policy",
+                next(self._count)))
+            try:
+                profile.dump_stats(path)
+            except OSError:
+                logger.exception("{}: cannot write profile".format(path))
+                return
+            heapq.heappush(kept, (seconds, path))
+            if len(kept) > self.slowest:
+                seconds, evicted = heapq.heappop(kept)
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+# the profiler used by all sessions, if any; any object with a
+# run(name) method returning a context manager, such as a sampling
+# profiler, may take its place
+profiler = None
+
+# called with the wall time and span attributes of every policy run
+# once it has been measured, if set
+observer = None
+
+@contextlib.contextmanager
+def measure(session, mailbox, policy, messages):
+    """Trace, measure and optionally profile a policy run.
+
+    CPU time is that of the thread running the policy; work done in
+    worker processes, or on pooled connections in other threads, is
+    not included, although the commands sent on pooled connections
+    are counted.
+
+    :param session: server name
+    :param mailbox: mailbox name
+    :param policy: policy name
+    :param messages: the number of messages
+    :type session: str
+    :type mailbox: str
+    :type policy: str
+    :type messages: int
+    :return: a context manager yielding the run's trace span
+    """
+
+    policy = policy or ""
+    with trace.span("policy", {
+            "imaplar.session": session,
+            "imaplar.mailbox": mailbox,
+            "imaplar.policy": policy,
+            "imaplar.messages": messages}) as span:
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            with profiler.run(policy) if profiler\
+                    else contextlib.nullcontext():
+                yield span
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            span.attributes.update({
+                "imaplar.cpu_seconds": cpu,
+                "imaplar.commands": span.commands,
+                "imaplar.bytes_sent": span.sent,
+                "imaplar.bytes_received": span.received
+            })
+            metrics.policy_duration.labels(policy).observe(wall)
+            metrics.policy_messages.labels(policy).inc(messages)
+            metrics.policy_cpu.labels(policy).inc(cpu)
+            metrics.policy_commands.labels(policy).inc(span.commands)
+            metrics.policy_bytes.labels(policy, "sent").inc(span.sent)
+            metrics.policy_bytes.labels(policy, "received").inc(
+                span.received)
+            if observer:
+                observer(wall, dict(span.attributes))
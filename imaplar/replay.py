@@ -0,0 +1,314 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Imaplar replay runs the policies configured for a server over Maildir
+or mbox snapshots, loaded into an in-memory IMAP server. Every change
+the policies make is written as a line of JSON, followed by the
+cost of each policy.
+"""
+
+import argparse
+import collections
+import email.parser
+import email.utils
+import json
+import logging.config
+import mailbox as _mailbox
+import os
+import sys
+import threading
+import time
+from . import client
+from . import profiling
+from . import server
+from . import shell
+from . import trace
+
+# flags of Maildir and mbox messages, as IMAP flags
+maildir_flags = {
+    "D": "\\Draft",
+    "F": "\\Flagged",
+    "R": "\\Answered",
+    "S": "\\Seen",
+    "T": "\\Deleted"
+}
+
+mbox_flags = {
+    "A": "\\Answered",
+    "D": "\\Deleted",
+    "F": "\\Flagged",
+    "R": "\\Seen"
+}
+
+_parser = email.parser.BytesParser()
+
+def load(backend, path, name = "INBOX", unseen = False):
+    """Load a Maildir or mbox snapshot into a mailbox.
+
+    The folders of a Maildir++ directory are loaded into mailboxes
+    of the same name.
+
+    :param backend: the server's mailboxes
+    :param path: a Maildir directory or an mbox file
+    :param name: mailbox name
+    :param unseen: load every message as unseen
+    :type backend: imaplar.server.Backend
+    :type path: str
+    :type name: str
+    :type unseen: bool
+    :return: the number of messages loaded
+    :rtype: int
+    """
+
+    backend.create(name)
+    if os.path.isdir(path):
+        return _load_maildir(backend, path, name, unseen)
+    return _load_mbox(backend, path, name, unseen)
+
+def _load_maildir(backend, path, name, unseen):
+    # flags are encoded in file names, which begin with the delivery time
+    entries = []
+    for subdirectory in ("new", "cur"):
+        entries.extend(os.scandir(os.path.join(path, subdirectory)))
+    count = 0
+    for entry in sorted(entries, key = lambda e: e.name):
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+        info = entry.name.partition(_mailbox.Maildir.colon + "2,")[2]
+        with open(entry.path, "rb") as stream:
+            data = stream.read()
+        backend.append(name, data, _flags(info, maildir_flags, unseen),
+            entry.stat().st_mtime, notify = False)
+        count += 1
+
+    for entry in sorted(os.scandir(path), key = lambda e: e.name):
+        if entry.name.startswith(".") and entry.name not in (".", "..")\
+                and entry.is_dir():
+            count += _load_maildir(backend, entry.path, entry.name[1:],
+                unseen)
+    return count
+
+def _load_mbox(backend, path, name, unseen):
+    # mailbox.mbox opens the file for writing, and a snapshot may be
+    # read-only, so it is read directly
+    count = 0
+    with open(path, "rb") as f:
+        for data in _mbox_messages(f):
+            headers = _parser.parsebytes(data, headersonly = True)
+            backend.append(name, data, _flags(headers.get("Status", "")
+                    + headers.get("X-Status", ""), mbox_flags, unseen),
+                _date(headers), notify = False)
+            count += 1
+    return count
+
+def _mbox_messages(f):
+    # the messages of an mbox file, without their "From " lines,
+    # split as mailbox.mbox splits them
+    lines = None
+    for line in f:
+        if line.startswith(b"From "):
+            if lines is not None:
+                yield _mbox_message(lines)
+            lines = []
+        elif lines is not None:
+            lines.append(line)
+    if lines is not None:
+        yield _mbox_message(lines)
+
+def _mbox_message(lines):
+    # the blank line before the next "From " line, or the end of the
+    # file, is not part of the message
+    if lines and lines[-1] == _mailbox.linesep:
+        lines.pop()
+    return b"".join(lines).replace(_mailbox.linesep, b"\n")
+
+def _flags(letters, flags, unseen):
+    return sorted(set(flags[f] for f in letters if f in flags
+        and not (unseen and flags[f] == "\\Seen")))
+
+def _date(headers):
+    try:
+        return email.utils.parsedate_to_datetime(
+            headers["Date"]).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def replay(policies, parameters, backend, output):
+    """Run policies over the unseen messages in the loaded mailboxes.
+
+    :param policies: mapping of mailbox names to policies
+    :param parameters: server specific parameters
+    :param backend: the loaded mailboxes
+    :param output: where changes are written
+    :type policies: collections.abc.Mapping
+    :type parameters: collections.abc.Mapping
+    :type backend: imaplar.server.Backend
+    :type output: file
+    :return: timings of each policy
+    :rtype: dict
+    """
+
+    lock = threading.Lock()
+    def journal(entry):
+        with lock:
+            output.write(json.dumps(entry) + "\n")
+
+    # the timings are observed directly, rather than exported from the
+    # trace, whose export queue may drop spans
+    timings = Timings()
+    observer, profiling.observer = profiling.observer, timings
+    tracer, trace.tracer = trace.tracer, trace.Tracer()
+    backend.journal = journal
+    backend.autocreate = True
+    try:
+        with server.Server(backend) as imap:
+            for name in policies:
+                backend.create(name)
+            session = client.Session(imap.host, imap.port,
+                client.TLSMode.DISABLED, None,
+                client.LoginAuthenticator("replay", "replay"),
+                parameters = parameters, mailboxes = policies)
+            with session.connect() as connection:
+                # every mailbox starts out changed
+                client.Monitor(session, connection).scan()
+            session.close()
+    finally:
+        trace.tracer.close()
+        trace.tracer = tracer
+        profiling.observer = observer
+        backend.journal = None
+    return timings.report()
+
+class Timings:
+    """Collects the cost of each policy, as each run is measured."""
+
+    def __init__(self):
+        self.runs = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __call__(self, seconds, attributes):
+        with self._lock:
+            self.runs[attributes.get("imaplar.policy")].append(
+                (seconds, attributes))
+
+    def report(self):
+        """Summarise the runs of each policy.
+
+        :return: mapping of policy names to summaries
+        :rtype: dict
+        """
+
+        report = {}
+        with self._lock:
+            for name, runs in sorted(self.runs.items()):
+                messages = _total(runs, "imaplar.messages")
+                seconds = sum(s for s, a in runs)
+                report[name] = {
+                    "runs": len(runs),
+                    "messages": messages,
+                    "seconds": seconds,
+                    "seconds_per_message": seconds / messages
+                        if messages else None,
+                    "slowest_run": max(s for s, a in runs),
+                    "cpu_seconds": _total(runs, "imaplar.cpu_seconds"),
+                    "commands": _total(runs, "imaplar.commands"),
+                    "bytes_sent": _total(runs, "imaplar.bytes_sent"),
+                    "bytes_received": _total(runs, "imaplar.bytes_received")
+                }
+        return report
+
+def _total(runs, key):
+    return sum(attributes.get(key, 0) for seconds, attributes in runs)
+
+def main(argv = sys.argv):
+    parser = argparse.ArgumentParser(prog = "{} replay".format(argv[0]),
+        description = __doc__)
+    parser.add_argument("--config",
+        default = os.path.expanduser("~/.imaplar"),
+        help = "configuration file (default: '~/.imaplar')")
+    parser.add_argument("--server",
+        help = "server whose mailboxes and policies are replayed "
+            "(default: the first default server)")
+    parser.add_argument("--unseen", action = "store_true",
+        help = "treat every message as unseen")
+    parser.add_argument("--output", default = "-",
+        help = "output file (default: standard output)")
+    parser.add_argument("snapshots", metavar = "[mailbox=]path",
+        nargs = "+",
+        help = "Maildir directory or mbox file, loaded into a mailbox "
+            "(default: INBOX)")
+    args = parser.parse_args(args = argv[2:])
+    snapshots = []
+    for snapshot in args.snapshots:
+        mailbox, path = "INBOX", snapshot
+        if not os.path.exists(os.path.expanduser(snapshot)):
+            mailbox, _, path = snapshot.partition("=")
+            if not mailbox or not os.path.exists(
+                    os.path.expanduser(path)):
+                parser.error("{}: no such snapshot".format(snapshot))
+        snapshots.append((mailbox, os.path.expanduser(path)))
+
+    # read configuration
+    config = shell.read_config(args.config)
+    if "logging" in config:
+        logging.config.dictConfig(config["logging"])
+    policies = shell.load_policies(config)
+    profiling_config = config.get("profiling", None)
+    if profiling_config:
+        profiling.profiler = profiling.Profiler(
+            os.path.expanduser(profiling_config["path"]),
+            profiling_config["slowest"])
+
+    # the server's mailboxes and policies
+    name = args.server
+    if name is None:
+        defaults = [k for k, v in config["servers"].items() if v["default"]]
+        name = defaults[0] if defaults else next(iter(config["servers"]))
+    server_config = config["servers"].get(name, None)
+    if not server_config:
+        raise shell.ConfigurationError("{}: unknown server".format(name))
+    mailboxes = {}
+    for mailbox, policy in server_config["mailboxes"].items():
+        if policy not in policies:
+            raise shell.ConfigurationError(
+                "{}: policy not defined".format(policy))
+        mailboxes[mailbox] = policies[policy]
+
+    # load snapshots
+    backend = server.Backend()
+    started = time.monotonic()
+    count = 0
+    for mailbox, path in snapshots:
+        count += load(backend, path, mailbox, args.unseen)
+    logging.info("loaded {} messages in {:.3f}s".format(count,
+        time.monotonic() - started))
+
+    # replay
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        started = time.monotonic()
+        timings = replay(mailboxes, server_config.get("parameters", {}),
+            backend, output)
+        logging.info("replayed in {:.3f}s".format(
+            time.monotonic() - started))
+        for name, timing in timings.items():
+            timing["policy"] = name
+            output.write(json.dumps(timing) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
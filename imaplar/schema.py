@@ -151,6 +151,11 @@ config = {
                     "min": 0,
                     "default": 900
                 },
+                "window": {
+                    "type": "integer",
+                    "min": 1,
+                    "default": 10000
+                },
                 "min_backoff": {
                     "type": "integer",
                     "min": 1,
@@ -172,6 +177,73 @@ config = {
                         "empty": False
                     }
                 },
+                "pool": {
+                    "type": "dict",
+                    "schema": {
+                        "min": {
+                            "type": "integer",
+                            "min": 0,
+                            "default": 0
+                        },
+                        "max": {
+                            "type": "integer",
+                            "min": 1,
+                            "default": 4
+                        },
+                        "idle": {
+                            "type": "number",
+                            "min": 0,
+                            "default": 300
+                        },
+                        "check": {
+                            "type": "number",
+                            "min": 0,
+                            "default": 60
+                        },
+                        "timeout": {
+                            "type": "number",
+                            "min": 0,
+                            "default": 60
+                        }
+                    }
+                },
+                "pipeline": {
+                    "type": "dict",
+                    "schema": {
+                        "workers": {
+                            "type": "integer",
+                            "min": 1,
+                            "default": 4
+                        },
+                        "queue_size": {
+                            "type": "integer",
+                            "min": 1,
+                            "default": 16
+                        },
+                        "ordered": {
+                            "type": "boolean",
+                            "default": False
+                        }
+                    }
+                },
+                "catchup": {
+                    "type": "dict",
+                    "schema": {
+                        "connections": {
+                            "type": "integer",
+                            "min": 1,
+                            "default": 4
+                        }
+                    }
+                },
+                "correspondents": {
+                    "type": "list",
+                    "schema": {
+                        "type": "string",
+                        "empty": False
+                    },
+                    "default": []
+                },
                 "parameters": {
                     "type": "dict",
                 }
@@ -186,7 +258,174 @@ config = {
             "empty": False
         },
         "valuesrules": {
-            "type": "string",
+            "type": ["string", "dict"],
+            "schema": {
+                "code": {
+                    "type": "string",
+                    "required": True,
+                    "excludes": "module"
+                },
+                "module": {
+                    "type": "string",
+                    "required": True,
+                    "empty": False,
+                    "excludes": "code"
+                },
+                "batch": {
+                    "type": "boolean",
+                    "default": False
+                },
+                "batch_size": {
+                    "type": "integer",
+                    "min": 1,
+                    "default": 500
+                },
+                "prefetch": {
+                    "type": "list",
+                    "schema": {
+                        "type": "string",
+                        "empty": False
+                    },
+                    "default": ["ENVELOPE", "FLAGS"]
+                },
+                "process": {
+                    "type": "boolean",
+                    "default": False
+                },
+                "headers": {
+                    "type": "list",
+                    "schema": {
+                        "type": "string",
+                        "empty": False
+                    },
+                    "default": []
+                }
+            }
+        }
+    },
+    "checkpoints": {
+        "type": "dict",
+        "schema": {
+            "path": {
+                "type": "string",
+                "required": True,
+                "empty": False
+            }
+        }
+    },
+    "correspondents": {
+        "type": "dict",
+        "schema": {
+            "path": {
+                "type": "string",
+                "required": True,
+                "empty": False
+            }
+        }
+    },
+    "processes": {
+        "type": "dict",
+        "schema": {
+            "workers": {
+                "type": "integer",
+                "min": 1,
+                "nullable": True,
+                "default": None
+            },
+            "max_tasks": {
+                "type": "integer",
+                "min": 1,
+                "default": 100
+            },
+            "timeout": {
+                "type": "number",
+                "min": 0,
+                "default": 60
+            }
+        }
+    },
+    "queries": {
+        "type": "dict",
+        "schema": {
+            "max_length": {
+                "type": "integer",
+                "min": 100,
+                "default": 8000
+            }
+        }
+    },
+    "query_cache": {
+        "type": "dict",
+        "schema": {
+            "size": {
+                "type": "integer",
+                "min": 1,
+                "default": 1024
+            },
+            "ttl": {
+                "type": "number",
+                "min": 0,
+                "default": 300
+            }
+        }
+    },
+    "metrics": {
+        "type": "dict",
+        "schema": {
+            "host": {
+                "type": "string",
+                "empty": False,
+                "default": "127.0.0.1"
+            },
+            "port": {
+                "type": "integer",
+                "min": 1,
+                "max": 65535,
+                "default": 9464
+            }
+        }
+    },
+    "tracing": {
+        "type": "dict",
+        "schema": {
+            "slow": {
+                "type": "number",
+                "min": 0,
+                "nullable": True,
+                "default": 1
+            },
+            "spans": {
+                "type": "string",
+                "empty": False,
+                "nullable": True,
+                "default": None
+            }
+        }
+    },
+    "profiling": {
+        "type": "dict",
+        "schema": {
+            "path": {
+                "type": "string",
+                "required": True,
+                "empty": False
+            },
+            "slowest": {
+                "type": "integer",
+                "min": 1,
+                "default": 5
+            }
+        }
+    },
+    "engine": {
+        "type": "dict",
+        "default": {},
+        "schema": {
+            "workers": {
+                "type": "integer",
+                "min": 1,
+                "default": 16
+            }
         }
     },
     "logging": {
@@ -0,0 +1,1417 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+This module provides a scriptable, in-memory IMAP4rev1 server.
+It implements enough of the protocol (and of the IDLE, MOVE, UIDPLUS,
+CONDSTORE, QRESYNC, NOTIFY, ESEARCH, SEARCHRES, MULTISEARCH and
+PARTIAL extensions) to exercise imaplar, and is intended for benchmarking
+and replaying policies. It is not suitable for storing real mail.
+"""
+
+import asyncio
+import bisect
+import collections
+import email
+import email.parser
+import email.utils
+import itertools
+import re
+import threading
+import time
+
+class ProtocolError(Exception):
+    pass
+
+class _No(ProtocolError):
+    pass
+
+_header_parser = email.parser.BytesParser()
+
+class Message:
+    """A stored message.
+
+    :param uid: message uid
+    :param data: raw message
+    :param flags: message flags
+    :param internaldate: arrival time in seconds since the epoch
+    :param modseq: modification sequence
+    :type uid: int
+    :type data: bytes
+    :type flags: iterable of strings
+    :type internaldate: float
+    :type modseq: int
+    """
+
+    __slots__ = ("uid", "data", "flags", "internaldate", "modseq",
+        "_envelope")
+
+    def __init__(self, uid, data, flags, internaldate, modseq):
+        self.uid = uid
+        self.data = data
+        self.flags = set(flags)
+        self.internaldate = internaldate
+        self.modseq = modseq
+        self._envelope = None
+
+    @property
+    def parsed(self):
+        """The parsed message.
+
+        Parsed messages are not kept, since they are much larger than
+        the raw messages.
+
+        :rtype: email.message.Message
+        """
+
+        return email.message_from_bytes(self.data)
+
+    @property
+    def headers(self):
+        """The parsed message header.
+
+        :rtype: email.message.Message
+        """
+
+        return _header_parser.parsebytes(self.data, headersonly = True)
+
+    @property
+    def envelope(self):
+        """The message's ENVELOPE.
+
+        :rtype: bytes
+        """
+
+        if self._envelope is None:
+            self._envelope = envelope(self.headers)
+        return self._envelope
+
+class Mailbox:
+    """A mailbox.
+
+    :param name: mailbox name
+    :param uidvalidity: uid validity
+    :type name: str
+    :type uidvalidity: int
+    """
+
+    def __init__(self, name, uidvalidity):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages = []
+        self.vanished = []
+        self.listeners = set()
+
+    def find(self, uid):
+        """Find a message by uid.
+
+        :param uid: message uid
+        :type uid: int
+        :return: the message, or None
+        :rtype: Message
+        """
+
+        messages = self.messages
+        lo, hi = 0, len(messages)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if messages[mid].uid < uid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(messages) and messages[lo].uid == uid:
+            return messages[lo]
+        return None
+
+    def modify(self, message):
+        self.highestmodseq += 1
+        message.modseq = self.highestmodseq
+
+    def changed(self):
+        for listener in list(self.listeners):
+            listener(self)
+
+class Backend:
+    """A collection of mailboxes shared by every connection.
+
+    The backend is not thread safe. Use :py:meth:`Server.call` to
+    modify it while the server is running.
+
+    :ivar journal: called with a dict describing each change made by
+        a client, or None
+    :ivar autocreate: create missing mailboxes when messages are
+        copied or moved to them
+    """
+
+    def __init__(self):
+        self.mailboxes = {}
+        self.journal = None
+        self.autocreate = False
+        self._uidvalidity = itertools.count(int(time.time()))
+
+    def record(self, action, mailbox, message, **details):
+        """Describe a change to the journal.
+
+        :param action: what was done, such as "store" or "move"
+        :param mailbox: the mailbox
+        :param message: the message
+        :param details: other details of the change
+        :type action: str
+        :type mailbox: Mailbox
+        :type message: Message
+        """
+
+        if self.journal:
+            entry = {
+                "action": action,
+                "mailbox": mailbox.name,
+                "uid": message.uid,
+                "message_id": message.headers.get("Message-ID")
+            }
+            entry.update(details)
+            self.journal(entry)
+
+    def get(self, name):
+        """Return a mailbox, or None if it does not exist.
+
+        :param name: mailbox name
+        :type name: str
+        :rtype: Mailbox
+        """
+
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        return self.mailboxes.get(name)
+
+    def create(self, name):
+        """Create a mailbox if it does not exist.
+
+        :param name: mailbox name
+        :type name: str
+        :rtype: Mailbox
+        """
+
+        mailbox = self.get(name)
+        if mailbox is None:
+            if name.upper() == "INBOX":
+                name = "INBOX"
+            mailbox = Mailbox(name, next(self._uidvalidity))
+            self.mailboxes[name] = mailbox
+        return mailbox
+
+    def append(self, name, data, flags = (), internaldate = None,
+            notify = True):
+        """Append a message to a mailbox, creating it if necessary.
+
+        :param name: mailbox name
+        :param data: raw message
+        :param flags: message flags
+        :param internaldate: arrival time (default: now)
+        :param notify: notify connections of the change
+        :type name: str
+        :type data: bytes
+        :type flags: iterable of strings
+        :type internaldate: float
+        :type notify: bool
+        :return: message uid
+        :rtype: int
+        """
+
+        mailbox = self.create(name)
+        mailbox.highestmodseq += 1
+        message = Message(mailbox.uidnext, data, flags,
+            time.time() if internaldate is None else internaldate,
+            mailbox.highestmodseq)
+        mailbox.uidnext += 1
+        mailbox.messages.append(message)
+        if notify:
+            mailbox.changed()
+        return message.uid
+
+    def expunge(self, mailbox, uids):
+        """Remove messages from a mailbox.
+
+        :param mailbox: the mailbox
+        :param uids: message uids
+        :type mailbox: Mailbox
+        :type uids: set of ints
+        """
+
+        if uids:
+            mailbox.highestmodseq += 1
+            mailbox.messages = [m for m in mailbox.messages
+                if m.uid not in uids]
+            mailbox.vanished.extend(
+                (uid, mailbox.highestmodseq) for uid in sorted(uids))
+            mailbox.changed()
+
+def _quote(value):
+    if value is None:
+        return b"NIL"
+    if isinstance(value, str):
+        value = value.encode("utf-8", "surrogateescape")
+    if (b"\r" in value or b"\n" in value or b"\0" in value
+            or any(c > 127 for c in value)):
+        return b"{" + str(len(value)).encode() + b"}\r\n" + value
+    return b"\"" + value.replace(b"\\", b"\\\\").replace(b"\"", b"\\\"")\
+        + b"\""
+
+def _list(items):
+    return b"(" + b" ".join(items) + b")"
+
+def _addresses(message, *names):
+    for name in names:
+        values = message.get_all(name)
+        if values:
+            break
+    else:
+        return b"NIL"
+    addresses = []
+    for realname, address in email.utils.getaddresses(
+            [str(v) for v in values]):
+        mailbox, _, host = address.partition("@")
+        addresses.append(_list([_quote(realname or None), b"NIL",
+            _quote(mailbox or None), _quote(host or None)]))
+    return _list(addresses) if addresses else b"NIL"
+
+def _header(message, name):
+    value = message.get(name)
+    return None if value is None else str(value)
+
+def envelope(message):
+    """Format the ENVELOPE of a parsed message.
+
+    :param message: a parsed message
+    :type message: email.message.Message
+    :rtype: bytes
+    """
+
+    return _list([
+        _quote(_header(message, "Date")),
+        _quote(_header(message, "Subject")),
+        _addresses(message, "From"),
+        _addresses(message, "Sender", "From"),
+        _addresses(message, "Reply-To", "From"),
+        _addresses(message, "To"),
+        _addresses(message, "Cc"),
+        _addresses(message, "Bcc"),
+        _quote(_header(message, "In-Reply-To")),
+        _quote(_header(message, "Message-ID"))])
+
+def _payload(part):
+    payload = part.get_payload()
+    if isinstance(payload, list):
+        return b""
+    return payload.encode("ascii", "surrogateescape")
+
+def _parameters(part):
+    parameters = part.get_params()
+    if not parameters or len(parameters) < 2:
+        return b"NIL"
+    return _list([_quote(x) for k, v in parameters[1:]
+        for x in (k.upper(), str(v))])
+
+def _disposition(part):
+    value = part.get("Content-Disposition")
+    if value is None:
+        return b"NIL"
+    parameters = part.get_params(header = "Content-Disposition")
+    return _list([_quote(parameters[0][0].upper()),
+        _list([_quote(x) for k, v in parameters[1:]
+            for x in (k.upper(), str(v))]) if len(parameters) > 1
+            else b"NIL"])
+
+def bodystructure(part):
+    """Format the BODYSTRUCTURE of a parsed message.
+
+    :param part: a parsed message
+    :type part: email.message.Message
+    :rtype: bytes
+    """
+
+    maintype = part.get_content_maintype()
+    subtype = part.get_content_subtype()
+    if part.is_multipart():
+        return b"(" + b"".join(bodystructure(p) for p in part.get_payload())\
+            + b" " + _quote(subtype.upper()) + b" " + _parameters(part)\
+            + b" " + _disposition(part) + b" NIL)"
+
+    payload = _payload(part)
+    fields = [_quote(maintype.upper()), _quote(subtype.upper()),
+        _parameters(part), _quote(_header(part, "Content-ID")),
+        _quote(_header(part, "Content-Description")),
+        _quote((part.get("Content-Transfer-Encoding") or "7BIT").upper()),
+        str(len(payload)).encode()]
+    if maintype == "text":
+        fields.append(str(payload.count(b"\n")).encode())
+    fields.extend([b"NIL", _disposition(part), b"NIL"])
+    return _list(fields)
+
+def _split(data):
+    index = data.find(b"\r\n\r\n")
+    if index >= 0:
+        return data[:index + 4], data[index + 4:]
+    index = data.find(b"\n\n")
+    if index >= 0:
+        return data[:index + 2], data[index + 2:]
+    return data, b""
+
+def _part(message, section):
+    part = message
+    for number in section:
+        if part.is_multipart():
+            parts = part.get_payload()
+            if number < 1 or number > len(parts):
+                return None
+            part = parts[number - 1]
+        elif number != 1:
+            return None
+    return part
+
+def section(message, spec):
+    """Extract a body section.
+
+    :param message: the message
+    :param spec: section specification, for example "1.2" or "HEADER"
+    :type message: Message
+    :type spec: str
+    :rtype: bytes
+    """
+
+    spec = spec.upper()
+    match = re.match(r"^((?:\d+\.)*\d+)?\.?(.*)$", spec)
+    numbers, text = match.group(1), match.group(2)
+    if not numbers:
+        header, body = _split(message.data)
+        if text == "":
+            return message.data
+        if text == "TEXT":
+            return body
+        part = message.headers
+    else:
+        part = _part(message.parsed,
+            [int(x) for x in numbers.split(".")])
+        if part is None:
+            return b""
+        if text == "":
+            if part.is_multipart():
+                return _split(part.as_bytes())[1]
+            return _payload(part)
+        header, body = _split(part.as_bytes())
+        if text == "MIME":
+            return header
+        if text == "TEXT":
+            return body
+
+    if text == "HEADER":
+        return header
+    match = re.match(r"^HEADER\.FIELDS(\.NOT)? \((.*)\)$", text)
+    if match:
+        names = set(match.group(2).split())
+        exclude = bool(match.group(1))
+        lines = []
+        for name, value in part.items():
+            if (name.upper() in names) != exclude:
+                lines.append("{}: {}\r\n".format(name, value))
+        return "".join(lines).encode("utf-8", "surrogateescape") + b"\r\n"
+    raise ProtocolError("bad section {}".format(spec))
+
+_token = re.compile(
+    rb"\(|\)"                                  # parentheses
+    rb"|\"(?:[^\"\\]|\\.)*\""                  # quoted string
+    rb"|\{\d+\+?\}\r\n"                        # literal
+    rb"|[^\s()\[\"]+(?:\[[^\]]*\][^\s()]*)?"  # atom, maybe with a section
+    rb"|\[[^\]]*\]")                          # bracketed section
+
+def tokenize(data):
+    """Tokenize a command into nested lists of bytes.
+
+    :param data: command including literals
+    :type data: bytes
+    :rtype: list
+    """
+
+    stack = [[]]
+    position = 0
+    while position < len(data):
+        if data[position:position + 1] in (b" ", b"\r", b"\n"):
+            position += 1
+            continue
+        match = _token.match(data, position)
+        if not match:
+            raise ProtocolError("cannot parse command")
+        token = match.group(0)
+        position = match.end()
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if len(stack) < 2:
+                raise ProtocolError("unbalanced parentheses")
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif token.startswith(b"\""):
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", token[1:-1]))
+        elif token.startswith(b"{"):
+            size = int(token[1:].split(b"}")[0].rstrip(b"+"))
+            stack[-1].append(data[position:position + size])
+            position += size
+        else:
+            stack[-1].append(token)
+    if len(stack) != 1:
+        raise ProtocolError("unbalanced parentheses")
+    return stack[0]
+
+def _text(token):
+    if isinstance(token, list):
+        raise ProtocolError("unexpected list")
+    return token.decode("utf-8", "surrogateescape")
+
+def _keyword(token):
+    return None if isinstance(token, list) else _text(token).upper()
+
+def _sequence(text, largest):
+    ranges = []
+    for item in text.split(","):
+        bounds = [largest if x == "*" else int(x) for x in item.split(":")]
+        if len(bounds) == 1:
+            bounds.append(bounds[0])
+        ranges.append((min(bounds), max(bounds)))
+    return ranges
+
+def _within(value, ranges):
+    return any(lo <= value <= hi for lo, hi in ranges)
+
+def _imapdate(value):
+    return time.strftime("%d-%b-%Y %H:%M:%S +0000", time.gmtime(value))
+
+class Connection:
+    """A client connection."""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.backend = server.backend
+        self.reader = reader
+        self.writer = writer
+        self.authenticated = False
+        self.mailbox = None
+        self.readonly = True
+        self.view = []
+        self.notify = set()
+        self.notify_pending = set()
+        self.condstore = False
+        self.qresync = False
+        self.saved = []
+        self.wakeup = asyncio.Event()
+
+    def send(self, *lines):
+        data = b"".join(line + b"\r\n" for line in lines)
+        self.server.bytes_out += len(data)
+        self.writer.write(data)
+
+    def listener(self, mailbox):
+        if mailbox is not self.mailbox:
+            self.notify_pending.add(mailbox.name)
+        self.wakeup.set()
+
+    async def readline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError()
+        self.server.bytes_in += len(line)
+        return line
+
+    async def read_command(self):
+        data = await self.readline()
+        while True:
+            match = re.search(rb"\{(\d+)(\+?)\}\r\n$", data)
+            if not match:
+                return data
+            if not match.group(2):
+                self.send(b"+ Ready")
+                await self.writer.drain()
+            literal = await self.reader.readexactly(int(match.group(1)))
+            self.server.bytes_in += len(literal)
+            data += literal + await self.readline()
+
+    async def run(self):
+        self.send(b"* OK [CAPABILITY " + self.capabilities() +
+            b"] imaplar server ready")
+        try:
+            while True:
+                await self.writer.drain()
+                data = await self.read_command()
+                try:
+                    tokens = tokenize(data)
+                except ProtocolError as e:
+                    self.send(b"* BAD " + str(e).encode())
+                    continue
+                if len(tokens) < 2:
+                    self.send(b"* BAD missing command")
+                    continue
+                tag, tokens = tokens[0], tokens[1:]
+                if not await self.dispatch(tag, tokens):
+                    break
+        except (EOFError, ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            self.unselect()
+            self.subscribe(set())
+            self.writer.close()
+
+    async def dispatch(self, tag, tokens):
+        command = _text(tokens[0]).upper()
+        uid = False
+        if command == "UID" and len(tokens) > 1:
+            uid = True
+            tokens = tokens[1:]
+            command = _text(tokens[0]).upper()
+        self.server.commands[("UID " if uid else "") + command] += 1
+
+        latency = self.server.latency
+        if isinstance(latency, dict):
+            latency = latency.get(command, latency.get(None, 0))
+        if latency:
+            await asyncio.sleep(latency)
+
+        handler = getattr(self, "do_" + command.lower().replace("-", "_"),
+            None)
+        if handler is None or command not in self.server.commands_allowed():
+            self.send(tag + b" BAD unknown command " + command.encode())
+            return True
+        if not self.authenticated and command not in (
+                "CAPABILITY", "LOGIN", "AUTHENTICATE", "LOGOUT", "NOOP"):
+            self.send(tag + b" NO not authenticated")
+            return True
+
+        try:
+            result = handler(tag, tokens[1:], uid)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except _No as e:
+            self.send(tag + b" NO " + str(e).encode())
+            return True
+        except ProtocolError as e:
+            self.send(tag + b" BAD " + str(e).encode())
+            return True
+        except (IndexError, ValueError):
+            self.send(tag + b" BAD invalid arguments")
+            return True
+        if result is False:
+            return False
+        self.send(tag + b" OK " + (result or command.encode() + b" completed"))
+        return True
+
+    def capabilities(self):
+        return b" ".join(c.encode() for c in self.server.capabilities())
+
+    def synchronize(self, expunge = True):
+        if self.mailbox is not None:
+            current = [m.uid for m in self.mailbox.messages]
+            present = set(current)
+            if expunge:
+                for index in range(len(self.view) - 1, -1, -1):
+                    if self.view[index] not in present:
+                        if self.qresync:
+                            self.send("* VANISHED {}".format(
+                                self.view[index]).encode())
+                        else:
+                            self.send("* {} EXPUNGE".format(
+                                index + 1).encode())
+                        del self.view[index]
+            known = set(self.view)
+            last = self.view[-1] if self.view else 0
+            added = [u for u in current if u > last and u not in known]
+            if added:
+                self.view.extend(added)
+                self.send("* {} EXISTS".format(len(self.view)).encode())
+        for name in sorted(self.notify_pending):
+            mailbox = self.backend.get(name)
+            if mailbox is not None:
+                self.send(b"* STATUS " + _quote(mailbox.name) + b" "
+                    + self.status(mailbox, ["MESSAGES", "UIDNEXT", "UNSEEN"]))
+        self.notify_pending.clear()
+        self.wakeup.clear()
+
+    def subscribe(self, names):
+        for name in self.notify - names:
+            mailbox = self.backend.get(name)
+            if mailbox is not None and mailbox is not self.mailbox:
+                mailbox.listeners.discard(self.listener)
+        self.notify = names
+        for name in names:
+            self.backend.create(name).listeners.add(self.listener)
+
+    def unselect(self):
+        if self.mailbox is not None:
+            if self.mailbox.name not in self.notify:
+                self.mailbox.listeners.discard(self.listener)
+        self.mailbox = None
+        self.view = []
+        self.saved = []
+
+    def messages(self, text, uid):
+        # the view is in uid order, so ranges of uids can be bisected
+        view = self.view
+        indexes = set()
+        if text == "$":
+            for u in self.saved:
+                index = bisect.bisect_left(view, u)
+                if index < len(view) and view[index] == u:
+                    indexes.add(index)
+        elif uid:
+            largest = view[-1] if view else 0
+            for lo, hi in _sequence(text, largest):
+                indexes.update(range(bisect.bisect_left(view, lo),
+                    bisect.bisect_right(view, hi)))
+        else:
+            for lo, hi in _sequence(text, len(view)):
+                indexes.update(range(max(lo, 1) - 1, min(hi, len(view))))
+        result = []
+        for index in sorted(indexes):
+            message = self.mailbox.find(view[index])
+            if message is not None:
+                result.append((index + 1, message))
+        return result
+
+    def require_selected(self):
+        if self.mailbox is None:
+            raise ProtocolError("no mailbox selected")
+
+    def do_capability(self, tag, args, uid):
+        self.send(b"* CAPABILITY " + self.capabilities())
+
+    def do_noop(self, tag, args, uid):
+        self.synchronize()
+
+    def do_logout(self, tag, args, uid):
+        self.send(b"* BYE logging out", tag + b" OK LOGOUT completed")
+        return False
+
+    def do_login(self, tag, args, uid):
+        username, password = _text(args[0]), _text(args[1])
+        users = self.server.users
+        if users is not None and users.get(username) != password:
+            raise _No("authentication failed")
+        self.authenticated = True
+        return b"[CAPABILITY " + self.capabilities() + b"] LOGIN completed"
+
+    def do_enable(self, tag, args, uid):
+        enabled = []
+        for arg in args:
+            name = _text(arg).upper()
+            if name in ("CONDSTORE", "QRESYNC") and name in \
+                    self.server.capabilities():
+                self.condstore = True
+                if name == "QRESYNC":
+                    self.qresync = True
+                enabled.append(name.encode())
+        self.send(b"* ENABLED" + b"".join(b" " + e for e in enabled))
+
+    def do_list(self, tag, args, uid):
+        pattern = _text(args[1])
+        regex = re.compile("^" + re.escape(pattern).replace(r"\*", ".*")
+            .replace("%", "[^/]*") + "$")
+        for name in sorted(self.backend.mailboxes):
+            if regex.match(name):
+                self.send(b"* LIST () \"/\" " + _quote(name))
+
+    def do_create(self, tag, args, uid):
+        self.backend.create(_text(args[0]))
+
+    def status(self, mailbox, items):
+        values = []
+        for item in items:
+            item = item.upper()
+            if item == "MESSAGES":
+                value = len(mailbox.messages)
+            elif item == "RECENT":
+                value = 0
+            elif item == "UIDNEXT":
+                value = mailbox.uidnext
+            elif item == "UIDVALIDITY":
+                value = mailbox.uidvalidity
+            elif item == "UNSEEN":
+                value = sum(1 for m in mailbox.messages
+                    if "\\Seen" not in m.flags)
+            elif item == "HIGHESTMODSEQ" and self.server.condstore:
+                value = mailbox.highestmodseq
+            else:
+                raise ProtocolError("unknown status item " + item)
+            values.append("{} {}".format(item, value).encode())
+        return _list(values)
+
+    def do_status(self, tag, args, uid):
+        mailbox = self.backend.get(_text(args[0]))
+        if mailbox is None:
+            raise _No("no such mailbox")
+        self.send(b"* STATUS " + _quote(mailbox.name) + b" " +
+            self.status(mailbox, [_text(x) for x in args[1]]))
+
+    def select(self, tag, args, readonly):
+        self.unselect()
+        mailbox = self.backend.get(_text(args[0]))
+        if mailbox is None:
+            raise _No("no such mailbox")
+        if len(args) > 1 and self.server.condstore:
+            self.condstore = True
+        self.mailbox = mailbox
+        self.readonly = readonly
+        self.view = [m.uid for m in mailbox.messages]
+        mailbox.listeners.add(self.listener)
+        self.send(
+            b"* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)",
+            "* {} EXISTS".format(len(self.view)).encode(),
+            b"* 0 RECENT",
+            "* OK [UIDVALIDITY {}] UIDs valid".format(
+                mailbox.uidvalidity).encode(),
+            "* OK [UIDNEXT {}] Predicted next UID".format(
+                mailbox.uidnext).encode())
+        if self.server.condstore:
+            self.send("* OK [HIGHESTMODSEQ {}] Highest".format(
+                mailbox.highestmodseq).encode())
+        self.send(b"* OK [PERMANENTFLAGS (\\Answered \\Flagged \\Deleted "
+            b"\\Seen \\Draft \\*)] Limited")
+        return b"[READ-ONLY] EXAMINE completed" if readonly\
+            else b"[READ-WRITE] SELECT completed"
+
+    def do_select(self, tag, args, uid):
+        return self.select(tag, args, False)
+
+    def do_examine(self, tag, args, uid):
+        return self.select(tag, args, True)
+
+    def do_close(self, tag, args, uid):
+        self.require_selected()
+        if not self.readonly:
+            self.expunge(self.mailbox.messages)
+        self.unselect()
+
+    def do_unselect(self, tag, args, uid):
+        self.require_selected()
+        self.unselect()
+
+    def do_expunge(self, tag, args, uid):
+        self.require_selected()
+        if self.readonly:
+            raise _No("mailbox is read-only")
+        candidates = self.mailbox.messages
+        if uid:
+            candidates = [m for s, m in self.messages(_text(args[0]), True)]
+        self.expunge(candidates)
+        self.synchronize()
+
+    def expunge(self, candidates):
+        deleted = [m for m in candidates if "\\Deleted" in m.flags]
+        for message in deleted:
+            self.backend.record("expunge", self.mailbox, message)
+        self.backend.expunge(self.mailbox, set(m.uid for m in deleted))
+
+    def do_append(self, tag, args, uid):
+        name = _text(args[0])
+        flags = args[1] if len(args) > 2 and isinstance(args[1], list) \
+            else []
+        data = args[-1]
+        mailbox = self.backend.get(name)
+        if mailbox is None:
+            raise _No("[TRYCREATE] no such mailbox")
+        appended = self.backend.append(name, data, [_text(f) for f in flags])
+        self.backend.record("append", mailbox, mailbox.find(appended))
+        if "UIDPLUS" in self.server.capabilities():
+            return "[APPENDUID {} {}] APPEND completed".format(
+                mailbox.uidvalidity, appended).encode()
+
+    def do_idle(self, tag, args, uid):
+        return self.idle(tag)
+
+    async def idle(self, tag):
+        self.send(b"+ idling")
+        self.synchronize()
+        await self.writer.drain()
+        reading = asyncio.ensure_future(self.readline())
+        try:
+            while True:
+                waiting = asyncio.ensure_future(self.wakeup.wait())
+                done, pending = await asyncio.wait([reading, waiting],
+                    return_when = asyncio.FIRST_COMPLETED)
+                if reading in done:
+                    waiting.cancel()
+                    line = reading.result()
+                    if line.strip().upper() != b"DONE":
+                        raise ProtocolError("expected DONE")
+                    return b"IDLE terminated"
+                self.synchronize()
+                await self.writer.drain()
+        finally:
+            if not reading.done():
+                reading.cancel()
+
+    def do_notify(self, tag, args, uid):
+        if _text(args[0]).upper() == "NONE":
+            self.subscribe(set())
+            return
+        names = set()
+        args = args[1:]
+        if args and not isinstance(args[0], list):
+            args = args[1:]
+        for group in args:
+            spec = group[0]
+            if isinstance(spec, list) and spec and \
+                    _text(spec[0]).upper() == "MAILBOXES":
+                names.update(_text(x) for x in spec[1:])
+            elif not isinstance(spec, list) and \
+                    _text(spec).upper() == "MAILBOXES":
+                for item in group[1:-1]:
+                    if isinstance(item, list):
+                        names.update(_text(x) for x in item)
+                    else:
+                        names.add(_text(item))
+        self.subscribe(names)
+
+    def do_search(self, tag, args, uid):
+        self.require_selected()
+        returns = None
+        if args and _keyword(args[0]) == "RETURN":
+            returns = [_text(x).upper() for x in args[1]] or ["ALL"]
+            args = args[2:]
+        if args and _keyword(args[0]) == "CHARSET":
+            args = args[2:]
+        predicate = self.criteria(list(args))
+        matched = [(s, m) for s, m in
+            ((i + 1, self.mailbox.find(u)) for i, u in enumerate(self.view))
+            if m is not None and predicate(s, m)]
+        self.respond_search(tag, matched, uid, returns)
+
+    def respond_search(self, tag, matched, uid, returns, prefix = b""):
+        numbers = [m.uid if uid else s for s, m in matched]
+        if returns is None:
+            self.send(b"* SEARCH" + b"".join(" {}".format(n).encode()
+                for n in numbers))
+            return
+        if "SAVE" in returns:
+            self.saved = [m.uid for s, m in matched]
+            returns = [r for r in returns if r != "SAVE"]
+            if not returns:
+                return
+        items = [b"(TAG " + _quote(tag) + prefix + b")"]
+        if uid:
+            items.append(b"UID")
+        if numbers:
+            if "MIN" in returns:
+                items.append("MIN {}".format(min(numbers)).encode())
+            if "MAX" in returns:
+                items.append("MAX {}".format(max(numbers)).encode())
+            if "ALL" in returns:
+                items.append(b"ALL " + _compress(numbers))
+        if "PARTIAL" in returns:
+            # a range of results, counted from the end if negative
+            window = returns[returns.index("PARTIAL") + 1]
+            first, _, last = window.partition(":")
+            first, last = sorted((int(first), int(last or first)),
+                key = abs)
+            if first < 0:
+                page = numbers[max(len(numbers) + last, 0):
+                    len(numbers) + first + 1]
+            else:
+                page = numbers[first - 1:last]
+            items.append("PARTIAL ({} ".format(window).encode() +
+                (_compress(page) if page else b"NIL") + b")")
+        if "COUNT" in returns:
+            items.append("COUNT {}".format(len(numbers)).encode())
+        self.send(b"* ESEARCH " + b" ".join(items))
+
+    def do_esearch(self, tag, args, uid):
+        names = []
+        if args and _keyword(args[0]) == "IN":
+            source = args[1]
+            for i in range(0, len(source) - 1, 2):
+                if _keyword(source[i]) != "MAILBOXES":
+                    continue
+                value = source[i + 1]
+                names.extend(_text(x) for x in
+                    (value if isinstance(value, list) else [value]))
+            args = args[2:]
+        returns = ["ALL"]
+        if args and _keyword(args[0]) == "RETURN":
+            returns = [_text(x).upper() for x in args[1]] or ["ALL"]
+            args = args[2:]
+        predicate = self.criteria(list(args))
+        for name in names:
+            mailbox = self.backend.get(name)
+            if mailbox is None:
+                continue
+            matched = [(i + 1, m) for i, m in enumerate(mailbox.messages)
+                if predicate(i + 1, m)]
+            self.respond_search(tag, matched, True, returns,
+                " MAILBOX {} UIDVALIDITY {}".format(
+                    _quote(mailbox.name).decode(),
+                    mailbox.uidvalidity).encode())
+
+    def criteria(self, args):
+        predicates = []
+        while args:
+            predicates.append(self.criterion(args))
+        return lambda s, m: all(p(s, m) for p in predicates)
+
+    def criterion(self, args):
+        token = args.pop(0)
+        if isinstance(token, list):
+            return self.criteria(list(token))
+        key = _text(token).upper()
+        flags = {"SEEN": "\\Seen", "ANSWERED": "\\Answered",
+            "FLAGGED": "\\Flagged", "DELETED": "\\Deleted",
+            "DRAFT": "\\Draft"}
+        if key == "ALL":
+            return lambda s, m: True
+        if key in flags:
+            flag = flags[key]
+            return lambda s, m: flag in m.flags
+        if key.startswith("UN") and key[2:] in flags:
+            flag = flags[key[2:]]
+            return lambda s, m: flag not in m.flags
+        if key in ("NEW", "RECENT"):
+            return lambda s, m: False
+        if key == "OLD":
+            return lambda s, m: True
+        if key == "KEYWORD":
+            flag = _text(args.pop(0))
+            return lambda s, m: flag in m.flags
+        if key == "UNKEYWORD":
+            flag = _text(args.pop(0))
+            return lambda s, m: flag not in m.flags
+        if key == "NOT":
+            inner = self.criterion(args)
+            return lambda s, m: not inner(s, m)
+        if key == "OR":
+            a = self.criterion(args)
+            b = self.criterion(args)
+            return lambda s, m: a(s, m) or b(s, m)
+        if key == "UID":
+            text = _text(args.pop(0))
+            if text == "$":
+                saved = set(self.saved)
+                return lambda s, m: m.uid in saved
+            largest = self.mailbox.uidnext - 1 if self.mailbox else 0
+            ranges = _sequence(text, largest)
+            return lambda s, m: _within(m.uid, ranges)
+        if key == "$":
+            saved = set(self.saved)
+            return lambda s, m: m.uid in saved
+        if key in ("FROM", "TO", "CC", "BCC", "SUBJECT"):
+            value = _text(args.pop(0)).lower()
+            return lambda s, m: any(value in str(v).lower()
+                for v in m.headers.get_all(key, []))
+        if key == "HEADER":
+            name = _text(args.pop(0))
+            value = _text(args.pop(0)).lower()
+            return lambda s, m: any(value in str(v).lower()
+                for v in m.headers.get_all(name, []))
+        if key in ("BODY", "TEXT"):
+            value = _text(args.pop(0)).lower().encode()
+            return lambda s, m: value in (m.data.lower() if key == "TEXT"
+                else _split(m.data)[1].lower())
+        if key == "LARGER":
+            size = int(_text(args.pop(0)))
+            return lambda s, m: len(m.data) > size
+        if key == "SMALLER":
+            size = int(_text(args.pop(0)))
+            return lambda s, m: len(m.data) < size
+        if key == "MODSEQ":
+            value = _text(args.pop(0))
+            if not value.isdigit():
+                args.pop(0)
+                value = _text(args.pop(0))
+            modseq = int(value)
+            return lambda s, m: m.modseq >= modseq
+        if key in ("SINCE", "BEFORE", "ON"):
+            value = time.mktime(time.strptime(_text(args.pop(0)),
+                "%d-%b-%Y"))
+            if key == "SINCE":
+                return lambda s, m: m.internaldate >= value
+            if key == "BEFORE":
+                return lambda s, m: m.internaldate < value
+            return lambda s, m: value <= m.internaldate < value + 86400
+        if re.match(r"^[\d*:,]+$", key):
+            ranges = _sequence(key, len(self.view))
+            return lambda s, m: _within(s, ranges)
+        raise ProtocolError("unsupported search key " + key)
+
+    def do_fetch(self, tag, args, uid):
+        self.require_selected()
+        messages = self.messages(_text(args[0]), uid)
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [_text(i).upper() if not isinstance(i, list) else i
+            for i in items]
+        expanded = []
+        for item in items:
+            if item == "ALL":
+                expanded += ["FLAGS", "INTERNALDATE", "RFC822.SIZE",
+                    "ENVELOPE"]
+            elif item == "FAST":
+                expanded += ["FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+            elif item == "FULL":
+                expanded += ["FLAGS", "INTERNALDATE", "RFC822.SIZE",
+                    "ENVELOPE", "BODY"]
+            else:
+                expanded.append(item)
+        items = expanded
+        if uid and "UID" not in items:
+            items.insert(0, "UID")
+
+        changedsince = None
+        vanished = False
+        if len(args) > 2:
+            modifiers = args[2]
+            index = 0
+            while index < len(modifiers):
+                name = _text(modifiers[index]).upper()
+                if name == "CHANGEDSINCE":
+                    changedsince = int(_text(modifiers[index + 1]))
+                    self.condstore = True
+                    index += 2
+                elif name == "VANISHED":
+                    vanished = True
+                    index += 1
+                else:
+                    raise ProtocolError("unknown modifier " + name)
+        if changedsince is not None:
+            if "MODSEQ" not in items:
+                items.append("MODSEQ")
+            if vanished and uid and self.qresync:
+                ranges = _sequence(_text(args[0]), self.mailbox.uidnext - 1)
+                gone = [u for u, modseq in self.mailbox.vanished
+                    if modseq > changedsince and _within(u, ranges)]
+                if gone:
+                    self.send(b"* VANISHED (EARLIER) " + _compress(gone))
+            messages = [(s, m) for s, m in messages
+                if m.modseq > changedsince]
+
+        self.send(*(b"* " + str(seq).encode() + b" FETCH "
+            + _list([self.fetch_item(message, item) for item in items])
+                for seq, message in messages))
+
+    def fetch_item(self, message, item):
+        if item == "UID":
+            return "UID {}".format(message.uid).encode()
+        if item == "FLAGS":
+            return b"FLAGS " + _list([f.encode() for f in
+                sorted(message.flags)])
+        if item == "INTERNALDATE":
+            return b"INTERNALDATE " + _quote(_imapdate(message.internaldate))
+        if item == "RFC822.SIZE":
+            return "RFC822.SIZE {}".format(len(message.data)).encode()
+        if item == "ENVELOPE":
+            return b"ENVELOPE " + message.envelope
+        if item in ("BODYSTRUCTURE", "BODY"):
+            return item.encode() + b" " + bodystructure(message.parsed)
+        if item == "MODSEQ":
+            return "MODSEQ ({})".format(message.modseq).encode()
+        if item == "RFC822":
+            self.mark_seen(message)
+            return b"RFC822 " + _quote(message.data)
+        if item == "RFC822.HEADER":
+            return b"RFC822.HEADER " + _quote(_split(message.data)[0])
+        if item == "RFC822.TEXT":
+            self.mark_seen(message)
+            return b"RFC822.TEXT " + _quote(_split(message.data)[1])
+        match = re.match(r"^BODY(\.PEEK)?\[(.*)\](?:<(\d+)(?:\.(\d+))?>)?$",
+            item, re.DOTALL)
+        if not match:
+            raise ProtocolError("unknown fetch item " + item)
+        peek, spec, offset, size = match.groups()
+        data = section(message, spec)
+        name = "BODY[{}]".format(spec)
+        if offset is not None:
+            offset = int(offset)
+            data = data[offset:offset + int(size)] if size else data[offset:]
+            name += "<{}>".format(offset)
+        if not peek:
+            self.mark_seen(message)
+        return name.encode() + b" " + _quote(data)
+
+    def mark_seen(self, message):
+        if not self.readonly and "\\Seen" not in message.flags:
+            message.flags.add("\\Seen")
+            self.mailbox.modify(message)
+
+    def do_store(self, tag, args, uid):
+        self.require_selected()
+        if self.readonly:
+            raise _No("mailbox is read-only")
+        messages = self.messages(_text(args[0]), uid)
+        index = 1
+        unchangedsince = None
+        if isinstance(args[1], list):
+            unchangedsince = int(_text(args[1][1]))
+            index = 2
+        operation = _text(args[index]).upper()
+        flags = args[index + 1]
+        flags = set(_text(f) for f in (flags if isinstance(flags, list)
+            else args[index + 1:]))
+        silent = operation.endswith(".SILENT")
+        operation = operation.replace(".SILENT", "")
+        modified = []
+        for seq, message in messages:
+            if unchangedsince is not None and \
+                    message.modseq > unchangedsince:
+                modified.append(message.uid if uid else seq)
+                continue
+            before = set(message.flags)
+            if operation == "+FLAGS":
+                message.flags |= flags
+            elif operation == "-FLAGS":
+                message.flags -= flags
+            elif operation == "FLAGS":
+                message.flags = set(flags)
+            else:
+                raise ProtocolError("bad store operation")
+            if message.flags != before:
+                self.mailbox.modify(message)
+                self.backend.record("store", self.mailbox, message,
+                    added = sorted(message.flags - before),
+                    removed = sorted(before - message.flags))
+            if not silent:
+                items = [b"FLAGS " + _list([f.encode()
+                    for f in sorted(message.flags)])]
+                if uid:
+                    items.insert(0, "UID {}".format(message.uid).encode())
+                if self.condstore:
+                    items.append("MODSEQ ({})".format(
+                        message.modseq).encode())
+                self.send(b"* " + str(seq).encode() + b" FETCH "
+                    + _list(items))
+        self.mailbox.changed()
+        if modified:
+            return b"[MODIFIED " + _compress(modified) + b"] conditional "\
+                b"STORE failed"
+
+    def copy(self, args, uid, move):
+        self.require_selected()
+        messages = self.messages(_text(args[0]), uid)
+        target = self.backend.get(_text(args[1]))
+        if target is None and self.backend.autocreate:
+            target = self.backend.create(_text(args[1]))
+        if target is None:
+            raise _No("[TRYCREATE] no such mailbox")
+        source_uids, target_uids = [], []
+        for seq, message in messages:
+            self.backend.record("move" if move else "copy", self.mailbox,
+                message, to = target.name)
+            source_uids.append(message.uid)
+            target_uids.append(self.backend.append(target.name, message.data,
+                message.flags - {"\\Recent"}, message.internaldate,
+                notify = False))
+        target.changed()
+        code = b""
+        if source_uids and "UIDPLUS" in self.server.capabilities():
+            code = b"[COPYUID " + str(target.uidvalidity).encode() + b" " \
+                + _compress(source_uids) + b" " + _compress(target_uids) \
+                + b"] "
+        if move:
+            if code:
+                self.send(b"* OK " + code + b"moved")
+            self.backend.expunge(self.mailbox, set(source_uids))
+            self.synchronize()
+            return b"MOVE completed"
+        return code + b"COPY completed"
+
+    def do_copy(self, tag, args, uid):
+        return self.copy(args, uid, False)
+
+    def do_move(self, tag, args, uid):
+        if self.readonly:
+            raise _No("mailbox is read-only")
+        return self.copy(args, uid, True)
+
+def _compress(numbers):
+    numbers = sorted(set(numbers))
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(lo) if lo == hi else "{}:{}".format(lo, hi)
+        for lo, hi in ranges).encode()
+
+class Server:
+    """An in-memory IMAP server running in a background thread.
+
+    :param backend: mailbox storage (default: a new, empty backend)
+    :param host: listening address
+    :param port: listening port (default: any free port)
+    :param idle: advertise IDLE
+    :param move: advertise MOVE
+    :param uidplus: advertise UIDPLUS
+    :param condstore: advertise CONDSTORE and QRESYNC
+    :param notify: advertise NOTIFY
+    :param esearch: advertise ESEARCH, SEARCHRES, MULTISEARCH and PARTIAL
+    :param latency: delay before each response in seconds, either a
+        number or a mapping of command names to numbers (the key None
+        is the default)
+    :param users: mapping of usernames to passwords (default: accept
+        any credentials)
+    :type backend: Backend
+    :type host: str
+    :type port: int
+    :type idle: bool
+    :type move: bool
+    :type uidplus: bool
+    :type condstore: bool
+    :type notify: bool
+    :type esearch: bool
+    :type latency: float or mapping
+    :type users: mapping
+    """
+
+    def __init__(self, backend = None, host = "127.0.0.1", port = 0,
+            idle = True, move = True, uidplus = True, condstore = True,
+            notify = False, esearch = False, latency = 0, users = None):
+        self.backend = backend if backend is not None else Backend()
+        self.host = host
+        self.port = port
+        self.idle = idle
+        self.move = move
+        self.uidplus = uidplus
+        self.condstore = condstore
+        self.notify = notify
+        self.esearch = esearch
+        self.latency = latency
+        self.users = users
+        self.commands = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._loop = None
+        self._thread = None
+        self._server = None
+
+    def capabilities(self):
+        """Return the advertised capabilities.
+
+        :rtype: list of str
+        """
+
+        capabilities = ["IMAP4rev1", "LITERAL+", "ENABLE", "UNSELECT"]
+        if self.idle:
+            capabilities.append("IDLE")
+        if self.move:
+            capabilities.append("MOVE")
+        if self.uidplus:
+            capabilities.append("UIDPLUS")
+        if self.condstore:
+            capabilities.extend(["CONDSTORE", "QRESYNC"])
+        if self.notify:
+            capabilities.append("NOTIFY")
+        if self.esearch:
+            capabilities.extend(["ESEARCH", "SEARCHRES", "MULTISEARCH",
+                "PARTIAL"])
+        return capabilities
+
+    def commands_allowed(self):
+        allowed = set(["CAPABILITY", "NOOP", "LOGOUT", "LOGIN", "SELECT",
+            "EXAMINE", "CREATE", "LIST", "STATUS", "APPEND", "CLOSE",
+            "UNSELECT", "EXPUNGE", "SEARCH", "FETCH", "STORE", "COPY",
+            "ENABLE"])
+        capabilities = self.capabilities()
+        for name in ("IDLE", "MOVE", "NOTIFY"):
+            if name in capabilities:
+                allowed.add(name)
+        if "MULTISEARCH" in capabilities:
+            allowed.add("ESEARCH")
+        return allowed
+
+    def start(self):
+        """Start serving in a background thread.
+
+        :return: listening address
+        :rtype: (host, port) tuple
+        """
+
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._accept, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks,
+                return_exceptions = True))
+            self._loop.close()
+
+        self._thread = threading.Thread(target = serve, daemon = True,
+            name = "imaplar-server")
+        self._thread.start()
+        started.wait()
+        return self.host, self.port
+
+    def stop(self):
+        """Stop serving."""
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def call(self, function, *args, **kwargs):
+        """Call a function in the server thread and return its result.
+
+        :param function: function to call
+        :type function: callable
+        """
+
+        if self._loop is None:
+            return function(*args, **kwargs)
+        future = asyncio.run_coroutine_threadsafe(
+            self._call(function, args, kwargs), self._loop)
+        return future.result()
+
+    async def _call(self, function, args, kwargs):
+        return function(*args, **kwargs)
+
+    def append(self, mailbox, data, flags = ()):
+        """Deliver a message.
+
+        :param mailbox: mailbox name
+        :param data: raw message
+        :param flags: message flags
+        :type mailbox: str
+        :type data: bytes
+        :type flags: iterable of strings
+        :return: message uid
+        :rtype: int
+        """
+
+        return self.call(self.backend.append, mailbox, data, flags)
+
+    async def _accept(self, reader, writer):
+        await Connection(self, reader, writer).run()
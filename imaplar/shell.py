@@ -24,14 +24,27 @@ import argparse
 import cerberus
 import collections.abc
 import functools
+import importlib
+import importlib.util
 import logging.config
 import os
 import ssl
 import sys
-import threading
 import yaml
+from . import cache
+from . import checkpoint
 from . import client
+from . import engine
+from . import index
+from . import metrics
+from . import pipeline
+from . import pool
+from . import processes
+from . import profiling
+from . import policy as _policy
+from . import replay
 from . import schema
+from . import trace
 
 try:
     from importlib import metadata
@@ -68,10 +81,84 @@ auth_factories = {
                     config["oauth2_vendor"])
 }
 
+def load_module(name, module):
+    """Load a policy module.
+
+    :param name: policy name
+    :param module: a module name, or the path of a python file
+    :type name: str
+    :type module: str
+    :return: the module
+    :rtype: types.ModuleType
+    """
+
+    if module.endswith(".py"):
+        spec = importlib.util.spec_from_file_location(
+            "imaplar_policy_{}".format(name), os.path.expanduser(module))
+        loaded = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loaded)
+    else:
+        loaded = importlib.import_module(module)
+
+    if not hasattr(loaded, "handle") and not hasattr(loaded, "handle_batch"):
+        raise ConfigurationError(
+            "{}: policy module defines no handler".format(module))
+    return loaded
+
+def read_config(path):
+    """Read and validate a configuration file.
+
+    :param path: file path
+    :type path: str
+    :return: the validated configuration
+    :rtype: dict
+    """
+
+    validator = cerberus.Validator(schema.config)
+    with open(path) as stream:
+        config = validator.validated(yaml.safe_load(stream))
+    if not config:
+        raise ConfigurationError(validator.errors)
+    return config
+
+def load_policies(config):
+    """Compile the configured policy scripts, and load policy modules.
+
+    :param config: the validated configuration
+    :type config: dict
+    :return: mapping of policy names to policies
+    :rtype: dict
+    """
+
+    policies = {}
+    for name, policy_config in config["policies"].items():
+        if isinstance(policy_config, str):
+            policy_config = {"code": policy_config}
+        if "module" in policy_config:
+            policy = client.Policy(
+                module = load_module(name, policy_config["module"]))
+        else:
+            policy = client.Policy(compile(policy_config["code"],
+                "<policy_{}>".format(name), "exec"),
+                source = policy_config["code"])
+        for option in ("batch", "batch_size", "prefetch", "headers",
+                "process"):
+            if option in policy_config:
+                setattr(policy, option, policy_config[option])
+        policy.name = name
+        policies[name] = policy
+    return policies
+
 def main(argv = sys.argv):
+    # subcommands
+    if len(argv) > 1 and argv[1] == "replay":
+        return replay.main(argv)
+
     # parse command line
     parser = argparse.ArgumentParser(prog = argv[0],
-        description = __doc__)
+        description = __doc__,
+        epilog = "Run '%(prog)s replay --help' to replay policies "
+            "over a Maildir or mbox snapshot.")
     parser.add_argument("--config",
         default = os.path.expanduser("~/.imaplar"),
         help = "configuration file (default: '~/.imaplar')")
@@ -82,27 +169,73 @@ def main(argv = sys.argv):
     args = parser.parse_args(args = argv[1:])
 
     # read configuration
-    validator = cerberus.Validator(schema.config)
-    with open(args.config) as stream:
-        config = validator.validated(yaml.load(stream))
-    if not config:
-        raise ConfigurationError(validator.errors)
+    config = read_config(args.config)
 
     # configure logging
     if "logging" in config:
         logging.config.dictConfig(config["logging"])
 
-    # compile policies
-    policies = dict(
-        (name, compile(code, "<policy_{}>".format(name), "exec"))
-            for name, code in config["policies"].items())
+    # compile scripts and load modules
+    policies = load_policies(config)
 
     # monitored servers
     servers = args.servers if args.servers\
         else [k for k, v in config["servers"].items() if v["default"]]
 
+    # checkpoint store
+    checkpoints = None
+    checkpoints_config = config.get("checkpoints", None)
+    if checkpoints_config:
+        checkpoints = checkpoint.SQLiteStore(
+            os.path.expanduser(checkpoints_config["path"]))
+
+    # correspondent index
+    correspondents = None
+    correspondents_config = config.get("correspondents", None)
+    if correspondents_config:
+        correspondents = index.CorrespondentIndex(
+            os.path.expanduser(correspondents_config["path"]))
+
+    # process pool, shared by all sessions
+    process_pool = None
+    processes_config = config.get("processes", None)
+    if processes_config:
+        process_pool = processes.ProcessPool(processes_config["workers"],
+            processes_config["max_tasks"], processes_config["timeout"])
+
+    # query compilation
+    queries_config = config.get("queries", None)
+    if queries_config:
+        _policy.Query.max_length = queries_config["max_length"]
+
+    # query cache, shared by all policies
+    query_cache_config = config.get("query_cache", None)
+    if query_cache_config:
+        _policy.Query.cache = cache.QueryCache(
+            query_cache_config["size"], query_cache_config["ttl"])
+
+    # metrics endpoint
+    metrics_config = config.get("metrics", None)
+    if metrics_config:
+        metrics.serve(metrics_config["host"], metrics_config["port"])
+
+    # command tracing
+    tracing_config = config.get("tracing", None)
+    if tracing_config:
+        spans = tracing_config["spans"]
+        trace.tracer = trace.Tracer(tracing_config["slow"],
+            trace.exporter(spans) if spans else None)
+
+    # policy profiling
+    profiling_config = config.get("profiling", None)
+    if profiling_config:
+        profiling.profiler = profiling.Profiler(
+            os.path.expanduser(profiling_config["path"]),
+            profiling_config["slowest"])
+
     # configure sessions 
-    sessions = []
+    engine_config = config["engine"]
+    sessions = engine.Engine(engine_config["workers"])
     for server in servers:
         # server configuration
         server_config = config["servers"].get(server, None)
@@ -145,21 +278,52 @@ def main(argv = sys.argv):
         # server specific parameters
         parameters = server_config.get("parameters", {})
 
+        # all mailboxes share one connection
+        mailboxes = {}
         for mailbox, policy in server_config["mailboxes"].items():
             if policy not in policies:
                 raise ConfigurationError(
                     "{}: policy not defined".format(policy))
-            sessions.append(client.Session(server, port,
+            mailboxes[mailbox] = policies[policy]
+        if mailboxes:
+            session = client.Session(server, port,
                 tls_mode, ssl_context, authenticator,
                 server_config["poll"], server_config["idle"],
-                mailbox, policies[policy], parameters))
+                parameters = parameters, mailboxes = mailboxes,
+                window = server_config["window"])
+            if checkpoints:
+                session.checkpoints = checkpoints
+            if correspondents:
+                session.correspondents = correspondents
+                session.indexed = server_config["correspondents"]
+            session.processes = process_pool
+            pool_config = server_config.get("pool", None)
+            if pool_config:
+                session.pool = pool.ConnectionPool(session.connect,
+                    pool_config["min"], pool_config["max"],
+                    pool_config["idle"], pool_config["check"],
+                    pool_config["timeout"])
+                session.pool.start()
+            catchup_config = server_config.get("catchup", None)
+            if catchup_config:
+                session.catchup = catchup_config["connections"]
+            pipeline_config = server_config.get("pipeline", None)
+            if pipeline_config:
+                session.pipeline = pipeline.Pipeline(session,
+                    pipeline_config["workers"],
+                    pipeline_config["queue_size"],
+                    pipeline_config["ordered"])
+            sessions.add(session,
+                min = server_config["min_backoff"],
+                max = server_config["max_backoff"])
 
     # run sessions
-    for session in sessions:
-        thread = threading.Thread(target = session.run_forever, kwargs = {
-           "min": server_config["min_backoff"],
-           "max": server_config["max_backoff"]})
-        thread.start()
+    try:
+        sessions.run()
+    finally:
+        if process_pool:
+            process_pool.close()
+        trace.tracer.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,457 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+This module traces IMAP commands. Every command is timed, its bytes
+counted, and it is attributed to the session and policy run that sent
+it. Slow commands are logged, and spans may be exported in the
+OpenTelemetry (OTLP/JSON) format to a file or an HTTP collector.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# span kinds, as defined by OTLP
+INTERNAL = 1
+CLIENT = 3
+
+# the innermost span of the current thread or task
+_current = contextvars.ContextVar("imaplar_span", default = None)
+
+# pooled connections may count commands against a span concurrently
+_counting = threading.Lock()
+
+class Span:
+    """A timed operation, such as a policy run or an IMAP command.
+
+    A span inherits its trace, and its attributes, from its parent.
+    It counts the IMAP commands sent while it is current, including
+    those of its descendants, and the bytes they transferred.
+
+    :param name: operation name
+    :param attributes: attributes of the operation
+    :param parent: the enclosing span, if any
+    :param kind: INTERNAL or CLIENT
+    :type name: str
+    :type attributes: dict
+    :type parent: Span
+    :type kind: int
+    """
+
+    __slots__ = ("name", "attributes", "kind", "trace_id", "span_id",
+        "parent_id", "parent", "start", "end", "ok", "commands", "sent",
+        "received")
+
+    def __init__(self, name, attributes, parent = None, kind = INTERNAL):
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(parent.attributes) if parent else {}
+        self.attributes.update(attributes)
+        self.trace_id = parent.trace_id if parent\
+            else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.parent = parent
+        self.start = time.time_ns()
+        self.end = None
+        self.ok = True
+        self.commands = 0
+        self.sent = 0
+        self.received = 0
+
+    def finish(self, end = None):
+        """Mark the span as finished.
+
+        :param end: end time in nanoseconds since the epoch, or None for now
+        :type end: int
+        """
+
+        self.end = time.time_ns() if end is None else end
+
+    def describe(self):
+        """Describe the span's attributes, for logging.
+
+        :rtype: str
+        """
+
+        return " ".join("{}={}".format(k, v)
+            for k, v in sorted(self.attributes.items()))
+
+    def otlp(self):
+        """Convert the span to the OTLP/JSON format.
+
+        :rtype: dict
+        """
+
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [{"key": k, "value": _value(v)}
+                for k, v in sorted(self.attributes.items())],
+            "status": {"code": 1 if self.ok else 2}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class Tracer:
+    """Logs slow commands, and exports spans.
+
+    Spans are exported in batches from a background thread, so a slow
+    exporter does not delay the sessions. If the export queue is full,
+    spans are dropped.
+
+    :param slow: log commands that take at least this many seconds,
+        or None to log none
+    :param exporter: called with each batch of finished spans, or None
+    :param batch_size: the largest batch of spans to export
+    :param interval: the longest time, in seconds, a span waits
+        to be exported
+    :param queue_size: the most spans waiting to be exported
+    :type slow: float
+    :type exporter: callable
+    :type batch_size: int
+    :type interval: float
+    :type queue_size: int
+    """
+
+    def __init__(self, slow = None, exporter = None, batch_size = 512,
+            interval = 5, queue_size = 8192):
+        self.slow = slow
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, attributes = None):
+        """Trace an operation, and the commands it sends.
+
+        :param name: operation name
+        :param attributes: attributes of the operation
+        :type name: str
+        :type attributes: dict
+        :return: a context manager yielding the span
+        """
+
+        span = Span(name, attributes or {}, _current.get())
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException:
+            span.ok = False
+            raise
+        finally:
+            _current.reset(token)
+            span.finish()
+            self.export(span)
+
+    def command(self, server, name, start, duration, sent, received,
+            status):
+        """Record a completed IMAP command.
+
+        :param server: server name
+        :param name: command name
+        :param start: start time in nanoseconds since the epoch
+        :param duration: elapsed time in seconds
+        :param sent: bytes sent
+        :param received: bytes received
+        :param status: the tagged response status, such as "OK",
+            or None if the command failed without one
+        :type server: str
+        :type name: str
+        :type start: int
+        :type duration: float
+        :type sent: int
+        :type received: int
+        :type status: str
+        """
+
+        metrics.commands.labels(server, name).observe(duration)
+        parent = _current.get()
+        if parent:
+            with _counting:
+                ancestor = parent
+                while ancestor:
+                    ancestor.commands += 1
+                    ancestor.sent += sent
+                    ancestor.received += received
+                    ancestor = ancestor.parent
+
+        slow = self.slow is not None and duration >= self.slow
+        if not slow and not self.exporter:
+            return
+        span = Span(name, {
+                "imap.server": server,
+                "imap.command": name,
+                "imap.status": status or "",
+                "imap.bytes_sent": sent,
+                "imap.bytes_received": received
+            }, parent, CLIENT)
+        span.start = start
+        span.finish(start + int(duration * 1e9))
+        span.ok = status == "OK"
+        if slow:
+            logger.warning("slow command: {:.3f}s {}".format(duration,
+                span.describe()))
+        self.export(span)
+
+    def export(self, span):
+        """Queue a finished span for export.
+
+        :param span: the span
+        :type span: Span
+        """
+
+        if not self.exporter:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._export,
+                    name = "imaplar-trace", daemon = True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def close(self):
+        """Export any queued spans, and stop the export thread."""
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self._queue.put(None)
+            thread.join()
+
+    def _export(self):
+        done = False
+        while not done:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    span = self._queue.get(
+                        timeout = max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if span is None:
+                    done = True
+                    break
+                batch.append(span)
+            if batch:
+                try:
+                    self.exporter(batch)
+                except Exception:
+                    logger.exception("span export failed")
+
+# the tracer used by all sessions
+tracer = Tracer()
+
+def span(name, attributes = None):
+    """Trace an operation with the current tracer.
+
+    :param name: operation name
+    :param attributes: attributes of the operation
+    :type name: str
+    :type attributes: dict
+    :return: a context manager yielding the span
+    """
+
+    return tracer.span(name, attributes)
+
+class FileExporter:
+    """Appends batches of spans to a file, one OTLP/JSON request per line.
+
+    This is the format written by the OpenTelemetry Collector's file
+    exporter.
+
+    :param path: file path
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, spans):
+        with open(self.path, "a") as stream:
+            stream.write(json.dumps(_request(spans)) + "\n")
+
+class HTTPExporter:
+    """Posts batches of spans to an OTLP/HTTP collector.
+
+    :param url: the collector's traces endpoint, such as
+        ``http://localhost:4318/v1/traces``
+    :param timeout: request timeout in seconds
+    :type url: str
+    :type timeout: float
+    """
+
+    def __init__(self, url, timeout = 10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, spans):
+        request = urllib.request.Request(self.url,
+            data = json.dumps(_request(spans)).encode("utf-8"),
+            headers = {"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout = self.timeout):
+            pass
+
+def exporter(destination):
+    """Make an exporter for a file path or an HTTP URL.
+
+    :param destination: file path or URL
+    :type destination: str
+    :rtype: FileExporter or HTTPExporter
+    """
+
+    if destination.startswith(("http://", "https://")):
+        return HTTPExporter(destination)
+    return FileExporter(os.path.expanduser(destination))
+
+def instrument(imap, server):
+    """Trace the commands sent over an imaplib connection.
+
+    :param imap: the connection
+    :param server: server name
+    :type imap: imaplib.IMAP4
+    :type server: str
+    """
+
+    # commands on a connection are sent one at a time; a command is
+    # complete once its tagged response has been read, whichever
+    # method reads it
+    command = _Command()
+    new_tag = imap._new_tag
+    send = imap.send
+    read = imap.read
+    readline = imap.readline
+    get_response = imap._get_response
+    sent = metrics.sent.labels(server)
+    received = metrics.received.labels(server)
+
+    def _new_tag():
+        tag = new_tag()
+        command.begin(tag)
+        return tag
+
+    def _send(data):
+        if command.tag is not None and command.name is None:
+            command.name = _name(data)
+        command.sent += len(data)
+        sent.inc(len(data))
+        return send(data)
+
+    def _read(size):
+        data = read(size)
+        command.received += len(data)
+        received.inc(len(data))
+        return data
+
+    def _readline():
+        data = readline()
+        command.received += len(data)
+        received.inc(len(data))
+        return data
+
+    def _get_response():
+        result = get_response()
+        if command.tag is not None:
+            response = imap.tagged_commands.get(command.tag)
+            if response is not None:
+                command.end(server, response[0])
+        return result
+
+    imap._new_tag = _new_tag
+    imap.send = _send
+    imap.read = _read
+    imap.readline = _readline
+    imap._get_response = _get_response
+
+class _Command:
+    def __init__(self):
+        self.tag = None
+
+    def begin(self, tag):
+        self.tag = tag
+        self.name = None
+        self.start = time.time_ns()
+        self.started = time.monotonic()
+        self.sent = 0
+        self.received = 0
+
+    def end(self, server, status):
+        self.tag = None
+        name = self.name or "UNKNOWN"
+        if name == "IDLE":
+            # idling is slow by design
+            return
+        if isinstance(status, bytes):
+            status = status.decode("ascii", "replace")
+        tracer.command(server, name, self.start,
+            time.monotonic() - self.started, self.sent, self.received,
+            status)
+
+def _name(data):
+    # the command name follows the tag, and UID qualifies the next word
+    words = bytes(data).split(None, 3)[1:3]
+    if not words:
+        return None
+    name = words[0].decode("ascii", "replace").upper()
+    if name == "UID" and len(words) > 1:
+        name += " " + words[1].decode("ascii", "replace").upper()
+    return name
+
+def _request(spans):
+    return {
+        "resourceSpans": [{
+            "resource": {
+                "attributes": [{"key": "service.name",
+                    "value": {"stringValue": "imaplar"}}]
+            },
+            "scopeSpans": [{
+                "scope": {"name": "imaplar"},
+                "spans": [s.otlp() for s in spans]
+            }]
+        }]
+    }
+
+def _value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
@@ -0,0 +1,103 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Fixtures shared by the tests, which run sessions against the in-memory
+server.
+"""
+
+import threading
+import time
+import unittest.mock
+from imaplar import client
+from imaplar import server
+
+# how long, in seconds, tests wait for a session to catch up
+timeout = 10
+
+def session(imap, mailboxes, **options):
+    """Make a session that logs in to an in-memory server.
+
+    :param imap: the server
+    :param mailboxes: mapping of mailbox names to policies
+    :param options: other session fields
+    :type imap: imaplar.server.Server
+    :type mailboxes: dict
+    :rtype: imaplar.client.Session
+    """
+
+    options.setdefault("poll", 0.05)
+    return client.Session(imap.host, imap.port, client.TLSMode.DISABLED,
+        None, client.LoginAuthenticator("test", "test"),
+        mailboxes = mailboxes, **options)
+
+def start(session):
+    """Run a session in the background until its server stops.
+
+    :param session: the session
+    :type session: imaplar.client.Session
+    """
+
+    threading.Thread(target = _run, args = (session,),
+        daemon = True).start()
+
+def _run(session):
+    try:
+        session.run()
+    except Exception:
+        # the server stops when the test is over
+        pass
+
+def wait_for(predicate):
+    """Wait until a condition holds, or the timeout passes.
+
+    :param predicate: the condition
+    :type predicate: callable
+    :return: the predicate's last value
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        value = predicate()
+        if value or time.monotonic() >= deadline:
+            return value
+        time.sleep(0.01)
+
+def status_of_selected(test):
+    """Note every STATUS command that names the selected mailbox,
+    which RFC 3501 (6.3.10) advises against, for the rest of a test.
+
+    :param test: the test
+    :type test: unittest.TestCase
+    :return: the names of the mailboxes, as they are noted
+    :rtype: list
+    """
+
+    noted = []
+    do_status = server.Connection.do_status
+
+    def status(connection, tag, args, uid):
+        if connection.mailbox is not None and\
+                connection.mailbox.name == server._text(args[0]):
+            noted.append(connection.mailbox.name)
+        return do_status(connection, tag, args, uid)
+
+    patcher = unittest.mock.patch.object(server.Connection, "do_status",
+        status)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return noted
@@ -0,0 +1,58 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from imaplar import benchmark
+
+class ScenarioTest(unittest.TestCase):
+    """Every scenario completes, whatever the policy does."""
+
+    def check(self, scenario, **options):
+        for engine in (0, 2):
+            for action in ("none", "flag", "move"):
+                with self.subTest(engine = engine, action = action):
+                    result = benchmark.scenarios[scenario](
+                        benchmark.Options(messages = 40, bursts = 4,
+                            mailboxes = 4, size = 256, poll = 0.05,
+                            batch_size = 5, action = action,
+                            engine = engine, timeout = 20, **options))
+                    self.assertTrue(result["completed"])
+                    self.assertEqual(result["messages"], 40)
+
+    def test_backlog(self):
+        self.check("backlog")
+
+    def test_burst(self):
+        self.check("burst")
+
+    def test_mailboxes(self):
+        self.check("mailboxes")
+
+    def test_mailboxes_notify(self):
+        self.check("mailboxes", notify = True)
+
+    def test_queries(self):
+        self.check("queries")
+
+    def test_timeout(self):
+        result = benchmark.burst(benchmark.Options(messages = 10,
+            latency = 0.5, timeout = 1))
+        self.assertFalse(result["completed"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import tempfile
+import unittest
+import support
+from imaplar import client
+from imaplar import index
+from imaplar import server
+
+def _message(sender):
+    return "From: {}\r\nTo: me@example.com\r\n\r\nbody\r\n".format(
+        sender).encode()
+
+class UpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = index.CorrespondentIndex(
+            os.path.join(directory.name, "index.db"))
+        self.addCleanup(self.index.close)
+
+    def check(self, selected):
+        noted = support.status_of_selected(self)
+        with server.Server() as imap:
+            imap.append("INBOX", _message("a@example.com"))
+            with client.Client(imap.host, imap.port, ssl = False)\
+                    as connection:
+                connection.login("test", "test")
+                if selected:
+                    connection.select_folder("INBOX", readonly = True)
+                self.assertEqual(self.index.update(connection, "test",
+                    "INBOX"), 1)
+                imap.append("INBOX", _message("b@example.com"))
+                self.assertEqual(self.index.update(connection, "test",
+                    "INBOX"), 1)
+                self.assertEqual(self.index.update(connection, "test",
+                    "INBOX"), 0)
+        for address in ("a@example.com", "b@example.com"):
+            self.assertTrue(self.index.contains("test", index.ORIGINATOR,
+                address))
+        self.assertEqual(noted, [])
+
+    def test_selected(self):
+        self.check(True)
+
+    def test_unselected(self):
+        self.check(False)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+import support
+from imaplar import benchmark
+from imaplar import client
+from imaplar import server
+
+class Delivering(benchmark.Recorder):
+    """A policy module that delivers more mail while it runs.
+
+    :param imap: the server to deliver to
+    :param deliveries: the number of messages delivered during runs
+    :param action: what to do with each message: "none", "flag" or "move"
+    :param mailbox: the mailbox delivered to
+    """
+
+    def __init__(self, imap, deliveries, action = "none",
+            mailbox = "INBOX"):
+        super().__init__(action)
+        self.imap = imap
+        self.deliveries = deliveries
+        self.mailbox = mailbox
+
+    def handle_batch(self, context, messages):
+        if self.deliveries:
+            self.deliveries -= 1
+            self.imap.append(self.mailbox, benchmark.message(
+                self.deliveries, 256))
+
+            # the server reports the delivery during a command
+            context.client.noop()
+        super().handle_batch(context, messages)
+
+class MailDuringPolicyTest(unittest.TestCase):
+    """Mail that arrives while a policy is running is processed."""
+
+    def check(self, action, mailbox = "INBOX", **options):
+        with server.Server(**options) as imap:
+            imap.append("INBOX", benchmark.message(100, 256))
+            imap.append("Other", benchmark.message(101, 256),
+                ["\\Seen"])
+            policy = Delivering(imap, 3, action, mailbox)
+            watched = client.Policy(module = policy, batch = True)
+            support.start(support.session(imap,
+                {"INBOX": watched, "Other": watched}))
+            self.assertTrue(policy.wait(4, support.timeout))
+
+    def test_idle(self):
+        self.check("none")
+
+    def test_idle_flag(self):
+        self.check("flag")
+
+    def test_idle_move(self):
+        self.check("move")
+
+    def test_poll(self):
+        self.check("none", idle = False)
+
+    def test_poll_flag(self):
+        self.check("flag", idle = False)
+
+    def test_no_condstore(self):
+        self.check("flag", condstore = False)
+
+    def test_notify(self):
+        # NOTIFY reports the other mailbox's new mail during commands,
+        # and the session never polls it
+        self.check("flag", "Other", notify = True)
+
+    def test_status(self):
+        self.check("flag", "Other", idle = False)
+
+class Fetching(Delivering):
+    """A policy module that fetches whole messages, and flags them."""
+
+    def __init__(self, imap):
+        super().__init__(imap, 0, "flag")
+
+    def handle_batch(self, context, messages):
+        context.client.fetch(messages, ["RFC822"])
+        super().handle_batch(context, messages)
+
+class ReadOnlyTest(unittest.TestCase):
+    """Policies always run with the mailbox selected read-only."""
+
+    def test_fetch(self):
+        with server.Server() as imap:
+            for i in range(3):
+                imap.append("INBOX", benchmark.message(i, 256))
+            policy = Fetching(imap)
+            support.start(support.session(imap,
+                {"INBOX": client.Policy(module = policy, batch = True,
+                    batch_size = 1)}))
+            self.assertTrue(policy.wait(3, support.timeout))
+
+            def flags():
+                return imap.call(lambda: [set(m.flags)
+                    for m in imap.backend.get("INBOX").messages])
+
+            # the last batch's actions are applied after it is handled
+            support.wait_for(lambda: all(flags()))
+            self.assertEqual(flags(), [{"\\Flagged"}] * 3)
+
+class SelectedStatusTest(MailDuringPolicyTest):
+    """STATUS is never sent for the selected mailbox (RFC 3501 6.3.10)."""
+
+    def setUp(self):
+        self.selected = support.status_of_selected(self)
+
+    def tearDown(self):
+        self.assertEqual(self.selected, [])
+
+if __name__ == "__main__":
+    unittest.main()
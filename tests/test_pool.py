@@ -0,0 +1,95 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+import unittest.mock
+import support
+from imaplar import benchmark
+from imaplar import client
+from imaplar import pipeline
+from imaplar import pool
+from imaplar import server
+
+class Pooled(benchmark.Recorder):
+    """A policy module that borrows a pooled connection for each batch."""
+
+    def handle_batch(self, context, messages):
+        with context.pool.connection() as pooled:
+            pooled.noop()
+        super().handle_batch(context, messages)
+
+def _session(imap, policy, max = 2):
+    session = support.session(imap, {"INBOX": client.Policy(
+        module = policy, batch = True, batch_size = 5)})
+    session.pool = pool.ConnectionPool(session.connect, max = max,
+        timeout = 5)
+    return session
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_timeout(self):
+        with server.Server() as imap:
+            session = _session(imap, Pooled(), max = 1)
+            session.pool.timeout = 0.1
+            with session.pool.connection():
+                with self.assertRaises(pool.PoolTimeout):
+                    session.pool.acquire()
+            with session.pool.connection() as pooled:
+                pooled.noop()
+            session.pool.close()
+
+    def test_maintain(self):
+        # a pool that checks and evicts at once doesn't spin
+        connections = pool.ConnectionPool(None, check = 0, idle = 0)
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            connections.close()
+
+        with unittest.mock.patch("time.sleep", sleep):
+            connections._maintain()
+        self.assertEqual(delays, [1])
+
+    def test_pipeline(self):
+        # as many workers as pooled connections, each running a policy
+        # that borrows one
+        with server.Server() as imap:
+            for i in range(20):
+                imap.append("INBOX", benchmark.message(i, 256))
+            policy = Pooled()
+            session = _session(imap, policy)
+            session.pipeline = pipeline.Pipeline(session, 2)
+            support.start(session)
+            self.assertTrue(policy.wait(20, support.timeout))
+
+    def test_catchup(self):
+        # a backlog caught up on over more connections than the pool
+        # has, by policies that borrow from the pool
+        with server.Server() as imap:
+            for i in range(50):
+                imap.append("INBOX", benchmark.message(i, 256))
+            policy = Pooled()
+            session = _session(imap, policy)
+            session.window = 5
+            session.catchup = 4
+            support.start(session)
+            self.assertTrue(policy.wait(50, support.timeout))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import importlib.util
+import os
+import tempfile
+import unittest
+import support
+from imaplar import client
+from imaplar import processes
+
+# a policy module whose state is the file in which it records teardowns
+_module = """
+import time
+
+def setup(parameters):
+    return parameters["path"]
+
+def handle(context, message):
+    time.sleep(context.parameters.get("sleep", 0))
+    if message in context.parameters.get("fail", ()):
+        raise ValueError(message)
+
+def teardown(state):
+    with open(state, "a") as f:
+        f.write("torn down\\n")
+"""
+
+class TeardownTest(unittest.TestCase):
+    """Policy modules are torn down in worker processes."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "teardowns")
+        source = os.path.join(directory.name, "imaplar_test_teardown.py")
+        with open(source, "w") as f:
+            f.write(_module)
+        spec = importlib.util.spec_from_file_location(
+            "imaplar_test_teardown", source)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self.policy = client.Policy(module = module)
+
+    def run_policy(self, pool, messages = (1,), **parameters):
+        parameters["path"] = self.path
+        return pool.run("test", self.policy, "INBOX", list(messages), {},
+            parameters)
+
+    def teardowns(self):
+        try:
+            with open(self.path) as f:
+                return len(f.readlines())
+        except FileNotFoundError:
+            return 0
+
+    def test_max_tasks(self):
+        pool = processes.ProcessPool(1, max_tasks = 1)
+        try:
+            self.assertEqual(self.run_policy(pool)[1], 0)
+            support.wait_for(self.teardowns)
+            self.assertEqual(self.teardowns(), 1)
+        finally:
+            pool.close()
+
+    def test_timeout(self):
+        pool = processes.ProcessPool(1, timeout = 0.5)
+        try:
+            self.assertEqual(self.run_policy(pool, sleep = 60), (None, 1))
+            support.wait_for(self.teardowns)
+            self.assertEqual(self.teardowns(), 1)
+        finally:
+            pool.close()
+
+    def test_close(self):
+        pool = processes.ProcessPool(2)
+        self.assertEqual(self.run_policy(pool)[1], 0)
+        pool.close()
+        support.wait_for(self.teardowns)
+        self.assertEqual(self.teardowns(), 1)
+
+    def test_failures(self):
+        pool = processes.ProcessPool(1)
+        try:
+            actions, failed = self.run_policy(pool, [1, 2, 3],
+                fail = [1, 3])
+            self.assertIsNotNone(actions)
+            self.assertEqual(failed, 2)
+        finally:
+            pool.close()
+
+if __name__ == "__main__":
+    unittest.main()
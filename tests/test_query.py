@@ -0,0 +1,145 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+import support
+from imaplar import cache
+from imaplar import client
+from imaplar import policy
+from imaplar import server
+
+def _from(*addresses):
+    return [policy.Query(["FROM", a]) for a in addresses]
+
+class CompileTest(unittest.TestCase):
+
+    def test_any_empty(self):
+        self.assertEqual(policy._any([]), ["NOT", "ALL"])
+
+    def test_any_duplicates(self):
+        # duplicates differ only in case, and the first is kept
+        self.assertEqual(policy._any(_from("a@x.com", "b@x.com")
+                + [policy.Query(["from", "A@X.COM"])]),
+            ["OR", ["FROM", "a@x.com"], ["FROM", "b@x.com"]])
+
+    def test_balance(self):
+        self.assertEqual(policy._balance(_from("a", "b", "c", "d", "e")),
+            ["OR", ["OR", ["FROM", "a"], ["FROM", "b"]],
+                ["OR", ["FROM", "c"], ["OR", ["FROM", "d"],
+                    ["FROM", "e"]]]])
+
+    def test_or_flattens(self):
+        # ORed queries are rebalanced, without duplicates
+        query = policy.FromQuery(["a@x.com", "b@x.com"])\
+            | policy.FromQuery(["b@x.com", "c@x.com", "d@x.com"])
+        self.assertEqual(query, policy._balance(
+            _from("a@x.com", "b@x.com", "c@x.com", "d@x.com")))
+
+class SplitTest(unittest.TestCase):
+
+    def split(self, criteria, limit):
+        return list(policy._split(criteria, limit))
+
+    def test_short(self):
+        query = policy.FromQuery(["a@x.com", "b@x.com"])
+        self.assertEqual(self.split(query, 1000), [query])
+
+    def test_or(self):
+        query = policy._balance(_from("a", "b", "c", "d"))
+        self.assertEqual(self.split(query, 10), _from("a", "b", "c", "d"))
+
+    def test_nested_or(self):
+        # only as far as needed to fit
+        query = policy._balance(_from("a", "b", "c", "d"))
+        self.assertEqual(self.split(query, 30), [
+            ["OR", ["FROM", "a"], ["FROM", "b"]],
+            ["OR", ["FROM", "c"], ["FROM", "d"]]])
+
+    def test_and_over_or(self):
+        query = policy.Query(["SEEN",
+            policy._balance(_from("a", "b", "c", "d"))])
+        self.assertEqual(self.split(query, 20),
+            [["SEEN", q] for q in _from("a", "b", "c", "d")])
+
+    def test_not(self):
+        query = ~policy._balance(_from("a", "b", "c", "d"))
+        self.assertEqual(self.split(query, 10), [query])
+
+    def test_or_key(self):
+        # an operand of an OR key, which may itself be negated
+        disjunction = policy._balance(_from("a", "b", "c", "d"))
+        query = policy.Query(["NOT", "OR", "SEEN", disjunction])
+        self.assertEqual(self.split(query, 40), [query])
+
+    def test_not_within_or(self):
+        # the disjunction is split, but not the negation within it
+        negation = ~policy._balance(_from("a", "b", "c", "d"))
+        query = policy.Query(["OR", ["FROM", "e"], negation])
+        self.assertEqual(self.split(query, 20), [["FROM", "e"], negation])
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.max_length = policy.Query.max_length
+        policy.Query.max_length = 100
+
+    def tearDown(self):
+        policy.Query.max_length = self.max_length
+
+    def test_not(self):
+        addresses = ["a@x.com"] + ["u{}@example.com".format(i)
+            for i in range(10)]
+        with server.Server() as imap:
+            for i in range(3):
+                imap.append("INBOX", "From: a@x.com\r\nSubject: {}\r\n"
+                    "\r\nbody\r\n".format(i).encode())
+            imap.append("INBOX", b"From: b@x.com\r\n\r\nbody\r\n")
+            with client.Client(imap.host, imap.port, ssl = False)\
+                    as connection:
+                connection.login("test", "test")
+                query = policy.FromQuery(addresses)
+                self.assertEqual(list(query(connection, "INBOX")),
+                    [1, 2, 3])
+                self.assertEqual(list((~query)(connection, "INBOX")), [4])
+
+class CachedSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        policy.Query.cache = cache.QueryCache(16, 60)
+        self.addCleanup(setattr, policy.Query, "cache", None)
+
+    def test_selected(self):
+        # the selected mailbox's state comes from selecting it again
+        noted = support.status_of_selected(self)
+        query = policy.FromQuery(["a@x.com"])
+        with server.Server() as imap:
+            imap.append("INBOX", b"From: a@x.com\r\n\r\nbody\r\n")
+            with client.Client(imap.host, imap.port, ssl = False)\
+                    as connection:
+                connection.login("test", "test")
+                connection.select_folder("INBOX", readonly = True)
+                self.assertEqual(list(query(connection, "INBOX")), [1])
+                self.assertEqual(list(query(connection, "INBOX")), [1])
+                imap.append("INBOX", b"From: a@x.com\r\n\r\nbody\r\n")
+                self.assertEqual(list(query(connection, "INBOX")),
+                    [1, 2])
+                self.assertTrue(connection.readonly)
+        self.assertEqual(noted, [])
+
+if __name__ == "__main__":
+    unittest.main()
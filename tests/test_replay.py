@@ -0,0 +1,86 @@
+#
+# Copyright (C) 2017-2022 Michael Paddon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import contextlib
+import functools
+import io
+import mailbox
+import os
+import tempfile
+import unittest
+import unittest.mock
+from imaplar import benchmark
+from imaplar import client
+from imaplar import replay
+from imaplar import server
+from imaplar import trace
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshot.mbox")
+        corpus = mailbox.mbox(self.path)
+        for i in range(10):
+            corpus.add("Subject: {}\nStatus: {}\n\nFrom here\n{}".format(
+                i, "RO" if i % 2 else "O", "\n" * (i % 3)).encode())
+        corpus.close()
+
+    def test_mbox(self):
+        corpus = mailbox.mbox(self.path, create = False)
+        expected = [corpus.get_bytes(key) for key in corpus.iterkeys()]
+        corpus.close()
+        os.chmod(self.path, 0o444)
+
+        backend = server.Backend()
+        self.assertEqual(replay.load(backend, self.path), 10)
+        messages = backend.get("INBOX").messages
+        self.assertEqual([m.data for m in messages], expected)
+        self.assertEqual([m.flags for m in messages],
+            [{"\\Seen"} if i % 2 else set() for i in range(10)])
+
+    def test_missing(self):
+        for snapshot in ("missing.mbox", "INBOX=missing.mbox",
+                "=" + self.path):
+            with self.subTest(snapshot = snapshot):
+                with contextlib.redirect_stderr(io.StringIO()) as error:
+                    with self.assertRaises(SystemExit):
+                        replay.main(["imaplar", "replay", snapshot])
+                self.assertIn("no such snapshot", error.getvalue())
+
+class ReplayTest(unittest.TestCase):
+
+    def test_timings(self):
+        # every run is reported, however few spans the trace can hold
+        backend = server.Backend()
+        backend.create("INBOX")
+        for i in range(20):
+            backend.append("INBOX", benchmark.message(i, 256),
+                notify = False)
+        policy = client.Policy(module = benchmark.Recorder(),
+            batch = True, batch_size = 1, name = "test")
+        with unittest.mock.patch.object(trace, "Tracer",
+                functools.partial(trace.Tracer, queue_size = 1)):
+            timings = replay.replay({"INBOX": policy}, {}, backend,
+                io.StringIO())
+        self.assertEqual(timings["test"]["runs"], 20)
+        self.assertEqual(timings["test"]["messages"], 20)
+
+if __name__ == "__main__":
+    unittest.main()